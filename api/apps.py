@@ -1,4 +1,4 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.apps import AppConfig
 
 
@@ -6,7 +6,21 @@ class ApiConfig(AppConfig):
     name = "api"
 
     def ready(self):
-        from .signals import update_statistics
+        from django.contrib.auth.models import User
+        from rest_framework.authtoken.models import Token
+        from .signals import (
+            update_statistics,
+            invalidate_platform_wallet,
+            invalidate_token,
+            invalidate_user_tokens,
+        )
 
         Transaction = self.get_model("Transaction")
         post_save.connect(update_statistics, sender=Transaction)
+        # The platform wallet is memoized (see models.get_platform_wallet)
+        Wallet = self.get_model("Wallet")
+        post_delete.connect(invalidate_platform_wallet, sender=Wallet)
+        post_delete.connect(invalidate_platform_wallet, sender=User)
+        # Authenticated tokens are cached (see CachedTokenAuthentication)
+        post_delete.connect(invalidate_token, sender=Token)
+        post_save.connect(invalidate_user_tokens, sender=User)
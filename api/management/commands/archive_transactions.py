@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.models import ArchivedTransaction, Transaction
+from api.utils.partitions import drop_partition, is_partitioned, partitions
+
+
+class Command(BaseCommand):
+    """
+    Moves the transactions of the months older than
+    TRANSACTION_ARCHIVE_AFTER_MONTHS (or --months) to the archive table. On a partitioned
+    table, whole month partitions are copied in one statement and dropped,
+    so no dead rows are left behind. Remaining rows (e.g. in the default
+    partition) are moved in chunks. The archive is only appended to, in
+    (created_at, id) order, so it stays compact.
+    """
+
+    help = "Move the transactions of closed months to the archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months",
+            type=int,
+            default=settings.TRANSACTION_ARCHIVE_AFTER_MONTHS,
+            help="Archive transactions older than this many months. "
+            "Defaults to TRANSACTION_ARCHIVE_AFTER_MONTHS, which must be set.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Rows moved per transaction outside of partitions. "
+            "Defaults to 5000.",
+        )
+
+    def handle(self, *args, **options):
+        # The archive is only read while the setting is set: archiving
+        # without it would hide the archived transactions.
+        if not ArchivedTransaction.in_use():
+            raise CommandError("Set TRANSACTION_ARCHIVE_AFTER_MONTHS first.")
+        if options["months"] < 0:
+            raise CommandError("--months can't be negative.")
+        cutoff = ArchivedTransaction.cutoff(options["months"])
+
+        archived = 0
+        if is_partitioned():
+            archived += self.archive_partitions(cutoff)
+        archived += self.archive_rows(cutoff, options["chunk_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Archived {archived} transaction(s) created before "
+                f"{cutoff.isoformat()}."
+            )
+        )
+
+    def archive_partitions(self, cutoff):
+        columns = ", ".join(ArchivedTransaction.COLUMNS)
+        archived = 0
+        for name, _, end in partitions():
+            if end > cutoff:
+                break
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {ArchivedTransaction._meta.db_table} ({columns}) "
+                    f"SELECT {columns} FROM {name} ORDER BY created_at, id"
+                )
+                archived += cursor.rowcount
+                drop_partition(name)
+            self.stdout.write(f"Archived partition {name}.")
+        return archived
+
+    def archive_rows(self, cutoff, chunk_size):
+        old = Transaction.objects.filter(created_at__lt=cutoff).order_by(
+            "created_at", "id"
+        )
+        archived = 0
+        while True:
+            with transaction.atomic():
+                rows = list(old.values(*ArchivedTransaction.COLUMNS)[:chunk_size])
+                if not rows:
+                    return archived
+                ArchivedTransaction.objects.bulk_create(
+                    ArchivedTransaction(**row) for row in rows
+                )
+                Transaction.objects.filter(pk__in=[row["id"] for row in rows]).delete()
+            archived += len(rows)
@@ -0,0 +1,300 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.db import connection, transaction
+from django.test.testcases import QuietWSGIRequestHandler
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import requests
+from rest_framework.authtoken.models import Token
+
+from api.models import Wallet, Transaction, get_platform_wallet
+from api.utils.bench import run_concurrently, summarize, test_database
+from api.utils.rates import Rates
+
+OPERATIONS = [
+    "wallet-detail",
+    "transaction-list",
+    "transfer-internal",
+    "transfer-external",
+]
+DEFAULT_MIX = (
+    "wallet-detail=50,transaction-list=30,transfer-internal=10,transfer-external=10"
+)
+
+
+def parse_mix(value):
+    """
+    Parses a mix of operations like "wallet-detail=50,transfer-internal=10"
+    into a dict of weights.
+    """
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in OPERATIONS:
+            raise CommandError(
+                f"Unknown operation {name!r}, choose from {', '.join(OPERATIONS)}."
+            )
+        try:
+            mix[name] = int(weight)
+        except ValueError:
+            raise CommandError(f"Invalid weight for {name}: {weight!r}.")
+        if mix[name] < 0:
+            raise CommandError(f"Invalid weight for {name}: {weight!r}.")
+    if not any(mix.values()):
+        raise CommandError("At least one operation needs a positive weight.")
+    return mix
+
+
+class Command(BaseCommand):
+    """
+    HTTP load benchmark of the API. Creates a throwaway test database,
+    users with two funded wallets each, serves the app from a local
+    threaded server and drives a mix of wallet reads, transaction lists
+    and transfers from concurrent clients. The rates API is stubbed.
+    Reports throughput and latency percentiles of each operation as JSON,
+    so runs can be compared across releases.
+    """
+
+    help = "Benchmark the API over HTTP with a configurable mix of requests."
+
+    stub_rates = {"usd": 10000, "eur": 9000, "gbp": 8000}
+    grant_amount = Decimal("1.00000000")
+    transfer_amount = Decimal("0.00001")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users", type=int, default=50, help="Bench users. Defaults to 50."
+        )
+        parser.add_argument(
+            "--clients", type=int, default=8, help="Concurrent clients."
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=2000,
+            help="Number of requests. Defaults to 2000.",
+        )
+        parser.add_argument(
+            "--mix",
+            type=parse_mix,
+            default=DEFAULT_MIX,
+            help=f"Weights of the operations. Defaults to {DEFAULT_MIX}.",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Seed of the requests drawn."
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="Reuse the test database if it exists, and keep it afterwards.",
+        )
+        parser.add_argument(
+            "--output", help="File the report is written to. Defaults to stdout."
+        )
+
+    def handle(self, *args, **options):
+        mix = options["mix"]
+        if isinstance(mix, str):
+            mix = parse_mix(mix)
+        if options["users"] < 2:
+            raise CommandError("At least 2 users are needed.")
+
+        with test_database(options["keepdb"]), override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "127.0.0.1"],
+            PLATFORM_INITIAL_FUNDS=str(self.grant_amount * 2 * options["users"] + 1),
+        ), mock.patch.object(
+            Rates, "api_call", classmethod(lambda cls: dict(self.stub_rates))
+        ):
+            cache.delete(Rates.CACHE_KEY)
+            accounts = self.create_accounts(options["users"])
+            server = self.start_server()
+            try:
+                report = self.run(server, accounts, mix, options)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def create_accounts(self, count):
+        """
+        Creates the bench users, their tokens and two wallets per user,
+        granted like WalletCreateView does. Returns the token and wallet
+        addresses of each user.
+        """
+        now = timezone.now()
+        prefix = f"bench-{uuid.uuid4().hex[:8]}"
+        password = make_password(None)
+        with transaction.atomic():
+            usernames = [f"{prefix}-{index}" for index in range(count)]
+            User.objects.bulk_create(
+                User(username=username, password=password, date_joined=now)
+                for username in usernames
+            )
+            # Not all the databases return the primary keys of bulk inserts
+            users = User.objects.in_bulk(usernames, field_name="username")
+            tokens, wallets = [], []
+            for username in usernames:
+                token = Token(user=users[username], created=now)
+                token.key = token.generate_key()
+                tokens.append(token)
+                for _ in range(2):
+                    address = uuid.uuid4()
+                    wallets.append(
+                        Wallet(
+                            address=address,
+                            alias=str(address),
+                            user=users[username],
+                            last_updated=now,
+                        )
+                    )
+            Token.objects.bulk_create(tokens)
+            Wallet.objects.bulk_create(wallets)
+
+            platform_wallet = get_platform_wallet()
+            results = Wallet.transfer_batch(
+                [
+                    {
+                        "wallet_from": platform_wallet,
+                        "wallet_to": wallet,
+                        "transaction_type": Transaction.PLATFORM,
+                        "amount": self.grant_amount,
+                        "extra": "Platform grants 1 BTC after wallet creation.",
+                    }
+                    for wallet in wallets
+                ]
+            )
+            errors = [result for result in results if isinstance(result, str)]
+            if errors:
+                raise CommandError(errors[0])
+        return [
+            {
+                "token": token.key,
+                "wallets": [
+                    str(wallet.address) for wallet in wallets[2 * i : 2 * i + 2]
+                ],
+            }
+            for i, token in enumerate(tokens)
+        ]
+
+    def start_server(self):
+        """
+        Serves the app from a threaded server on a free local port.
+        """
+        server = ThreadedWSGIServer(
+            ("127.0.0.1", 0), QuietWSGIRequestHandler, allow_reuse_address=False
+        )
+        server.set_app(WSGIHandler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def run(self, server, accounts, mix, options):
+        """
+        Makes the requests from the given number of clients and returns the
+        report. Requests answered with an error status count as errors.
+        """
+        base_url = "http://127.0.0.1:%s/api/v1" % server.server_address[1]
+        names = [name for name in OPERATIONS if mix.get(name)]
+        weights = [mix[name] for name in names]
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        lock = threading.Lock()
+        local = threading.local()
+
+        def request(index):
+            rng = random.Random(f"{options['seed']}-{index}")
+            name = rng.choices(names, weights)[0]
+            account, other = rng.sample(accounts, 2)
+            method, path, data = self.build_request(name, account, other, rng)
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            start = time.perf_counter()
+            try:
+                response = local.session.request(
+                    method,
+                    base_url + path,
+                    json=data,
+                    headers={"Authorization": f"Token {account['token']}"},
+                )
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            elapsed = time.perf_counter() - start
+            with lock:
+                if failed:
+                    errors[name] += 1
+                else:
+                    latencies[name].append(elapsed)
+
+        _, _, elapsed = run_concurrently(
+            request, options["clients"], options["requests"]
+        )
+        all_latencies = [value for values in latencies.values() for value in values]
+        return {
+            "config": {
+                "database": connection.vendor,
+                "users": len(accounts),
+                "clients": options["clients"],
+                "requests": options["requests"],
+                "mix": mix,
+                "seed": options["seed"],
+            },
+            "elapsed": round(elapsed, 3),
+            "total": summarize(all_latencies, sum(errors.values()), elapsed),
+            "operations": {
+                name: summarize(latencies[name], errors[name], elapsed)
+                for name in names
+            },
+        }
+
+    def build_request(self, name, account, other, rng):
+        """
+        Returns the method, path and body of a request of the operation.
+        Transfers are made from a wallet of the account, either to its other
+        wallet (internal) or to a wallet of another account (external).
+        """
+        wallet_from, wallet_to = rng.sample(account["wallets"], 2)
+        if name == "wallet-detail":
+            return "GET", f"/wallets/{wallet_from}", None
+        if name == "transaction-list":
+            return "GET", "/transactions/", None
+        if name == "transfer-internal":
+            transaction_type = Transaction.SENT_INTERNAL
+            amount = self.transfer_amount
+        else:
+            transaction_type = Transaction.SENT_EXTERNAL
+            wallet_to = rng.choice(other["wallets"])
+            amount = max(
+                self.transfer_amount,
+                Decimal(settings.PLATFORM_TRANSACTION_LIMITS or 0),
+            )
+        return (
+            "POST",
+            "/transactions/",
+            {
+                "wallet_from": wallet_from,
+                "wallet_to": wallet_to,
+                "transaction_type": transaction_type,
+                "amount": str(amount),
+            },
+        )
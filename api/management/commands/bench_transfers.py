@@ -0,0 +1,107 @@
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.utils import timezone
+
+from api.models import Wallet, Transaction
+from api.utils.bench import run_concurrently, summarize, test_database
+
+
+class Command(BaseCommand):
+    """
+    Compares throughput and latency of the transfer modes under contention.
+    Concurrent transfers are made between a few wallets of a throwaway
+    user, in a throwaway test database, so the configured database is never
+    written to. Use a PostgreSQL server to measure lock contention.
+    """
+
+    help = "Benchmark pessimistic and optimistic transfers under contention."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mode",
+            action="append",
+            dest="modes",
+            choices=[Wallet.PESSIMISTIC, Wallet.OPTIMISTIC],
+            help="Transfer mode to benchmark. May be repeated. Defaults to both.",
+        )
+        parser.add_argument(
+            "--threads", type=int, default=8, help="Concurrent transfers."
+        )
+        parser.add_argument(
+            "--transfers",
+            type=int,
+            default=500,
+            help="Number of transfers per mode. Defaults to 500.",
+        )
+        parser.add_argument(
+            "--wallets",
+            type=int,
+            default=2,
+            help="Number of wallets transfers are made between. Fewer wallets "
+            "means more contention. Defaults to 2.",
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="Reuse the test database if it exists, and keep it afterwards.",
+        )
+
+    def handle(self, *args, **options):
+        modes = options["modes"] or [Wallet.PESSIMISTIC, Wallet.OPTIMISTIC]
+        with test_database(options["keepdb"]):
+            wallets = self.create_wallets(max(options["wallets"], 2))
+            self.stdout.write(
+                f"{'mode':<12} {'threads':>7} {'transfers':>9} {'errors':>6} "
+                f"{'tx/s':>9} {'p50 ms':>9} {'p99 ms':>9}"
+            )
+            for mode in modes:
+
+                def transfer(index):
+                    Wallet.transfer(
+                        wallet_from=wallets[index % len(wallets)],
+                        wallet_to=wallets[(index + 1) % len(wallets)],
+                        transaction_type=Transaction.SENT_INTERNAL,
+                        amount=Decimal("0.00001"),
+                        extra="bench",
+                        mode=mode,
+                    )
+
+                result = summarize(
+                    *run_concurrently(
+                        transfer, options["threads"], options["transfers"]
+                    )
+                )
+                self.stdout.write(
+                    f"{mode:<12} {options['threads']:>7} {result['calls']:>9} "
+                    f"{result['errors']:>6} {result['throughput']:>9} "
+                    f"{result['p50']:>9} {result['p99']:>9}"
+                )
+
+    def create_wallets(self, count):
+        """
+        Creates the bench user and its funded wallets.
+        """
+        with transaction.atomic():
+            user = User.objects.create_user(username=f"bench-{uuid.uuid4().hex[:8]}")
+            now = timezone.now()
+            wallets = []
+            for index in range(count):
+                wallet = Wallet.objects.create(
+                    user=user, alias=f"bench {index}", last_updated=now
+                )
+                funds = Transaction.objects.create(
+                    wallet_to=wallet,
+                    transaction_type=Transaction.PLATFORM,
+                    amount=Decimal("1000"),
+                    details="Bench funds",
+                    created_at=now,
+                )
+                Wallet.objects.filter(pk=wallet.pk).update(
+                    balance_btc=models.F("balance_btc") + funds.amount
+                )
+                wallets.append(wallet)
+        return wallets
@@ -0,0 +1,122 @@
+import heapq
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.utils import timezone
+
+from api.models import ArchivedTransaction, BalanceCheckpoint
+
+
+class Command(BaseCommand):
+    """
+    Streams the transactions ledger (archive included, if in use) once, in
+    (created_at, id) order, and writes a balance checkpoint for each wallet
+    every BALANCE_CHECKPOINT_INTERVAL transactions. Runs are incremental:
+    the ledger is only read after the latest checkpoint already written.
+    """
+
+    help = "Write periodic per-wallet balance checkpoints from the ledger."
+
+    batch_size = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Delete all checkpoints and stream the whole ledger again.",
+        )
+        parser.add_argument(
+            "--settle",
+            type=int,
+            default=60,
+            help="Skip transactions newer than this many seconds, so transfers "
+            "still in flight are not missed. Defaults to 60.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=settings.BALANCE_CHECKPOINT_INTERVAL,
+            help="Transactions per wallet between two checkpoints.",
+        )
+
+    def handle(self, *args, **options):
+        interval = options["interval"]
+        until = timezone.now() - timedelta(seconds=options["settle"])
+
+        with transaction.atomic():
+            if options["rebuild"]:
+                BalanceCheckpoint.objects.all().delete()
+            last = BalanceCheckpoint.objects.aggregate(last=Max("created_at"))
+            watermark = last["last"]
+            # address -> [balance, transactions since checkpoint, last created_at]
+            state = self.latest_checkpoints()
+            iterators = []
+            # Archived rows are all older than the other ones
+            for model in ArchivedTransaction.ledgers():
+                ledger = model.objects.filter(created_at__lte=until)
+                if watermark is not None:
+                    ledger = ledger.filter(created_at__gt=watermark)
+                iterators.append(
+                    ledger.order_by("created_at", "id")
+                    .values_list(
+                        "created_at", "id", "wallet_from", "wallet_to", "amount"
+                    )
+                    .iterator(chunk_size=self.batch_size)
+                )
+            rows = heapq.merge(*iterators, key=lambda row: row[:2])
+
+            pending = []
+            written = 0
+            for created_at, _, wallet_from, wallet_to, amount in rows:
+                for address, delta in ((wallet_to, amount), (wallet_from, -amount)):
+                    if address is None:
+                        continue
+                    wallet_state = state.setdefault(address, [Decimal("0"), 0, None])
+                    # Only cut at a timestamp boundary: a checkpoint must
+                    # include every transaction sharing its created_at.
+                    if wallet_state[1] >= interval and wallet_state[2] != created_at:
+                        pending.append(self.checkpoint(address, wallet_state))
+                    wallet_state[0] += delta
+                    wallet_state[1] += 1
+                    wallet_state[2] = created_at
+                if len(pending) >= self.batch_size:
+                    written += self.write(pending)
+
+            # Close every wallet with unsaved transactions, so the next run
+            # can start right after the latest checkpoint.
+            for address, wallet_state in state.items():
+                if wallet_state[1]:
+                    pending.append(self.checkpoint(address, wallet_state))
+            written += self.write(pending)
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} balance checkpoint(s)."))
+
+    def latest_checkpoints(self):
+        latest = (
+            BalanceCheckpoint.objects.filter(wallet=OuterRef("wallet"))
+            .order_by("-created_at")
+            .values("created_at")[:1]
+        )
+        checkpoints = BalanceCheckpoint.objects.filter(
+            created_at=Subquery(latest)
+        ).values_list("wallet", "balance_btc", "created_at")
+        return {
+            address: [balance, 0, created_at]
+            for address, balance, created_at in checkpoints
+        }
+
+    def checkpoint(self, address, wallet_state):
+        wallet_state[1] = 0
+        return BalanceCheckpoint(
+            wallet_id=address, balance_btc=wallet_state[0], created_at=wallet_state[2]
+        )
+
+    def write(self, pending):
+        BalanceCheckpoint.objects.bulk_create(pending, batch_size=self.batch_size)
+        written = len(pending)
+        pending.clear()
+        return written
@@ -0,0 +1,301 @@
+import json
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from rest_framework import serializers
+
+from api.models import Wallet, Transaction
+from api.serializers import TransactionSerializer
+from api.utils.bench import percentile, test_database
+from api.utils.exception_handler import custom_exception_handler
+
+BENCHMARKS = [
+    "wallet-balance",
+    "wallet-ledger-balance",
+    "transfer",
+    "calculate-profit",
+    "serializer-validate",
+    "serializer-render",
+    "exception-handler",
+]
+
+# Seconds each sample of a benchmark lasts at least
+SAMPLE_TIME = 0.005
+
+
+def measure(func, repeat):
+    """
+    Times func. The calls are grouped in samples lasting about SAMPLE_TIME,
+    so fast functions are timed accurately. Returns the number of calls
+    per sample and the timing of a call in each sample (microseconds).
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    number = max(1, int(SAMPLE_TIME / elapsed)) if elapsed else 1000
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return number, timings
+
+
+def compare(baseline, current, threshold):
+    """
+    Compares the p50 timings of two reports. Returns a (benchmark,
+    ledger_size, baseline p50, current p50, change %, regressed) row for
+    each benchmark in both, regressed when it got slower by more than
+    threshold percent.
+    """
+    baseline_results = {
+        (result["benchmark"], result["ledger_size"]): result
+        for result in baseline["results"]
+    }
+    rows = []
+    for result in current["results"]:
+        key = (result["benchmark"], result["ledger_size"])
+        if key not in baseline_results:
+            continue
+        before, after = baseline_results[key]["p50_us"], result["p50_us"]
+        change = (after - before) / before * 100 if before else 0
+        rows.append((*key, before, after, round(change, 1), change > threshold))
+    return rows
+
+
+class Command(BaseCommand):
+    """
+    Microbenchmarks of the model and serializer hot paths, at growing
+    ledger sizes. Runs against a throwaway test database with a wallet
+    whose ledger is grown to each size. Writes the timings as JSON and
+    compares them to a baseline report, failing if any benchmark
+    regressed by more than the threshold.
+    """
+
+    help = "Benchmark model and serializer hot paths at several ledger sizes."
+
+    amount = Decimal("0.00001")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ledger-size",
+            type=int,
+            action="append",
+            dest="ledger_sizes",
+            help="Transactions of the benchmarked wallet. May be repeated. "
+            "Defaults to 1000, 10000 and 100000.",
+        )
+        parser.add_argument(
+            "--benchmark",
+            action="append",
+            dest="benchmarks",
+            choices=BENCHMARKS,
+            help="Benchmark to run. May be repeated. Defaults to all.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="Samples timed per benchmark. Defaults to 20.",
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="Reuse the test database if it exists, and keep it afterwards.",
+        )
+        parser.add_argument(
+            "--output", help="File the report is written to. Defaults to stdout."
+        )
+        parser.add_argument("--baseline", help="Report to compare the timings against.")
+        parser.add_argument(
+            "--current",
+            help="Compare this report to the baseline instead of running the "
+            "benchmarks.",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=10,
+            help="Slowdown of the p50 (percent) flagged as a regression. "
+            "Defaults to 10.",
+        )
+
+    def handle(self, *args, **options):
+        if options["current"]:
+            if not options["baseline"]:
+                raise CommandError("--current requires --baseline.")
+            report = self.load(options["current"])
+        else:
+            report = self.run(options)
+            output = json.dumps(report, indent=2)
+            if options["output"]:
+                with open(options["output"], "w") as f:
+                    f.write(output + "\n")
+            else:
+                self.stdout.write(output)
+
+        if options["baseline"]:
+            rows = compare(self.load(options["baseline"]), report, options["threshold"])
+            self.stderr.write(
+                f"{'benchmark':<22} {'ledger':>8} {'before us':>11} "
+                f"{'after us':>11} {'change %':>9}"
+            )
+            for name, size, before, after, change, regressed in rows:
+                line = f"{name:<22} {size:>8} {before:>11} {after:>11} {change:>9}"
+                self.stderr.write(self.style.ERROR(line) if regressed else line)
+            regressions = sum(1 for row in rows if row[-1])
+            if regressions:
+                raise CommandError(
+                    f"{regressions} benchmark(s) regressed by more than "
+                    f"{options['threshold']}%."
+                )
+
+    def load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Unable to read report {path}: {exc}")
+
+    def run(self, options):
+        sizes = sorted(options["ledger_sizes"] or [1000, 10000, 100000])
+        names = [
+            name for name in BENCHMARKS if name in (options["benchmarks"] or BENCHMARKS)
+        ]
+        results = []
+        with test_database(options["keepdb"]):
+            wallet, other_wallet = self.create_wallets()
+            for size in sizes:
+                self.grow_ledger(wallet, other_wallet, size)
+                benchmarks = self.benchmarks(wallet, other_wallet)
+                for name in names:
+                    number, timings = measure(benchmarks[name], options["repeat"])
+                    results.append(
+                        {
+                            "benchmark": name,
+                            "ledger_size": size,
+                            "number": number,
+                            "min_us": round(min(timings), 2),
+                            "p50_us": round(percentile(timings, 50), 2),
+                            "p95_us": round(percentile(timings, 95), 2),
+                        }
+                    )
+            vendor = connection.vendor
+        return {
+            "config": {
+                "database": vendor,
+                "repeat": options["repeat"],
+                "ledger_sizes": sizes,
+            },
+            "results": results,
+        }
+
+    def benchmarks(self, wallet, other_wallet):
+        """
+        Returns the benchmarked functions, keyed by name.
+        """
+        user = wallet.user
+        data = {
+            "wallet_from": str(wallet.address),
+            "wallet_to": str(other_wallet.address),
+            "transaction_type": Transaction.SENT_INTERNAL,
+            "amount": str(self.amount),
+        }
+        error = serializers.ValidationError(
+            {"non_field_errors": ["Insufficient funds in wallet"]}
+        )
+
+        def wallet_balance():
+            return Wallet.objects.only("balance_btc").get(pk=wallet.pk).balance_btc
+
+        def transfer():
+            Wallet.transfer(
+                wallet_from=wallet,
+                wallet_to=other_wallet,
+                transaction_type=Transaction.SENT_INTERNAL,
+                amount=self.amount,
+                extra="microbench",
+            )
+
+        def serializer_validate():
+            serializer = TransactionSerializer(data=data, context={"user": user})
+            serializer.is_valid(raise_exception=True)
+
+        def serializer_render():
+            # A page of the transaction list views
+            page = Transaction.objects.filter(
+                models.Q(wallet_from=wallet) | models.Q(wallet_to=wallet)
+            ).order_by("-created_at", "-pk")[:100]
+            return TransactionSerializer(page, many=True).data
+
+        return {
+            "wallet-balance": wallet_balance,
+            "wallet-ledger-balance": wallet.ledger_balance_btc,
+            "transfer": transfer,
+            "calculate-profit": lambda: Transaction.calculate_profit(
+                self.amount, Transaction.SENT_EXTERNAL
+            ),
+            "serializer-validate": serializer_validate,
+            "serializer-render": serializer_render,
+            "exception-handler": lambda: custom_exception_handler(error, {}),
+        }
+
+    def create_wallets(self):
+        """
+        Creates the bench user and its two wallets, the first one funded.
+        """
+        with transaction.atomic():
+            user = User.objects.create_user(username=f"bench-{uuid.uuid4().hex[:8]}")
+            now = timezone.now()
+            wallet = Wallet.objects.create(user=user, alias="bench", last_updated=now)
+            other_wallet = Wallet.objects.create(
+                user=user, alias="bench other", last_updated=now
+            )
+            funds = Transaction.objects.create(
+                wallet_to=wallet,
+                transaction_type=Transaction.PLATFORM,
+                amount=Decimal("1000000"),
+                details="Bench funds",
+                created_at=now,
+            )
+            Wallet.objects.filter(pk=wallet.pk).update(
+                balance_btc=models.F("balance_btc") + funds.amount
+            )
+        wallet.refresh_from_db()
+        return wallet, other_wallet
+
+    def grow_ledger(self, wallet, other_wallet, size, batch_size=10000):
+        """
+        Inserts transfers between the wallets until the first one has size
+        transactions. They go back and forth, so balances are unchanged.
+        """
+        transactions = Transaction.objects.filter(
+            models.Q(wallet_from=wallet) | models.Q(wallet_to=wallet)
+        )
+        missing = size - transactions.count()
+        start = timezone.now() - timedelta(seconds=missing)
+        for offset in range(0, max(missing, 0), batch_size):
+            rows = []
+            for index in range(offset, min(offset + batch_size, missing)):
+                wallets = (
+                    (wallet, other_wallet) if index % 2 else (other_wallet, wallet)
+                )
+                rows.append(
+                    Transaction(
+                        wallet_from=wallets[0],
+                        wallet_to=wallets[1],
+                        transaction_type=Transaction.SENT_INTERNAL,
+                        amount=self.amount,
+                        details="microbench",
+                        created_at=start + timedelta(seconds=index),
+                    )
+                )
+            Transaction.objects.bulk_create(rows)
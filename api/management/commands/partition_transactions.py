@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.utils.partitions import (
+    create_partition,
+    is_partitioned,
+    month_start,
+    partition_name,
+    partitions,
+)
+
+
+class Command(BaseCommand):
+    """
+    Creates the monthly partitions of the transactions table ahead of time,
+    so new transactions never land in the default partition. Meant to be
+    run periodically (e.g. daily). PostgreSQL only.
+    """
+
+    help = "Create the upcoming monthly partitions of the transactions table."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=3,
+            help="Number of months to create after the current one. Defaults to 3.",
+        )
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            raise CommandError("The transactions table is not partitioned.")
+        existing = {name for name, _, _ in partitions()}
+        now = timezone.now()
+        created = 0
+        for months in range(options["ahead"] + 1):
+            start = month_start(now, months)
+            if partition_name(start) not in existing:
+                name = create_partition(start)
+                created += 1
+                self.stdout.write(f"Created partition {name}.")
+        self.stdout.write(
+            self.style.SUCCESS(f"Created {created} transaction partition(s).")
+        )
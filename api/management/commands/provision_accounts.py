@@ -0,0 +1,216 @@
+import csv
+import json
+import os
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+
+from api.models import Wallet, Transaction, get_platform_wallet
+
+
+class Command(BaseCommand):
+    """
+    Provisions users, their tokens and a wallet granted with 1 BTC for each
+    account of a CSV or NDJSON stream (username, password and optional
+    alias of the wallet), like UserCreateView and WalletCreateView do.
+    Accounts are inserted in chunks with bulk_create, each chunk in its own
+    transaction. Grants are made with Wallet.transfer_batch, so statistics
+    are updated once per chunk. Passwords are hashed by a process pool.
+    Writes the username, token and wallet address of every provisioned
+    account as CSV. Existing or invalid usernames are skipped.
+    """
+
+    help = "Provision users, tokens and granted wallets from a CSV/NDJSON stream."
+
+    grant_amount = Decimal("1.00000000")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path", help="CSV (with header) or NDJSON file. Use - for stdin."
+        )
+        parser.add_argument(
+            "--format",
+            choices=["csv", "ndjson"],
+            help="Format of the stream. Guessed from the file extension by "
+            "default, CSV for stdin.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Accounts inserted per transaction. Defaults to 500.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Processes hashing passwords. Defaults to the number of CPUs, "
+            "1 hashes them in this process.",
+        )
+
+    def handle(self, *args, **options):
+        fmt = options["format"]
+        if fmt is None:
+            fmt = "ndjson" if options["path"].endswith((".ndjson", ".jsonl")) else "csv"
+        stream = sys.stdin if options["path"] == "-" else open(options["path"])
+
+        pool = None
+        if options["workers"] > 1:
+            pool = ProcessPoolExecutor(options["workers"], initializer=django.setup)
+        writer = csv.writer(self.stdout)
+        writer.writerow(["username", "token", "address"])
+        provisioned = skipped = 0
+        try:
+            records = self.read_records(stream, fmt)
+            while True:
+                chunk = list(islice(records, options["chunk_size"]))
+                if not chunk:
+                    break
+                accounts, invalid = self.validate_chunk(chunk)
+                for username, error in invalid:
+                    self.stderr.write(f"Skipped {username}: {error}")
+                passwords = [account["password"] for account in accounts]
+                if pool is not None:
+                    hashes = pool.map(make_password, passwords, chunksize=64)
+                else:
+                    hashes = map(make_password, passwords)
+                for account, password in zip(accounts, hashes):
+                    account["password"] = password
+                for row in self.provision_chunk(accounts):
+                    writer.writerow(row)
+                provisioned += len(accounts)
+                skipped += len(invalid)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stderr.write(
+            self.style.SUCCESS(
+                f"Provisioned {provisioned} account(s), skipped {skipped}."
+            )
+        )
+
+    def read_records(self, stream, fmt):
+        if fmt == "csv":
+            yield from csv.DictReader(stream)
+            return
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise CommandError(f"Invalid JSON in line {number}.")
+
+    def validate_chunk(self, chunk):
+        """
+        Returns the valid accounts of the chunk and the (username, error)
+        of the invalid ones. Existing usernames are checked in one query.
+        """
+        username_field = User._meta.get_field("username")
+        alias_field = Wallet._meta.get_field("alias")
+        accounts, invalid, usernames = [], [], set()
+        for record in chunk:
+            username = (record.get("username") or "").strip()
+            account = {
+                "username": username,
+                "password": record.get("password") or "",
+                "alias": (record.get("alias") or "").strip(),
+            }
+            try:
+                username_field.clean(username, None)
+                alias_field.clean(account["alias"], None)
+            except ValidationError as exc:
+                invalid.append((username, " ".join(exc.messages)))
+                continue
+            if not account["password"]:
+                invalid.append((username, "A password is required."))
+            elif username in usernames:
+                invalid.append((username, "Duplicated username."))
+            else:
+                usernames.add(username)
+                accounts.append(account)
+
+        existing = set(
+            User.objects.filter(username__in=usernames).values_list(
+                "username", flat=True
+            )
+        )
+        for username in sorted(existing):
+            invalid.append((username, "A user with that username already exists."))
+        accounts = [a for a in accounts if a["username"] not in existing]
+        return accounts, invalid
+
+    def provision_chunk(self, accounts):
+        """
+        Inserts users, tokens and wallets of the accounts, and grants the
+        wallets. Returns the (username, token, address) of each account.
+        """
+        if not accounts:
+            return []
+        now = timezone.now()
+        with transaction.atomic():
+            User.objects.bulk_create(
+                User(
+                    username=account["username"],
+                    password=account["password"],
+                    date_joined=now,
+                )
+                for account in accounts
+            )
+            # Not all the databases return the primary keys of bulk inserts
+            users = User.objects.in_bulk(
+                [account["username"] for account in accounts], field_name="username"
+            )
+            tokens, wallets = [], []
+            for account in accounts:
+                user = users[account["username"]]
+                token = Token(user=user, created=now)
+                token.key = token.generate_key()
+                tokens.append(token)
+                address = uuid.uuid4()
+                wallets.append(
+                    Wallet(
+                        address=address,
+                        alias=account["alias"] or str(address),
+                        user=user,
+                        last_updated=now,
+                    )
+                )
+            Token.objects.bulk_create(tokens)
+            Wallet.objects.bulk_create(wallets)
+
+            platform_wallet = get_platform_wallet()
+            grants = [
+                {
+                    "wallet_from": platform_wallet,
+                    "wallet_to": wallet,
+                    "transaction_type": Transaction.PLATFORM,
+                    "amount": self.grant_amount,
+                    "extra": "Platform grants 1 BTC after wallet creation.",
+                }
+                for wallet in wallets
+            ]
+            results = Wallet.transfer_batch(grants, atomic=True)
+            errors = [result for result in results if isinstance(result, str)]
+            if errors:
+                # Rolls back the whole chunk
+                raise CommandError(errors[0])
+        return [
+            (account["username"], token.key, str(wallet.address))
+            for account, token, wallet in zip(accounts, tokens, wallets)
+        ]
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    """
+    Deletes the idempotency keys older than IDEMPOTENCY_KEY_TTL seconds,
+    so the table stays bounded. Meant to be run periodically.
+    """
+
+    help = "Delete expired idempotency keys."
+
+    def handle(self, *args, **options):
+        deleted, _ = IdempotencyKey.expired().delete()
+        self.stdout.write(
+            self.style.SUCCESS(f"Deleted {deleted} expired idempotency key(s).")
+        )
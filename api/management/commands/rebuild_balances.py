@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from api.models import Wallet, ArchivedTransaction, PlatformBalance
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds (or just verifies) the stored wallet balances using the
+    transactions ledger (archive included, if in use) as the source of truth.
+    """
+
+    help = "Rebuild or verify stored wallet balances from the transactions ledger."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Only report wallets whose stored balance differs from the ledger.",
+        )
+        parser.add_argument(
+            "--wallet",
+            action="append",
+            dest="addresses",
+            default=[],
+            help="Limit the command to the given wallet address. May be repeated.",
+        )
+
+    def handle(self, *args, **options):
+        wallets = Wallet.objects.order_by("pk")
+        if options["addresses"]:
+            wallets = wallets.filter(address__in=options["addresses"])
+        if options["verify"]:
+            self.verify(wallets)
+        else:
+            self.rebuild(wallets)
+
+    def verify(self, wallets):
+        """
+        Compares stored balances against the ledger using two grouped
+        aggregates. No rows are locked, so wallets with in-flight
+        transfers may be reported as mismatched.
+        """
+        debits = self.ledger_totals("wallet_to")
+        credits = self.ledger_totals("wallet_from")
+        mismatches = 0
+        for wallet in wallets.only("address", "balance_btc"):
+            address = wallet.address
+            stored = wallet.balance_btc + wallet.accrued_balance_btc()
+            ledger = debits.get(address, 0) - credits.get(address, 0)
+            if ledger != stored:
+                mismatches += 1
+                self.stdout.write(
+                    f"Wallet {address}: stored {stored} BTC, ledger {ledger} BTC"
+                )
+        if mismatches:
+            raise CommandError(f"{mismatches} wallet balance(s) differ from ledger.")
+        self.stdout.write(self.style.SUCCESS("All wallet balances match the ledger."))
+
+    def rebuild(self, wallets):
+        """
+        Recomputes each wallet balance while holding its row lock, the
+        same lock Wallet.transfer uses, so concurrent transfers are not lost.
+        The profits and grants accrued by the platform wallet are folded
+        into its stored balance.
+        """
+        updated = 0
+        for pk in wallets.values_list("pk", flat=True).iterator():
+            with transaction.atomic():
+                wallet = Wallet.objects.select_for_update().get(pk=pk)
+                if wallet.is_platform():
+                    PlatformBalance.fold()
+                ledger = wallet.ledger_balance_btc()
+                if ledger != wallet.balance_btc:
+                    wallet.balance_btc = ledger
+                    wallet.save(update_fields=["balance_btc"])
+                    updated += 1
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {updated} wallet balance(s)."))
+
+    def ledger_totals(self, field):
+        totals = {}
+        for model in ArchivedTransaction.ledgers():
+            rows = (
+                model.objects.filter(**{f"{field}__isnull": False})
+                .values_list(field)
+                .annotate(total=Sum("amount"))
+                .order_by()
+            )
+            for address, total in rows:
+                totals[address] = totals.get(address, 0) + total
+        return totals
@@ -0,0 +1,68 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from api.models import Statistics, StatisticsRollup, hour_start
+
+
+class Command(BaseCommand):
+    """
+    Writes the statistics prefix sums (StatisticsRollup) of every closed
+    hour since the last run. Meant to be run periodically.
+    """
+
+    help = "Roll up closed hours of statistics into prefix sums."
+
+    batch_size = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--settle",
+            type=int,
+            default=60,
+            help="Only roll up hours closed more than this many seconds ago, "
+            "so transactions still in flight are not missed. Defaults to 60.",
+        )
+
+    def handle(self, *args, **options):
+        until = timezone.now() - timedelta(seconds=options["settle"])
+        until = until.replace(minute=0, second=0, microsecond=0)
+
+        with transaction.atomic():
+            rollups = []
+            last = StatisticsRollup.objects.order_by("-hour").first()
+            if last is not None:
+                hour = last.hour
+                transactions, profit = last.transactions, last.profit
+            else:
+                first = Statistics.objects.aggregate(date=Min("date"))["date"]
+                if first is None:
+                    self.stdout.write("No statistics to roll up.")
+                    return
+                first_hour = Statistics.objects.filter(date=first).aggregate(
+                    hour=Min("hour")
+                )["hour"]
+                hour = hour_start(first, first_hour)
+                transactions, profit = 0, Decimal("0")
+                rollups.append(StatisticsRollup(hour=hour))
+
+            hourly = Statistics.hourly_totals(hour, until)
+            while hour < until:
+                hour_transactions, hour_profit = hourly.get(hour, (0, 0))
+                transactions += hour_transactions
+                profit += hour_profit
+                hour += timedelta(hours=1)
+                rollups.append(
+                    StatisticsRollup(
+                        hour=hour, transactions=transactions, profit=profit
+                    )
+                )
+            StatisticsRollup.objects.bulk_create(rollups, batch_size=self.batch_size)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Rolled up {len(rollups)} hour(s) of statistics.")
+        )
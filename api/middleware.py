@@ -0,0 +1,129 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from api.utils.instrumentation import collect, current_metrics
+from api.utils.metrics import REQUEST_DURATION
+from api.utils.routers import make_sticky, request_routing
+
+logger = logging.getLogger("api.timing")
+
+
+class RequestTimingMiddleware:
+    """
+    Counts and times the SQL queries, cache calls and outbound HTTP calls
+    of each request, and the rendering of its response. The results are
+    added to the response as a Server-Timing header, and logged as a JSON
+    line tagged with the URL name. Only enabled when REQUEST_TIMING is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_TIMING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with collect() as metrics:
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+
+        response["Server-Timing"] = self.server_timing(metrics, total)
+        match = request.resolver_match
+        logger.info(
+            json.dumps(
+                {
+                    "url_name": match.url_name if match else None,
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "total_ms": round(total * 1000, 2),
+                    "render_ms": self.ms(metrics.render),
+                    **{
+                        category: {
+                            "count": metrics.counts[category],
+                            "ms": self.ms(metrics.durations[category]),
+                        }
+                        for category in metrics.CATEGORIES
+                    },
+                }
+            )
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook
+        metrics = current_metrics()
+        start = time.perf_counter()
+
+        def rendered(response):
+            metrics.render = time.perf_counter() - start
+
+        if metrics is not None:
+            response.add_post_render_callback(rendered)
+        return response
+
+    @staticmethod
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 2)
+
+    def server_timing(self, metrics, total):
+        """
+        Returns the Server-Timing header value of the metrics.
+        """
+        entries = [
+            f"{category};dur={self.ms(metrics.durations[category])};"
+            f'desc="{metrics.counts[category]} call(s)"'
+            for category in metrics.CATEGORIES
+        ]
+        if metrics.render is not None:
+            entries.append(f"render;dur={self.ms(metrics.render)}")
+        entries.append(f"total;dur={self.ms(total)}")
+        return ", ".join(entries)
+
+
+class MetricsMiddleware:
+    """
+    Observes the latency of each request in the request duration histogram,
+    labelled with the URL name of the view.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        REQUEST_DURATION.observe(
+            time.perf_counter() - start,
+            view=match.url_name if match and match.url_name else "unmatched",
+            method=request.method,
+        )
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Scopes the database routing to each request (see ReplicaRouter), and
+    makes users sticky to the primary after a request that wrote to the
+    database. Only enabled when DATABASE_REPLICAS is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_routing() as routing:
+            response = self.get_response(request)
+        # Set by DRF once the request is authenticated (anonymous users and
+        # the admin token have no pk)
+        user = getattr(request, "user", None)
+        if routing.wrote and getattr(user, "pk", None) is not None:
+            make_sticky(response, user)
+        return response
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.15 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+def compute_balances(apps, schema_editor):
+    """
+    Fill the stored balance of existing wallets from the transactions ledger.
+    """
+    Wallet = apps.get_model("api", "Wallet")
+    Transaction = apps.get_model("api", "Transaction")
+    debits = dict(
+        Transaction.objects.filter(wallet_to__isnull=False)
+        .values_list("wallet_to")
+        .annotate(total=models.Sum("amount"))
+        .order_by()
+    )
+    credits = dict(
+        Transaction.objects.filter(wallet_from__isnull=False)
+        .values_list("wallet_from")
+        .annotate(total=models.Sum("amount"))
+        .order_by()
+    )
+    for wallet in Wallet.objects.all():
+        balance = debits.get(wallet.address, 0) - credits.get(wallet.address, 0)
+        if balance:
+            Wallet.objects.filter(pk=wallet.pk).update(balance_btc=balance)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_auto_20200901_0010'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='balance_btc',
+            field=models.DecimalField(decimal_places=8, default=0, max_digits=16),
+        ),
+        migrations.RunPython(compute_balances, migrations.RunPython.noop),
+    ]
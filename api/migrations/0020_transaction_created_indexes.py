@@ -0,0 +1,32 @@
+# Generated by Django 2.2.15 on 2026-10-17 02:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet_from', 'created_at'], name='api_tx_from_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet_to', 'created_at'], name='api_tx_to_created_idx'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='wallet_from',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='transactions_credits', to='api.Wallet', to_field='address'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='wallet_to',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='transactions_debits', to='api.Wallet', to_field='address'),
+        ),
+    ]
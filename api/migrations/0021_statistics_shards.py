@@ -0,0 +1,27 @@
+# Generated by Django 2.2.15 on 2026-10-17 02:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_transaction_created_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statistics',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='statistics',
+            name='date',
+            field=models.DateField(),
+        ),
+        migrations.AddConstraint(
+            model_name='statistics',
+            constraint=models.UniqueConstraint(fields=('date', 'shard'), name='unique_statistics_date_shard'),
+        ),
+    ]
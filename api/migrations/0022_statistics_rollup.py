@@ -0,0 +1,35 @@
+# Generated by Django 2.2.15 on 2026-10-17 02:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_statistics_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatisticsRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(unique=True)),
+                ('transactions', models.BigIntegerField(default=0)),
+                ('profit', models.DecimalField(decimal_places=8, default=0, max_digits=20)),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='statistics',
+            name='unique_statistics_date_shard',
+        ),
+        migrations.AddField(
+            model_name='statistics',
+            name='hour',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='statistics',
+            constraint=models.UniqueConstraint(fields=('date', 'hour', 'shard'), name='unique_statistics_hour_shard'),
+        ),
+    ]
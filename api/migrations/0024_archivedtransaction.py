@@ -0,0 +1,38 @@
+# Generated by Django 2.2.15 on 2026-10-17 02:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('transaction_type', models.CharField(choices=[('sent_external', 'sent_external'), ('sent_internal', 'sent_internal'), ('platform', 'platform'), ('platform_profit', 'platform_profit')], max_length=20)),
+                ('amount', models.DecimalField(decimal_places=8, max_digits=16)),
+                ('details', models.CharField(blank=True, max_length=250)),
+                ('extra', models.CharField(blank=True, max_length=250)),
+                ('created_at', models.DateTimeField()),
+                ('wallet_from', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='archived_credits', to='api.Wallet', to_field='address')),
+                ('wallet_to', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='archived_debits', to='api.Wallet', to_field='address')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['wallet_from', 'created_at'], name='api_atx_from_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['wallet_to', 'created_at'], name='api_atx_to_created_idx'),
+        ),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 2.2.15 on 2026-10-17 03:10
+
+from django.db import migrations
+
+# Indexes and wallet foreign keys of the transactions table
+CONSTRAINTS = """
+CREATE INDEX api_tx_from_created_idx ON api_transaction (wallet_from_id, created_at);
+CREATE INDEX api_tx_to_created_idx ON api_transaction (wallet_to_id, created_at);
+ALTER TABLE api_transaction ADD CONSTRAINT api_transaction_wallet_from_id_fk
+    FOREIGN KEY (wallet_from_id) REFERENCES api_wallet (address)
+    DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE api_transaction ADD CONSTRAINT api_transaction_wallet_to_id_fk
+    FOREIGN KEY (wallet_to_id) REFERENCES api_wallet (address)
+    DEFERRABLE INITIALLY DEFERRED;
+"""
+
+# Replaces the transactions table by one partitioned by month on created_at,
+# with a partition for each month since the first transaction up to 3 months
+# ahead (see the partition_transactions command), and a default partition.
+# The primary key of a partitioned table must include the partition key.
+PARTITION = (
+    """
+ALTER TABLE api_transaction RENAME TO api_transaction_legacy;
+ALTER TABLE api_transaction_legacy RENAME CONSTRAINT api_transaction_pkey
+    TO api_transaction_legacy_pkey;
+ALTER INDEX api_tx_from_created_idx RENAME TO api_tx_from_created_legacy_idx;
+ALTER INDEX api_tx_to_created_idx RENAME TO api_tx_to_created_legacy_idx;
+CREATE TABLE api_transaction (
+    LIKE api_transaction_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+) PARTITION BY RANGE (created_at);
+DO $$
+DECLARE
+    month timestamp := date_trunc(
+        'month',
+        COALESCE((SELECT min(created_at) FROM api_transaction_legacy), now())
+            AT TIME ZONE 'UTC'
+    );
+    stop timestamp := date_trunc('month', now() AT TIME ZONE 'UTC')
+        + interval '4 months';
+BEGIN
+    WHILE month < stop LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF api_transaction FOR VALUES FROM (%L) TO (%L)',
+            'api_transaction_p' || to_char(month, 'YYYYMM'),
+            month AT TIME ZONE 'UTC',
+            (month + interval '1 month') AT TIME ZONE 'UTC'
+        );
+        month := month + interval '1 month';
+    END LOOP;
+END $$;
+CREATE TABLE api_transaction_default PARTITION OF api_transaction DEFAULT;
+INSERT INTO api_transaction SELECT * FROM api_transaction_legacy;
+ALTER TABLE api_transaction ADD CONSTRAINT api_transaction_pkey
+    PRIMARY KEY (id, created_at);
+"""
+    + CONSTRAINTS
+    + """
+ALTER SEQUENCE api_transaction_id_seq OWNED BY api_transaction.id;
+DROP TABLE api_transaction_legacy;
+"""
+)
+
+UNPARTITION = (
+    """
+ALTER TABLE api_transaction RENAME TO api_transaction_partitioned;
+ALTER TABLE api_transaction_partitioned RENAME CONSTRAINT api_transaction_pkey
+    TO api_transaction_partitioned_pkey;
+ALTER INDEX api_tx_from_created_idx RENAME TO api_tx_from_created_partitioned_idx;
+ALTER INDEX api_tx_to_created_idx RENAME TO api_tx_to_created_partitioned_idx;
+CREATE TABLE api_transaction (
+    LIKE api_transaction_partitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+);
+INSERT INTO api_transaction SELECT * FROM api_transaction_partitioned;
+ALTER TABLE api_transaction ADD CONSTRAINT api_transaction_pkey PRIMARY KEY (id);
+"""
+    + CONSTRAINTS
+    + """
+ALTER SEQUENCE api_transaction_id_seq OWNED BY api_transaction.id;
+DROP TABLE api_transaction_partitioned;
+"""
+)
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(PARTITION)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(UNPARTITION)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_archivedtransaction'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.15 on 2026-10-17 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_partition_transactions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlatformBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField(unique=True)),
+                ('amount', models.DecimalField(decimal_places=8, default=0, max_digits=16)),
+            ],
+        ),
+    ]
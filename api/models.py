@@ -1,14 +1,29 @@
+import collections
+import random
+import time
 import uuid
+from datetime import datetime, timedelta
 from decimal import Decimal, ROUND_DOWN
 
 from django.utils import timezone
 from django.conf import settings
-from django.db import models, transaction
+from django.db import models, transaction, IntegrityError, OperationalError
 from django.contrib.auth.models import User
 
+from .utils.metrics import STATISTICS_WRITE, TRANSFERS
+from .utils.partitions import month_start
 from .utils.rates import Rates
 
 
+class InsufficientFundsError(Exception):
+    """
+    Raised when a wallet has not enough funds for a transfer.
+    """
+
+    def __init__(self, address):
+        super().__init__(f"Insufficient funds in wallet with address {address}")
+
+
 def get_platform_user():
     """
     Returns the user who owns the wallet of the platform. For
@@ -31,31 +46,74 @@ def get_platform_wallet():
     Returns the wallet used by the platform to transfer bitcoins
     to other wallets of the platform, or to receive bitcoins from
     profits.
+    The wallet is created (and funded) only once, and memoized for the
+    whole process after the transaction that read it is committed. Only
+    its address and user should be relied on, the memoized balance is
+    not kept up to date.
     """
+    platform_wallet = _platform_wallet_cache.get("wallet")
+    if platform_wallet is not None:
+        return platform_wallet
+
     platform_user = get_platform_user()
     last_updated = timezone.now()
+    # A UUID, like the address of wallets read from the database
+    address = uuid.UUID(settings.PLATFORM_WALLET_ADDRESS)
     platform_wallet, created = Wallet.objects.get_or_create(
-        address=settings.PLATFORM_WALLET_ADDRESS,
+        address=address,
         user=platform_user,
         defaults={
-            "address": settings.PLATFORM_WALLET_ADDRESS,
+            "address": address,
             "user": platform_user,
             "alias": "Platform Wallet",
             "last_updated": last_updated,
         },
     )
-    # Add some BTCs
-    transaction = Transaction(
-        wallet_to=platform_wallet,
-        transaction_type=Transaction.PLATFORM,
-        amount=1000,
-        details="Initial funds",
-        created_at=last_updated,
+    if created:
+        # Add some BTCs
+        initial_funds = Transaction(
+            wallet_to=platform_wallet,
+            transaction_type=Transaction.PLATFORM,
+            amount=Decimal(settings.PLATFORM_INITIAL_FUNDS),
+            details="Initial funds",
+            created_at=last_updated,
+        )
+        initial_funds.save()
+        Wallet.objects.filter(address=platform_wallet.address).update(
+            balance_btc=models.F("balance_btc") + initial_funds.amount
+        )
+    # Don't memoize a wallet created by a transaction that may be rolled back
+    transaction.on_commit(
+        lambda: _platform_wallet_cache.__setitem__("wallet", platform_wallet)
     )
-    transaction.save()
     return platform_wallet
 
 
+def is_grant(wallet_from, transaction_type):
+    """
+    Whether a transfer is a grant of the platform wallet. Grants mint
+    bitcoins: their funds are not checked, so the balance of the platform
+    wallet goes negative once grants exceed its funds and profits.
+    """
+    return transaction_type == Transaction.PLATFORM and uuid.UUID(
+        str(wallet_from.address)
+    ) == uuid.UUID(settings.PLATFORM_WALLET_ADDRESS)
+
+
+def clear_platform_wallet_cache():
+    """
+    Forgets the memoized platform wallet.
+    """
+    _platform_wallet_cache.clear()
+
+
+# Process wide memo of the platform wallet. See get_platform_wallet.
+_platform_wallet_cache = {}
+
+# Default of Wallet.balance_in, None means no rates are available
+_CACHED_RATES = object()
+
+
 class Wallet(models.Model):
     """
     Wallet model simulates a BTC Wallet. Each wallet has an address and
@@ -71,6 +129,13 @@ class Wallet(models.Model):
     last_updated = (
         models.DateTimeField()
     )  # Just a flag to 'associate' with the last transfer transaction
+    # Running balance kept up to date by Wallet.transfer. The transactions
+    # ledger is still the source of truth (see ledger_balance_btc).
+    balance_btc = models.DecimalField(max_digits=16, decimal_places=8, default=0)
+
+    # Transfer modes, see transfer
+    PESSIMISTIC = "pessimistic"
+    OPTIMISTIC = "optimistic"
 
     class Meta:
         constraints = [
@@ -85,75 +150,437 @@ class Wallet(models.Model):
         """
         Returns current balance in BTC and USD.
         """
-        total_btc = self.balance_btc
-        total_usd = Rates.bitcoins_to_usd(total_btc)
-        return {"btc": str(total_btc), "usd": str(total_usd)}
+        return self.balance_in(Rates.DEFAULT_CURRENCIES)
 
-    @property
-    def balance_btc(self):
+    def balance_in(self, currencies, rates=_CACHED_RATES):
+        """
+        Returns current balance in BTC and in each of the given currencies.
+        Amounts are converted using the given rate table (None if rates are
+        not available), or the cached one.
+        """
+        if rates is _CACHED_RATES:
+            rates = Rates.get_rates()
+        total_btc = self.balance_btc + self.accrued_balance_btc()
+        balance = {"btc": str(total_btc)}
+        for currency in currencies:
+            balance[currency] = str(Rates.convert(rates, currency, total_btc))
+        return balance
+
+    def is_platform(self):
+        return uuid.UUID(str(self.address)) == uuid.UUID(
+            settings.PLATFORM_WALLET_ADDRESS
+        )
+
+    def accrued_balance_btc(self):
         """
-        Calculate and returns total BTCs based on transactions data.
+        Returns the changes of the balance not included in the stored one:
+        the profits and grants of the platform wallet, which are accrued on
+        PlatformBalance shards. Zero for other wallets.
         """
-        total_debits = self.transactions_debits.filter().aggregate(
-            total=models.Sum("amount")
-        )["total"]
+        if not self.is_platform():
+            return Decimal("0")
+        return PlatformBalance.total()
 
-        total_credits = self.transactions_credits.filter().aggregate(
-            total=models.Sum("amount")
-        )["total"]
-        total = (total_debits or 0) - (total_credits or 0)
+    def ledger_balance_btc(self):
+        """
+        Calculate and returns total BTCs based on transactions data,
+        archived ones included if the archive is in use. Used to rebuild or
+        verify the stored balance.
+        """
+        total = 0
+        for model in ArchivedTransaction.ledgers():
+            transactions = model.objects.all()
+            total_debits = transactions.filter(wallet_to=self).aggregate(
+                total=models.Sum("amount")
+            )["total"]
+            total_credits = transactions.filter(wallet_from=self).aggregate(
+                total=models.Sum("amount")
+            )["total"]
+            total += (total_debits or 0) - (total_credits or 0)
         return total
 
+    def balance_btc_at(self, at):
+        """
+        Returns total BTCs at the given point in time. Starts from the
+        nearest balance checkpoint and only sums the transactions created
+        after it, so the scanned rows are bounded by the checkpoint interval.
+        Archived transactions are only read when the archive is in use.
+        """
+        checkpoint = (
+            self.checkpoints.filter(created_at__lte=at).order_by("-created_at").first()
+        )
+        total = Decimal("0")
+        if checkpoint is not None:
+            total = checkpoint.balance_btc
+
+        for model in ArchivedTransaction.ledgers():
+            transactions = model.objects.filter(created_at__lte=at)
+            if checkpoint is not None:
+                transactions = transactions.filter(created_at__gt=checkpoint.created_at)
+            total_debits = transactions.filter(wallet_to=self).aggregate(
+                total=models.Sum("amount")
+            )["total"]
+            total_credits = transactions.filter(wallet_from=self).aggregate(
+                total=models.Sum("amount")
+            )["total"]
+            total += Decimal(total_debits or 0) - Decimal(total_credits or 0)
+        return total.quantize(Decimal(".00000001"))
+
     @classmethod
-    def transfer(cls, wallet_from, wallet_to, transaction_type, amount, extra):
+    def transfer(
+        cls, wallet_from, wallet_to, transaction_type, amount, extra, mode=None
+    ):
         """
         Transfers bitcoins from one wallet to another. Creates a transaction
-        to register the 'movements'
+        to register the 'movements'.
+        Balances are updated in "pessimistic" or "optimistic" mode
+        (WALLET_TRANSFER_MODE setting by default). Transfers aborted by the
+        database (e.g. deadlocks) are retried up to WALLET_TRANSFER_RETRIES
+        times.
         """
-        with transaction.atomic():
-            # Try to prevents race condition acquiring a lock on the 'from' wallet.
-            # This will lock the wallet row in the database, therefore, no
-            # one wil can init another transfer with the same wallet, until the
-            # transaction is completed (either committed or rolled-back).
-            wallet = cls.objects.select_for_update().get(address=wallet_from.address)
-            balance = wallet.balance_btc
+        if mode is None:
+            mode = settings.WALLET_TRANSFER_MODE
+        if mode == cls.OPTIMISTIC:
+            update_balances = cls.update_balances_optimistic
+        elif mode == cls.PESSIMISTIC:
+            update_balances = cls.update_balances_pessimistic
+        else:
+            raise ValueError(f"Unknown transfer mode {mode}")
+
+        retries = settings.WALLET_TRANSFER_RETRIES
+        outcome = "error"
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    with transaction.atomic():
+                        # The wallet and transactions will have the same updated flag.
+                        last_updated = timezone.now()
+                        profit_amount = Transaction.calculate_profit(
+                            amount, transaction_type
+                        )
+                        platform_wallet = update_balances(
+                            wallet_from,
+                            wallet_to,
+                            transaction_type,
+                            amount,
+                            profit_amount,
+                            last_updated,
+                        )
+                        ledger = cls.create_ledger_rows(
+                            wallet_from,
+                            wallet_to,
+                            platform_wallet,
+                            transaction_type,
+                            amount,
+                            profit_amount,
+                            extra,
+                            last_updated,
+                        )
+                    outcome = "success"
+                    return ledger
+                except OperationalError:
+                    if attempt == retries:
+                        raise
+                    # Back off a little, so the conflicting transfer can finish
+                    time.sleep(random.uniform(0, 0.01 * 2**attempt))
+        except InsufficientFundsError:
+            outcome = "insufficient_funds"
+            raise
+        except OperationalError:
+            # Lock waits aborted by the database, once retries are exhausted
+            outcome = "lock_timeout"
+            raise
+        finally:
+            TRANSFERS.inc(transaction_type=transaction_type, outcome=outcome)
+
+    @classmethod
+    def update_balances_pessimistic(
+        cls, wallet_from, wallet_to, transaction_type, amount, profit_amount, at
+    ):
+        """
+        Locks the 'from' and 'to' wallets, checks the funds of the 'from'
+        wallet and updates the balances. Both rows are locked up front in a
+        single query sorted by address, so opposite transfers can't
+        deadlock. Grants and profits of the platform wallet are accrued on a
+        PlatformBalance shard, the platform wallet row is not locked.
+        Returns the platform wallet if it received a profit.
+        """
+        # Balances are updated before the ledger rows are inserted, so
+        # anyone locking a wallet row or the platform balance shards (e.g.
+        # rebuild_balances) sees both changes or none of them.
+        grant = is_grant(wallet_from, transaction_type)
+        addresses = {wallet_to.address}
+        if not grant:
+            addresses.add(wallet_from.address)
+        # Lock the wallet rows, no one else can transfer from or to them
+        # until the transaction is completed (either committed or
+        # rolled-back).
+        wallets = {
+            wallet.address: wallet
+            for wallet in cls.objects.select_for_update()
+            .filter(address__in=addresses)
+            .order_by("address")
+        }
+        if not grant:
+            wallet = wallets[wallet_from.address]
+            balance = wallet.balance_btc + wallet.accrued_balance_btc()
             profit = Decimal("0.0")
             if transaction_type == Transaction.SENT_EXTERNAL:
                 profit = Decimal(settings.PLATFORM_PROFIT)
             if balance - amount - (amount * profit) < 0:
-                raise Exception(
-                    f"Insufficient funds in wallet with address {wallet.address}"
+                raise InsufficientFundsError(wallet.address)
+            cls.objects.filter(address=wallet_from.address).update(
+                last_updated=at,
+                balance_btc=models.F("balance_btc") - (amount + profit_amount),
+            )
+        cls.objects.filter(address=wallet_to.address).update(
+            balance_btc=models.F("balance_btc") + amount
+        )
+        # Shards are locked after the wallet rows, as in the other modes
+        if grant:
+            PlatformBalance.accrue(-amount)
+        if transaction_type == Transaction.SENT_EXTERNAL:
+            PlatformBalance.accrue(profit_amount)
+            return get_platform_wallet()
+        return None
+
+    @classmethod
+    def update_balances_optimistic(
+        cls, wallet_from, wallet_to, transaction_type, amount, profit_amount, at
+    ):
+        """
+        Updates the balances without locking the 'from' wallet first. Funds
+        are checked by the UPDATE itself (WHERE balance_btc >= amount), which
+        saves the SELECT ... FOR UPDATE round trip. The updated rows are still
+        locked until the transaction commits, ledger rows and statistics
+        included. Rows are updated sorted by address, so concurrent transfers
+        can't deadlock. Grants and profits of the platform wallet are
+        accrued on a PlatformBalance shard, as in the pessimistic mode.
+        Returns the platform wallet if it received a profit.
+        """
+        profit = Decimal("0.0")
+        if transaction_type == Transaction.SENT_EXTERNAL:
+            profit = Decimal(settings.PLATFORM_PROFIT)
+        grant = is_grant(wallet_from, transaction_type)
+        deltas = {}
+        if not grant:
+            deltas[wallet_from.address] = -(amount + profit_amount)
+        deltas[wallet_to.address] = deltas.get(wallet_to.address, 0) + amount
+
+        for address in sorted(deltas):
+            wallets = cls.objects.filter(address=address)
+            updates = {"balance_btc": models.F("balance_btc") + deltas[address]}
+            if address == wallet_from.address:
+                required = amount + (amount * profit)
+                wallets = wallets.filter(
+                    balance_btc__gte=required - wallet_from.accrued_balance_btc()
                 )
-            # The wallet and transactions will have the same updated flag.
-            last_updated = timezone.now()
+                updates["last_updated"] = at
+            if not wallets.update(**updates) and address == wallet_from.address:
+                # Rolls back the balances already updated
+                raise InsufficientFundsError(wallet_from.address)
+        if grant:
+            PlatformBalance.accrue(-amount)
+        if transaction_type == Transaction.SENT_EXTERNAL:
+            PlatformBalance.accrue(profit_amount)
+            return get_platform_wallet()
+        return None
 
-            wallet.last_updated = last_updated
-            wallet.save(
-                update_fields=["last_updated",]
+    @classmethod
+    def create_ledger_rows(
+        cls,
+        wallet_from,
+        wallet_to,
+        platform_wallet,
+        transaction_type,
+        amount,
+        profit_amount,
+        extra,
+        at,
+    ):
+        """
+        Inserts the transaction of a transfer, and the platform profit one
+        if any. Statistics are recorded once for both, so a transfer
+        updates a single statistics shard. Returns the transfer transaction.
+        """
+        transaction_obj = Transaction(
+            wallet_from=wallet_from,
+            wallet_to=wallet_to,
+            transaction_type=transaction_type,
+            amount=amount,
+            extra=extra,
+            created_at=at,
+            details=f"Transfers {amount} bitcoins from {str(wallet_from.address)} "
+            f"wallet to {str(wallet_to.address)} wallet.",
+        )
+        ledger = [transaction_obj]
+        # If transferred to a wallet of another user, we need to
+        # transfer platform profit.
+        if transaction_type == Transaction.SENT_EXTERNAL:
+            ledger.append(
+                Transaction(
+                    wallet_from=wallet_from,
+                    wallet_to=platform_wallet,
+                    transaction_type=Transaction.PLATFORM_PROFIT,
+                    amount=profit_amount,
+                    created_at=at,
+                    details="Platform profits. 1,5% of the transferred amount",
+                )
             )
+        for row in ledger:
+            row.record_statistics = False
+            row.save(force_insert=True)
+        Statistics.record(transactions=len(ledger), profit=profit_amount)
+        return transaction_obj
 
-            transaction_obj = Transaction.objects.create(
-                wallet_from=wallet_from,
-                wallet_to=wallet_to,
-                transaction_type=transaction_type,
-                amount=amount,
-                extra=extra,
-                created_at=last_updated,
-                details=f"Transfers {amount} bitcoins from {str(wallet_from.address)} "
-                f"wallet to {str(wallet_to.address)} wallet.",
+    @classmethod
+    def transfer_batch(cls, transfers, atomic=True):
+        """
+        Performs a list of transfers (dicts with the arguments of transfer)
+        at once. All the involved wallets are locked in a single query,
+        sorted by address, so concurrent batches can't deadlock. Grants and
+        profits of the platform wallet are accrued on a PlatformBalance
+        shard, so the platform wallet is not locked for them. Funds are
+        checked in order, so each transfer sees the balance left by the
+        previous ones. Ledger rows are inserted with bulk_create.
+        Returns, for each transfer, its transaction or the error message if
+        it failed. If atomic is True and any transfer fails nothing is
+        transferred, and None is returned for the other transfers.
+        Each transfer is counted in the transfers metric, transfers not
+        made because another one failed as "rolled_back".
+        """
+        outcomes = ["error"] * len(transfers)
+        try:
+            results = cls._transfer_batch(transfers, atomic)
+            outcomes = [cls.batch_outcome(result) for result in results]
+            return results
+        except OperationalError:
+            # Lock waits aborted by the database
+            outcomes = ["lock_timeout"] * len(transfers)
+            raise
+        finally:
+            counts = collections.Counter(
+                (transfer["transaction_type"], outcome)
+                for transfer, outcome in zip(transfers, outcomes)
             )
-            # If transferred to a wallet of another user, we need to
-            # transfer platform profit.
-            if transaction_type == Transaction.SENT_EXTERNAL:
-                Transaction.objects.create(
+            for (transaction_type, outcome), count in counts.items():
+                TRANSFERS.inc(count, transaction_type=transaction_type, outcome=outcome)
+
+    @staticmethod
+    def batch_outcome(result):
+        if isinstance(result, Transaction):
+            return "success"
+        if isinstance(result, str):
+            return "insufficient_funds"
+        return "rolled_back"
+
+    @classmethod
+    def _transfer_batch(cls, transfers, atomic):
+        results = []
+        with transaction.atomic():
+            platform_wallet = get_platform_wallet()
+            addresses = set()
+            for transfer in transfers:
+                if not is_grant(transfer["wallet_from"], transfer["transaction_type"]):
+                    addresses.add(transfer["wallet_from"].address)
+                addresses.add(transfer["wallet_to"].address)
+            wallets = {
+                wallet.address: wallet
+                for wallet in cls.objects.select_for_update()
+                .filter(address__in=addresses)
+                .order_by("address")
+            }
+            accrued = {
+                address: w.accrued_balance_btc() for address, w in wallets.items()
+            }
+            balances = {
+                address: w.balance_btc + accrued[address]
+                for address, w in wallets.items()
+            }
+            platform_accrual = Decimal("0")
+            last_updated = timezone.now()
+            updated = set()
+            ledger = []
+            for transfer in transfers:
+                transaction_type = transfer["transaction_type"]
+                grant = is_grant(transfer["wallet_from"], transaction_type)
+                wallet_from = (
+                    platform_wallet
+                    if grant
+                    else wallets[transfer["wallet_from"].address]
+                )
+                wallet_to = wallets[transfer["wallet_to"].address]
+                amount = transfer["amount"]
+                profit = Decimal("0.0")
+                if transaction_type == Transaction.SENT_EXTERNAL:
+                    profit = Decimal(settings.PLATFORM_PROFIT)
+                if (
+                    not grant
+                    and balances[wallet_from.address] - amount - (amount * profit) < 0
+                ):
+                    results.append(str(InsufficientFundsError(wallet_from.address)))
+                    continue
+                profit_amount = Transaction.calculate_profit(amount, transaction_type)
+                if grant:
+                    platform_accrual -= amount
+                else:
+                    balances[wallet_from.address] -= amount + profit_amount
+                    updated.add(wallet_from.address)
+                balances[wallet_to.address] += amount
+                updated.add(wallet_to.address)
+                transaction_obj = Transaction(
                     wallet_from=wallet_from,
-                    wallet_to=get_platform_wallet(),
-                    transaction_type=Transaction.PLATFORM_PROFIT,
-                    amount=Transaction.calculate_profit(amount, transaction_type),
+                    wallet_to=wallet_to,
+                    transaction_type=transaction_type,
+                    amount=amount,
+                    extra=transfer.get("extra", ""),
                     created_at=last_updated,
-                    details="Platform profits. 1,5% of the transferred amount",
+                    details=f"Transfers {amount} bitcoins from "
+                    f"{str(wallet_from.address)} wallet to "
+                    f"{str(wallet_to.address)} wallet.",
                 )
-        return transaction_obj
+                ledger.append(transaction_obj)
+                results.append(transaction_obj)
+                if transaction_type == Transaction.SENT_EXTERNAL:
+                    platform_accrual += profit_amount
+                    ledger.append(
+                        Transaction(
+                            wallet_from=wallet_from,
+                            wallet_to=platform_wallet,
+                            transaction_type=Transaction.PLATFORM_PROFIT,
+                            amount=profit_amount,
+                            created_at=last_updated,
+                            details="Platform profits. 1,5% of the transferred "
+                            "amount",
+                        )
+                    )
+
+            if atomic and any(isinstance(result, str) for result in results):
+                return [r if isinstance(r, str) else None for r in results]
+            if not ledger:
+                return results
+
+            # Wallets are locked, so balances can be written as absolute values
+            for address in updated:
+                wallets[address].balance_btc = balances[address] - accrued[address]
+                wallets[address].last_updated = last_updated
+            cls.objects.bulk_update(
+                [wallets[address] for address in updated],
+                ["balance_btc", "last_updated"],
+            )
+            if platform_accrual:
+                PlatformBalance.accrue(platform_accrual)
+            Transaction.objects.bulk_create(ledger)
+            # bulk_create doesn't send post_save, statistics are recorded here
+            Statistics.record(
+                transactions=len(ledger),
+                profit=sum(
+                    row.amount
+                    for row in ledger
+                    if row.transaction_type == Transaction.PLATFORM_PROFIT
+                ),
+            )
+        return results
 
 
 class Transaction(models.Model):
@@ -184,6 +611,7 @@ class Transaction(models.Model):
         related_name="transactions_credits",
         on_delete=models.PROTECT,
         null=True,
+        db_index=False,  # Covered by the (wallet, created_at) indexes
     )
     wallet_to = models.ForeignKey(
         Wallet,
@@ -191,6 +619,7 @@ class Transaction(models.Model):
         related_name="transactions_debits",
         on_delete=models.PROTECT,
         null=True,
+        db_index=False,  # Covered by the (wallet, created_at) indexes
     )
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
     amount = models.DecimalField(max_digits=16, decimal_places=8)
@@ -198,8 +627,20 @@ class Transaction(models.Model):
     extra = models.CharField(max_length=250, blank=True)
     created_at = models.DateTimeField()
 
+    # Whether saving the row records its statistics (see
+    # signals.update_statistics). Transfers record theirs once instead.
+    record_statistics = True
+
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(
+                fields=["wallet_from", "created_at"], name="api_tx_from_created_idx"
+            ),
+            models.Index(
+                fields=["wallet_to", "created_at"], name="api_tx_to_created_idx"
+            ),
+        ]
 
     def __str__(self):
         return (
@@ -221,14 +662,356 @@ class Transaction(models.Model):
         return profit.quantize(bitcoins, rounding=ROUND_DOWN).normalize()
 
 
+class ArchivedTransaction(models.Model):
+    """
+    Transactions of closed months moved out of the transactions table by
+    the archive_transactions command, once they are older than
+    TRANSACTION_ARCHIVE_AFTER_MONTHS. Rows keep their original id, so
+    history endpoints can list both tables with the same cursors. Rows
+    are never updated, and wallets are not enforced by the database.
+    """
+
+    id = models.IntegerField(primary_key=True)
+    wallet_from = models.ForeignKey(
+        Wallet,
+        to_field="address",
+        related_name="archived_credits",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        db_index=False,  # Covered by the (wallet, created_at) indexes
+    )
+    wallet_to = models.ForeignKey(
+        Wallet,
+        to_field="address",
+        related_name="archived_debits",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        db_index=False,  # Covered by the (wallet, created_at) indexes
+    )
+    transaction_type = models.CharField(
+        max_length=20, choices=Transaction.TRANSACTION_TYPES
+    )
+    amount = models.DecimalField(max_digits=16, decimal_places=8)
+    details = models.CharField(max_length=250, blank=True)
+    extra = models.CharField(max_length=250, blank=True)
+    created_at = models.DateTimeField()
+
+    # Columns copied from the transactions table, in order
+    COLUMNS = [
+        "id",
+        "wallet_from_id",
+        "wallet_to_id",
+        "transaction_type",
+        "amount",
+        "details",
+        "extra",
+        "created_at",
+    ]
+
+    class Meta:
+        ordering = ["-created_at"]
+        indexes = [
+            models.Index(
+                fields=["wallet_from", "created_at"], name="api_atx_from_created_idx"
+            ),
+            models.Index(
+                fields=["wallet_to", "created_at"], name="api_atx_to_created_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return (
+            f"Archived transaction type:{self.transaction_type}."
+            f"From address:{self.wallet_from}. To address: {self.wallet_to}"
+        )
+
+    @classmethod
+    def in_use(cls):
+        """
+        Whether transactions are archived, so everything reading the ledger
+        must also read the archive. archive_transactions refuses to run
+        unless TRANSACTION_ARCHIVE_AFTER_MONTHS is set.
+        """
+        return settings.TRANSACTION_ARCHIVE_AFTER_MONTHS is not None
+
+    @classmethod
+    def ledgers(cls):
+        """
+        Returns the models holding the ledger, oldest rows first: the
+        archive (if in use) and the transactions table.
+        """
+        if cls.in_use():
+            return [cls, Transaction]
+        return [Transaction]
+
+    @classmethod
+    def cutoff(cls, months=None, now=None):
+        """
+        Returns the start (UTC) of the oldest month kept in the transactions
+        table. Transactions created before it are archived.
+        """
+        if months is None:
+            months = settings.TRANSACTION_ARCHIVE_AFTER_MONTHS
+        return month_start(now or timezone.now(), -months)
+
+
+class BalanceCheckpoint(models.Model):
+    """
+    Balance of a wallet including all the transactions created up to
+    (and including) created_at. Checkpoints are written periodically by
+    the checkpoint_balances command and used to answer point-in-time
+    balance queries without summing the whole ledger.
+    """
+
+    wallet = models.ForeignKey(
+        Wallet,
+        to_field="address",
+        related_name="checkpoints",
+        on_delete=models.CASCADE,
+    )
+    created_at = models.DateTimeField()
+    balance_btc = models.DecimalField(max_digits=16, decimal_places=8)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["wallet", "created_at"], name="unique_wallet_checkpoint"
+            )
+        ]
+
+    def __str__(self):
+        return f"Checkpoint {self.wallet_id} at {self.created_at}: {self.balance_btc}"
+
+
 class Statistics(models.Model):
     """
     Provides a simple class to storage some useful statistics.
-    Total values are group by day. That means we could have 365
-    entries per year. But gives flexibility to query range of
-    dates.
+    Total values are group by hour (UTC). That gives flexibility to
+    query range of dates with hour, day or month granularity.
+    Each hour is split in STATISTICS_SHARDS rows (shards), so concurrent
+    transactions don't wait for each other to update the same row.
+    Totals of an hour are the sum of its shards.
     """
 
-    date = models.DateField(unique=True)
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField(default=0)
+    shard = models.PositiveSmallIntegerField(default=0)
     transactions = models.IntegerField(default=0)
     profit = models.DecimalField(max_digits=16, decimal_places=8, default=0.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "hour", "shard"], name="unique_statistics_hour_shard"
+            )
+        ]
+
+    @classmethod
+    def record(cls, transactions=1, profit=0):
+        """
+        Adds the given number of transactions and profit to the current
+        hour statistics. Uses an atomic increment on a random shard.
+        """
+        with STATISTICS_WRITE.time():
+            cls._record(transactions, profit)
+
+    @classmethod
+    def _record(cls, transactions, profit):
+        now = timezone.now()
+        shard = random.randrange(settings.STATISTICS_SHARDS)
+        increments = {
+            "transactions": models.F("transactions") + transactions,
+            "profit": models.F("profit") + profit,
+        }
+        shard_rows = cls.objects.filter(date=now.date(), hour=now.hour, shard=shard)
+        if shard_rows.update(**increments):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    date=now.date(),
+                    hour=now.hour,
+                    shard=shard,
+                    transactions=transactions,
+                    profit=profit,
+                )
+        except IntegrityError:
+            # Created by a concurrent transaction
+            shard_rows.update(**increments)
+
+    @classmethod
+    def hourly_totals(cls, since=None, until=None):
+        """
+        Returns a dict with the (transactions, profit) totals of each hour
+        in the [since, until) range. Keys are the hour start datetimes.
+        """
+        stats = cls.objects.all()
+        if since is not None:
+            stats = stats.filter(
+                models.Q(date__gt=since.date())
+                | models.Q(date=since.date(), hour__gte=since.hour)
+            )
+        if until is not None:
+            stats = stats.filter(
+                models.Q(date__lt=until.date())
+                | models.Q(date=until.date(), hour__lt=until.hour)
+            )
+        stats = (
+            stats.values_list("date", "hour")
+            .annotate(
+                total_transactions=models.Sum("transactions"),
+                total_profit=models.Sum("profit"),
+            )
+            .order_by("date", "hour")
+        )
+        return {
+            hour_start(day, hour): (transactions, Decimal(profit))
+            for day, hour, transactions, profit in stats
+        }
+
+
+class PlatformBalance(models.Model):
+    """
+    Changes of the platform wallet balance made by transfers (profits
+    received and grants made), split in PLATFORM_BALANCE_SHARDS rows, so
+    concurrent transfers don't wait for each other on the platform wallet
+    row. The balance of the platform wallet is its stored balance plus the
+    sum of the shards (see Wallet.accrued_balance_btc).
+    """
+
+    shard = models.PositiveSmallIntegerField(unique=True)
+    amount = models.DecimalField(max_digits=16, decimal_places=8, default=0)
+
+    @classmethod
+    def accrue(cls, amount):
+        """
+        Adds amount to a random shard, with an atomic increment.
+        """
+        shard = random.randrange(settings.PLATFORM_BALANCE_SHARDS)
+        shard_rows = cls.objects.filter(shard=shard)
+        if shard_rows.update(amount=models.F("amount") + amount):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(shard=shard, amount=amount)
+        except IntegrityError:
+            # Created by a concurrent transaction
+            shard_rows.update(amount=models.F("amount") + amount)
+
+    @classmethod
+    def total(cls):
+        total = cls.objects.aggregate(total=models.Sum("amount"))["total"]
+        return Decimal(total or 0)
+
+    @classmethod
+    def fold(cls):
+        """
+        Locks the shards and resets them, before the stored balance of the
+        platform wallet is rebuilt from the ledger. Shards are locked before
+        the ledger is read, so no transfer is missed or counted twice.
+        """
+        list(cls.objects.select_for_update().order_by("shard"))
+        cls.objects.update(amount=0)
+
+
+class StatisticsRollup(models.Model):
+    """
+    Prefix sums of the statistics. Each row keeps the totals of all the
+    transactions recorded before its hour, so the totals of any range of
+    hours are the difference of two rows. The rollup_statistics command
+    writes a row for every hour, from the first recorded hour on.
+    """
+
+    hour = models.DateTimeField(unique=True)
+    transactions = models.BigIntegerField(default=0)
+    profit = models.DecimalField(max_digits=20, decimal_places=8, default=0)
+
+    @classmethod
+    def totals_before(cls, boundaries):
+        """
+        Returns a dict with the (transactions, profit) totals recorded
+        before each of the given hour aligned boundaries. Boundaries after
+        the last rollup add the hours not rolled up yet.
+        """
+        boundaries = sorted(set(boundaries))
+        last = cls.objects.order_by("-hour").first()
+        totals = {boundary: (0, Decimal("0")) for boundary in boundaries}
+
+        rolled_up = [b for b in boundaries if last is not None and b <= last.hour]
+        for hour, transactions, profit in cls.objects.filter(
+            hour__in=rolled_up
+        ).values_list("hour", "transactions", "profit"):
+            totals[hour] = (transactions, profit)
+
+        pending = [b for b in boundaries if last is None or b > last.hour]
+        if pending:
+            since = last.hour if last is not None else None
+            transactions, profit = (0, Decimal("0"))
+            if last is not None:
+                transactions, profit = (last.transactions, last.profit)
+            hourly = sorted(Statistics.hourly_totals(since, pending[-1]).items())
+            position = 0
+            for boundary in pending:
+                while position < len(hourly) and hourly[position][0] < boundary:
+                    hour_transactions, hour_profit = hourly[position][1]
+                    transactions += hour_transactions
+                    profit += hour_profit
+                    position += 1
+                totals[boundary] = (transactions, profit)
+        return totals
+
+    @classmethod
+    def totals(cls):
+        """
+        Returns the (transactions, profit) totals of all the statistics:
+        the last prefix sum plus the hours not rolled up yet.
+        """
+        now = timezone.now()
+        boundary = hour_start(now.date(), now.hour) + timedelta(hours=1)
+        return cls.totals_before([boundary])[boundary]
+
+
+class IdempotencyKey(models.Model):
+    """
+    Idempotency-Key sent by a user with a request, and the response that
+    was returned for it, so retries of the request get the same response
+    instead of being performed again. A key without status code belongs
+    to a request still being processed. Keys expire after
+    IDEMPOTENCY_KEY_TTL seconds and are deleted by purge_idempotency_keys.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # Fingerprint of the request (method, path and body)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "key"], name="unique_user_idempotency_key"
+            )
+        ]
+
+    def __str__(self):
+        return f"Idempotency key {self.key} of user {self.user_id}"
+
+    @classmethod
+    def expired(cls, now=None):
+        """
+        Returns the keys older than IDEMPOTENCY_KEY_TTL seconds.
+        """
+        now = now or timezone.now()
+        ttl = timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+        return cls.objects.filter(created_at__lt=now - ttl)
+
+
+def hour_start(day, hour):
+    """
+    Returns the (UTC) datetime an hour of the given day starts.
+    """
+    return datetime(day.year, day.month, day.day, hour, tzinfo=timezone.utc)
@@ -1,14 +1,62 @@
+import re
 import uuid
+from datetime import timedelta
 from decimal import Decimal
 
 from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db.models import Q
 from django.conf import settings
 
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
-from .models import Wallet, Transaction, Statistics, get_platform_wallet
+from .models import (
+    Wallet,
+    Transaction,
+    Statistics,
+    InsufficientFundsError,
+    get_platform_wallet,
+    is_grant,
+)
+from .utils.rates import Rates
+
+
+class CurrencyListField(serializers.CharField):
+    """
+    Comma separated list of currency codes (e.g. "usd,eur,ars").
+    """
+
+    default_error_messages = {
+        "invalid_currency": "Invalid currency code {code}.",
+        "max_currencies": "Ensure there are no more than {max_currencies} currencies.",
+    }
+    max_currencies = 10
+    code_regex = re.compile(r"^[a-z]{3}$")
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        currencies = []
+        for code in value.lower().split(","):
+            code = code.strip()
+            if not self.code_regex.match(code):
+                self.fail("invalid_currency", code=code)
+            if code not in currencies:
+                currencies.append(code)
+        if len(currencies) > self.max_currencies:
+            self.fail("max_currencies", max_currencies=self.max_currencies)
+        return currencies
+
+
+class CurrencyQuerySerializer(serializers.Serializer):
+    """
+    Serializer used to validate the currencies wallet balances are
+    expressed in.
+    """
+
+    currency = CurrencyListField(required=False)
+
+    def get_currencies(self):
+        return self.validated_data.get("currency", Rates.DEFAULT_CURRENCIES)
 
 
 class UserCreateSerializer(serializers.ModelSerializer):
@@ -30,18 +78,25 @@ class UserCreateSerializer(serializers.ModelSerializer):
 
 class WalletSerializer(serializers.ModelSerializer):
     """
-    Serializer used to create BTC wallet and view detail.
+    Serializer used to create BTC wallet, view detail and list wallets.
     After wallet creation, platform transfer (grant) 1 BTC
     to the owner of the wallet.
     """
 
     address = serializers.ReadOnlyField()
-    balance = serializers.ReadOnlyField()
+    balance = serializers.SerializerMethodField()
 
     class Meta:
         model = Wallet
         fields = ("address", "alias", "balance")
 
+    def get_balance(self, wallet):
+        currencies = self.context.get("currencies", Rates.DEFAULT_CURRENCIES)
+        if "rates" not in self.context:
+            # Resolved once, and shared by all the wallets of a list
+            self.context["rates"] = Rates.get_rates()
+        return wallet.balance_in(currencies, rates=self.context["rates"])
+
     def validate(self, data):
         user = self.context.get("user")
         user_wallets = Wallet.objects.filter(user=user).count()
@@ -86,17 +141,29 @@ class WalletSerializer(serializers.ModelSerializer):
         )
         serializer.is_valid(raise_exception=True)
         serializer.save()
+        # The grant updated the stored balance in the database
+        user_wallet.refresh_from_db(fields=["balance_btc"])
         return user_wallet
 
 
+class WalletAddressField(serializers.UUIDField):
+    """
+    Wallet address of a transaction. Reads the foreign key value so
+    listing transactions doesn't fetch the wallets row by row.
+    """
+
+    def get_attribute(self, instance):
+        return getattr(instance, f"{self.source}_id")
+
+
 class TransactionSerializer(serializers.ModelSerializer):
     """
     Serializer used to create transactions when transfer bitcoins
     between wallets, used to list those transactions.
     """
 
-    wallet_from = serializers.UUIDField()
-    wallet_to = serializers.UUIDField()
+    wallet_from = WalletAddressField()
+    wallet_to = WalletAddressField()
     details = serializers.ReadOnlyField()
     created_at = serializers.ReadOnlyField()
 
@@ -114,75 +181,106 @@ class TransactionSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         """
-        Transfer BTCs from one wallet to another wallet.
+        Transfer BTCs from one wallet to another wallet. Wallets were
+        resolved by validate, funds are checked again by the transfer,
+        under lock.
         """
-        wallet_from = Wallet.objects.get(address=validated_data["wallet_from"])
-        wallet_to = Wallet.objects.get(address=validated_data["wallet_to"])
-        transaction = Wallet.transfer(
-            wallet_from=wallet_from,
-            wallet_to=wallet_to,
-            transaction_type=validated_data["transaction_type"],
-            amount=validated_data["amount"],
-            extra=validated_data.get("extra", ""),
-        )
-        return transaction
+        try:
+            return Wallet.transfer(
+                wallet_from=validated_data["wallet_from"],
+                wallet_to=validated_data["wallet_to"],
+                transaction_type=validated_data["transaction_type"],
+                amount=validated_data["amount"],
+                extra=validated_data.get("extra", ""),
+            )
+        except InsufficientFundsError as exc:
+            # Same error as if validate_wallet_funds had failed
+            raise serializers.ValidationError(
+                {api_settings.NON_FIELD_ERRORS_KEY: [str(exc)]}
+            )
 
     def validate(self, data):
         """
-        Performs all required validations before init transactions
+        Performs all required validations before init transactions.
+        Both wallets are fetched at once, and replace their addresses
+        in the validated data.
         """
         user = self.context.get("user")
+        addresses = {data.get("wallet_from"), data.get("wallet_to")}
+        wallets = Wallet.objects.in_bulk(addresses, field_name="address")
+        self.validate_wallets(data, wallets, user)
+        data["wallet_from"] = wallets[data["wallet_from"]]
+        data["wallet_to"] = self.validate_destination_address(
+            data["wallet_to"], wallets
+        )
+        return data
+
+    def validate_wallets(self, data, wallets, user, check_funds=True):
+        """
+        Performs the wallets validations against the given wallets (keyed
+        by address). Funds are checked against the balance read with the
+        wallet, the transfer checks them again under lock.
+        """
         transaction_type = data.get("transaction_type")
         wallet_to = data.get("wallet_to")
         wallet_from = data.get("wallet_from")
         amount = data.get("amount")
 
-        wallet = self.validate_origin_address(wallet_from, user)
-        self.validate_wallet_funds(wallet, amount, transaction_type)
+        wallet = self.validate_origin_address(wallet_from, user, wallets)
+        if check_funds:
+            self.validate_wallet_funds(wallet, amount, transaction_type)
 
         if transaction_type == Transaction.SENT_INTERNAL:
-            self.validate_internal_destination_address(wallet_to, user)
+            self.validate_internal_destination_address(wallet_to, user, wallets)
 
         if transaction_type == Transaction.SENT_EXTERNAL:
-            self.validate_external_destination_address(wallet_to, user)
+            self.validate_external_destination_address(wallet_to, user, wallets)
             self.validate_minimum_transaction_amount(amount)
-        return data
 
-    def validate_origin_address(self, address, user):
+    def validate_origin_address(self, address, user, wallets):
         """
         Check wallet address belongs to the user who want to transfer BTCs
         """
-        try:
-            return Wallet.objects.get(user=user, address=address)
-        except Wallet.DoesNotExist:
+        wallet = wallets.get(address)
+        if wallet is None or wallet.user_id != getattr(user, "pk", None):
             raise serializers.ValidationError(
                 f"Invalid from wallet with address {address}"
             )
+        return wallet
 
-    def validate_internal_destination_address(self, address, user):
+    def validate_internal_destination_address(self, address, user, wallets):
         """
         Checks that the internal address to transfer to, belongs to the user
         who performs the transaction.
         """
-        try:
-            Wallet.objects.get(user=user, address=address)
-        except Wallet.DoesNotExist:
+        wallet = wallets.get(address)
+        if wallet is None or wallet.user_id != getattr(user, "pk", None):
             raise serializers.ValidationError(
                 "Invalid internal wallet/address to transfer."
             )
 
-    def validate_external_destination_address(self, address, user):
+    def validate_external_destination_address(self, address, user, wallets):
         """
         Checks that the external address to transfer to, not belongs to the user
         who performs the transaction.
         """
-        try:
-            Wallet.objects.get(~Q(user=user), address=address)
-        except Wallet.DoesNotExist:
+        wallet = wallets.get(address)
+        if wallet is None or wallet.user_id == getattr(user, "pk", None):
             raise serializers.ValidationError(
                 "Invalid external wallet/address to transfer."
             )
 
+    def validate_destination_address(self, address, wallets):
+        """
+        Checks that the address to transfer to exists.
+        """
+        try:
+            return wallets[address]
+        except KeyError:
+            raise serializers.ValidationError(
+                f"Invalid to wallet with address {address}"
+            )
+
     def validate_minimum_transaction_amount(self, amount):
         """
         Transfers to others users requiere a minimum amount to transfer
@@ -197,9 +295,12 @@ class TransactionSerializer(serializers.ModelSerializer):
     def validate_wallet_funds(self, wallet, amount, transaction_type):
         """
         Checks the user's wallet has enough funds to transfer the specified
-        amount, including profit if required
+        amount, including profit if required. Grants of the platform wallet
+        are not checked.
         """
-        balance = wallet.balance_btc
+        if is_grant(wallet, transaction_type):
+            return
+        balance = wallet.balance_btc + wallet.accrued_balance_btc()
         profit = Transaction.calculate_profit(amount, transaction_type)
         if balance - amount - (amount * profit) < 0:
             raise serializers.ValidationError(
@@ -207,6 +308,127 @@ class TransactionSerializer(serializers.ModelSerializer):
             )
 
 
+class TransactionBatchItemSerializer(TransactionSerializer):
+    """
+    Serializer used to validate each transfer of a batch. Wallets are
+    fetched once for the whole batch and checked with validate_wallets,
+    funds are only checked by the transfer.
+    """
+
+    transaction_type = serializers.ChoiceField(
+        choices=[Transaction.SENT_INTERNAL, Transaction.SENT_EXTERNAL]
+    )
+
+    def validate(self, data):
+        return data
+
+
+class TransactionBatchSerializer(serializers.Serializer):
+    """
+    Serializer used to perform a list of transfers at once.
+    With the "atomic" mode (default) nothing is transferred if any of the
+    transfers fails. With "best_effort" the valid transfers are performed
+    and the failed ones are reported. Results are returned in the same
+    order as the transfers.
+    """
+
+    ATOMIC = "atomic"
+    BEST_EFFORT = "best_effort"
+    MODES = [ATOMIC, BEST_EFFORT]
+    CREATED = "created"
+    FAILED = "failed"
+    NOT_APPLIED = "not_applied"
+    max_transfers = 1000
+
+    mode = serializers.ChoiceField(choices=MODES, default=ATOMIC)
+    transfers = serializers.ListField(
+        child=serializers.DictField(),
+        min_length=1,
+        max_length=max_transfers,
+        write_only=True,
+    )
+    results = serializers.ListField(read_only=True)
+
+    def create(self, validated_data):
+        user = self.context.get("user")
+        atomic = validated_data["mode"] == self.ATOMIC
+        items = [
+            TransactionBatchItemSerializer(data=transfer)
+            for transfer in validated_data["transfers"]
+        ]
+        errors = [None if item.is_valid() else item.errors for item in items]
+        addresses = set()
+        for item in items:
+            addresses.update(
+                item.validated_data.get(field) for field in ("wallet_from", "wallet_to")
+            )
+        addresses.discard(None)
+        wallets = Wallet.objects.in_bulk(addresses, field_name="address")
+        for index, item in enumerate(items):
+            if errors[index] is not None:
+                continue
+            try:
+                item.validate_wallets(
+                    item.validated_data, wallets, user, check_funds=False
+                )
+            except serializers.ValidationError as exc:
+                errors[index] = serializers.as_serializer_error(exc)
+
+        valid = [index for index, error in enumerate(errors) if error is None]
+        outcomes = {}
+        if valid and not (atomic and len(valid) < len(items)):
+            transfers = []
+            for index in valid:
+                data = items[index].validated_data
+                transfers.append(
+                    {
+                        "wallet_from": wallets[data["wallet_from"]],
+                        "wallet_to": wallets[data["wallet_to"]],
+                        "transaction_type": data["transaction_type"],
+                        "amount": data["amount"],
+                        "extra": data.get("extra", ""),
+                    }
+                )
+            outcomes = dict(zip(valid, Wallet.transfer_batch(transfers, atomic)))
+
+        results = []
+        for index in range(len(items)):
+            outcome = outcomes.get(index)
+            if errors[index] is not None:
+                results.append({"status": self.FAILED, "errors": errors[index]})
+            elif isinstance(outcome, Transaction):
+                results.append(
+                    {
+                        "status": self.CREATED,
+                        "transaction": TransactionSerializer(outcome).data,
+                    }
+                )
+            elif outcome is not None:
+                results.append(
+                    {"status": self.FAILED, "errors": {"non_field_errors": [outcome]}}
+                )
+            else:
+                results.append({"status": self.NOT_APPLIED})
+        return {"mode": validated_data["mode"], "results": results}
+
+    def is_created(self):
+        """
+        Returns True if all the transfers were performed.
+        """
+        return all(result["status"] == self.CREATED for result in self.data["results"])
+
+
+class BalanceAtSerializer(serializers.Serializer):
+    """
+    Serializer used to validate point in time balance queries and
+    render the wallet balance at that time.
+    """
+
+    address = serializers.ReadOnlyField()
+    at = serializers.DateTimeField(required=False)
+    btc = serializers.ReadOnlyField()
+
+
 class StatisticsSerializer(serializers.ModelSerializer):
     transactions = serializers.ReadOnlyField()
 
@@ -219,3 +441,75 @@ class StatisticsSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             "profit": {"max_digits": 16, "decimal_places": 8, "read_only": True}
         }
+
+
+class StatisticsBucketSerializer(serializers.Serializer):
+    """
+    Serializer used to render statistics of a range of time.
+    """
+
+    start = serializers.DateTimeField()
+    transactions = serializers.IntegerField()
+    profit = serializers.DecimalField(max_digits=20, decimal_places=8)
+
+
+class StatisticsQuerySerializer(serializers.Serializer):
+    """
+    Serializer used to validate statistics range queries:
+    ?from=<datetime>&to=<datetime>&granularity=hour|day|month
+    Range is split in buckets of the given granularity (UTC), the first
+    bucket starts at the beginning of the hour, day or month of "from".
+    """
+
+    HOUR = "hour"
+    DAY = "day"
+    MONTH = "month"
+    GRANULARITIES = [HOUR, DAY, MONTH]
+    max_buckets = 1000
+
+    from_ = serializers.DateTimeField(required=False)
+    to = serializers.DateTimeField(required=False)
+    granularity = serializers.ChoiceField(choices=GRANULARITIES, required=False)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # "from" is a python keyword
+        fields["from"] = fields.pop("from_")
+        return fields
+
+    def validate(self, data):
+        if not data:
+            return data
+        if "from" not in data or "to" not in data:
+            raise serializers.ValidationError("Both from and to dates are required.")
+        start = timezone.localtime(data["from"], timezone.utc)
+        end = timezone.localtime(data["to"], timezone.utc)
+        if start >= end:
+            raise serializers.ValidationError("from date must be before to date.")
+        granularity = data.setdefault("granularity", self.DAY)
+
+        boundary = start.replace(minute=0, second=0, microsecond=0)
+        if granularity != self.HOUR:
+            boundary = boundary.replace(hour=0)
+        if granularity == self.MONTH:
+            boundary = boundary.replace(day=1)
+        boundaries = [boundary]
+        while boundary < end:
+            boundary = self.next_boundary(boundary, granularity)
+            boundaries.append(boundary)
+            if len(boundaries) > self.max_buckets + 1:
+                raise serializers.ValidationError(
+                    f"Range is too large, up to {self.max_buckets} {granularity}s "
+                    f"are allowed."
+                )
+        data["boundaries"] = boundaries
+        return data
+
+    def next_boundary(self, boundary, granularity):
+        if granularity == self.HOUR:
+            return boundary + timedelta(hours=1)
+        if granularity == self.DAY:
+            return boundary + timedelta(days=1)
+        if boundary.month == 12:
+            return boundary.replace(year=boundary.year + 1, month=1)
+        return boundary.replace(month=boundary.month + 1)
@@ -1,12 +1,28 @@
-from datetime import date
-from .models import Statistics, Transaction
+from rest_framework.authtoken.models import Token
+
+from .models import Statistics, Transaction, clear_platform_wallet_cache
+from .utils.authentication import CachedTokenAuthentication
 
 
 # @receiver(post_save, sender=Transaction)
 def update_statistics(sender, instance, **kwargs):
-    today = date.today()
-    obj, created = Statistics.objects.get_or_create(date=today)
-    obj.transactions += 1
+    if not instance.record_statistics:
+        return
+    profit = 0
     if instance.transaction_type == Transaction.PLATFORM_PROFIT:
-        obj.profit += instance.amount
-    obj.save()
+        profit = instance.amount
+    Statistics.record(transactions=1, profit=profit)
+
+
+def invalidate_platform_wallet(sender, instance, **kwargs):
+    clear_platform_wallet_cache()
+
+
+def invalidate_token(sender, instance, **kwargs):
+    CachedTokenAuthentication.invalidate(instance.key)
+
+
+def invalidate_user_tokens(sender, instance, **kwargs):
+    if not instance.is_active:
+        keys = Token.objects.filter(user=instance).values_list("key", flat=True)
+        CachedTokenAuthentication.invalidate(*keys)
@@ -1,12 +1,59 @@
+import contextlib
+import csv
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
-from rest_framework.test import APITestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APITransactionTestCase
 from rest_framework import status
 
 from django.urls import reverse
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command, CommandError
+from django.db import connection, connections, transaction, OperationalError
+from django.db.models import Sum
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from .models import Transaction
+from .models import (
+    Transaction,
+    ArchivedTransaction,
+    Wallet,
+    BalanceCheckpoint,
+    IdempotencyKey,
+    PlatformBalance,
+    Statistics,
+    StatisticsRollup,
+    InsufficientFundsError,
+    get_platform_wallet,
+    clear_platform_wallet_cache,
+)
+from .serializers import TransactionSerializer
+from .views import TransactionExportView
+from . import urls as api_urls
+from .utils import instrumentation, metrics
+from .utils.partitions import is_partitioned, month_start, partitions
+from .management.commands.bench import parse_mix
+from .management.commands.microbench import compare, measure
+from .utils.bench import percentile, summarize
+from .utils.rates import Rates
+from .utils.routers import STICKY_COOKIE, STICKY_KEY, ReplicaRouter
+
+# Stubbed response of the rates API
+API_RATES = {"usd": 11661.17, "eur": 9876.54}
 
 
 class APITestBaseView(APITestCase):
@@ -86,6 +133,46 @@ class TestWalletCreateView(APITestBaseView):
         )
 
 
+class TestWalletListView(APITestBaseView):
+    url = reverse("wallet-create")
+
+    def test_list_wallets(self):
+        """
+        Tests all the wallets of the user are listed with their balances
+        """
+        addresses = [
+            self.client.post(self.url, data={}, format="json").data["address"]
+            for i in range(3)
+        ]
+        other = self.create_user("userB", "passB")
+        self.set_api_credentials(other)
+        self.client.post(self.url, data={}, format="json")
+        self.set_api_credentials(self.token)
+
+        with mock.patch.object(Rates, "get_rates", wraps=Rates.get_rates) as get_rates:
+            response = self.client.get(self.url, data={"currency": "usd,eur"})
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            "Expected Response Code 200, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        self.assertEqual([wallet["address"] for wallet in response.data], addresses)
+        self.assertEqual(set(response.data[0]["balance"]), {"btc", "usd", "eur"})
+        self.assertEqual(response.data[0]["balance"]["btc"], "1.00000000")
+        self.assertEqual(get_rates.call_count, 1)
+
+    def test_rates_not_available(self):
+        self.client.post(self.url, data={}, format="json")
+        self.client.post(self.url, data={}, format="json")
+        get_rates = mock.patch.object(Rates, "get_rates", return_value=None)
+        with get_rates as get_rates:
+            response = self.client.get(self.url)
+        self.assertEqual(get_rates.call_count, 1)
+        self.assertEqual(response.data[1]["balance"]["usd"], Rates.API_NOT_AVAILABLE)
+
+
 class TestWalletDetailView(APITestBaseView):
     def test_detail_by_address(self):
         """
@@ -113,6 +200,74 @@ class TestWalletDetailView(APITestBaseView):
             ),
         )
 
+    def test_detail_in_currencies(self):
+        """
+        Test wallet balance in several currencies
+        """
+        url_create = reverse("wallet-create")
+        response_create = self.client.post(url_create, data={}, format="json")
+        url_detail = reverse(
+            "wallet-detail", kwargs={"address": response_create.data.get("address")}
+        )
+        cache.clear()
+        with mock.patch.object(Rates, "api_call", return_value=API_RATES) as api_call:
+            response = self.client.get(url_detail, data={"currency": "usd,EUR"})
+        self.assertEqual(api_call.call_count, 1)
+        self.assertEqual(
+            response.data["balance"],
+            {"btc": "1.00000000", "usd": "11661.17", "eur": "9876.54"},
+        )
+        response = self.client.get(url_detail, data={"currency": "usd,euro"})
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_400_BAD_REQUEST,
+            "Expected Response Code 400, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+
+class TestRequestTiming(APITestBaseView):
+    @override_settings(REQUEST_TIMING=True)
+    def test_server_timing(self):
+        # Middlewares are loaded by the first request of a client
+        self.client = self.client_class()
+        self.set_api_credentials(self.token)
+        api_response = mock.Mock()
+        api_response.json.return_value = {"data": [{"code": "USD", "rate": 10000}]}
+        with self.assertLogs("api.timing", "INFO") as logs:
+            response = self.client.post(reverse("wallet-create"), {}, format="json")
+            url = reverse("wallet-detail", kwargs={"address": response.data["address"]})
+            cache.clear()
+            with mock.patch("api.utils.rates.requests.get", return_value=api_response):
+                response = self.client.get(url)
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            "Expected Response Code 200, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        entries = response["Server-Timing"].split(", ")
+        self.assertEqual(
+            [entry.split(";")[0] for entry in entries],
+            ["db", "cache", "http", "render", "total"],
+        )
+        self.assertIn('desc="1 call(s)"', entries[2])
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line["url_name"], "wallet-detail")
+        self.assertEqual(line["status"], 200)
+        self.assertEqual(line["http"]["count"], 1)
+        self.assertGreaterEqual(line["db"]["count"], 1)
+        # Rates are looked up in the cache before calling the API
+        self.assertGreaterEqual(line["cache"]["count"], 1)
+        self.assertIsNotNone(line["render_ms"])
+
+    def test_disabled(self):
+        response = self.client.get(reverse("wallet-create"))
+        self.assertNotIn("Server-Timing", response)
+
 
 class TestTransactionCreateListView(APITestBaseView):
     def setUp(self):
@@ -170,6 +325,36 @@ class TestTransactionCreateView(TestTransactionCreateListView):
             ),
         )
 
+    def test_pessimistic_transfer_locks_wallets_in_order(self):
+        wallet_from = Wallet.objects.get(address=self.wallet_1_user_B)
+        wallet_to = Wallet.objects.get(address=self.wallet_1_user_A)
+        with CaptureQueriesContext(connection) as queries:
+            Wallet.transfer(
+                wallet_from=wallet_from,
+                wallet_to=wallet_to,
+                transaction_type=Transaction.SENT_EXTERNAL,
+                amount=Decimal("0.1"),
+                extra="",
+                mode=Wallet.PESSIMISTIC,
+            )
+        statements = [query["sql"] for query in queries]
+        (lock,) = [
+            index
+            for index, sql in enumerate(statements)
+            if '"api_wallet"."address" IN' in sql
+            and 'ORDER BY "api_wallet"."address" ASC' in sql
+        ]
+        # Both wallets are locked at once, before any balance is updated
+        for wallet in (wallet_from, wallet_to):
+            self.assertIn(wallet.address.hex, statements[lock])
+        updates = [
+            index
+            for index, sql in enumerate(statements)
+            if sql.startswith('UPDATE "api_wallet"')
+        ]
+        self.assertEqual(len(updates), 2)
+        self.assertLess(lock, min(updates))
+
     def test_balance_is_ok_after_internal_transfer(self):
         amount = Decimal("0.55")
         # Transaction details. Trasfer from wallet 1 to wallet 2 from user A
@@ -277,8 +462,73 @@ class TestTransactionCreateView(TestTransactionCreateListView):
         )
 
 
+    def test_transfer_errors(self):
+        """
+        Test error messages of invalid transfers
+        """
+        invalid = [
+            (
+                {"wallet_from": self.wallet_1_user_B, "amount": Decimal("0.1")},
+                f"Invalid from wallet with address {self.wallet_1_user_B}",
+            ),
+            (
+                {"amount": Decimal("5")},
+                f"Insufficient funds in wallet with address {self.wallet_1_user_A}",
+            ),
+            (
+                {"wallet_to": self.wallet_1_user_B, "amount": Decimal("0.1")},
+                "Invalid internal wallet/address to transfer.",
+            ),
+        ]
+        for changes, message in invalid:
+            transaction = {
+                "wallet_from": self.wallet_1_user_A,
+                "wallet_to": self.wallet_2_user_A,
+                "transaction_type": Transaction.SENT_INTERNAL,
+            }
+            transaction.update(changes)
+            response = self.client.post(
+                self.url_transaction, data=transaction, format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data["error_message"], [message])
+
+    def test_insufficient_funds_checked_under_lock(self):
+        """
+        Test funds spent after validation are reported as a validation error
+        """
+        transaction = {
+            "wallet_from": self.wallet_1_user_A,
+            "wallet_to": self.wallet_2_user_A,
+            "transaction_type": Transaction.SENT_INTERNAL,
+            "amount": Decimal("0.6"),
+        }
+        validate = TransactionSerializer.validate
+
+        def validate_then_spend(serializer, data):
+            data = validate(serializer, data)
+            Wallet.objects.filter(address=self.wallet_1_user_A).update(
+                balance_btc=Decimal("0.5")
+            )
+            return data
+
+        with mock.patch.object(TransactionSerializer, "validate", validate_then_spend):
+            response = self.client.post(
+                self.url_transaction, data=transaction, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.data["error_message"],
+            [f"Insufficient funds in wallet with address {self.wallet_1_user_A}"],
+        )
+        self.assertFalse(
+            Transaction.objects.filter(transaction_type=Transaction.SENT_INTERNAL)
+        )
+
+
 class TestTransactionListView(TestTransactionCreateListView):
     url = reverse("transaction-list")
+    url_transaction = reverse("transaction-list")
 
     def test_list_transaction(self):
         response = self.client.get(self.url, format="json")
@@ -292,7 +542,7 @@ class TestTransactionListView(TestTransactionCreateListView):
 
     def test_list_first_transaction(self):
         response = self.client.get(self.url, format="json")
-        total = len(response.data)
+        total = len(response.data["results"])
         self.assertEqual(
             total,
             2,
@@ -301,6 +551,29 @@ class TestTransactionListView(TestTransactionCreateListView):
             ),
         )
 
+    def test_list_transactions_by_pages(self):
+        self.transfer_to_iternal_address()
+        self.transfer_to_external_address()
+        response = self.client.get(self.url, data={"page_size": 2}, format="json")
+        pages = [response.data["results"]]
+        while response.data["next"]:
+            response = self.client.get(response.data["next"], format="json")
+            pages.append(response.data["results"])
+        created = [t["created_at"] for page in pages for t in page]
+        # 2 grants + internal transfer + external transfer and its profit
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(created, sorted(created, reverse=True))
+
+    def test_list_invalid_cursor(self):
+        response = self.client.get(self.url, data={"cursor": "invalid"}, format="json")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_404_NOT_FOUND,
+            "Expected Response Code 404, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
 
 class TestWalletTransactionListView(TestTransactionCreateListView):
     """
@@ -341,13 +614,19 @@ class TestWalletTransactionListView(TestTransactionCreateListView):
         )
 
 
-class TestStatisticsListView(TestTransactionCreateListView):
-    url = reverse("statistics")
+class TestTransactionExportView(TestTransactionCreateListView):
+    url_transaction = reverse("transaction-list")
 
-    def test_statistics_platform_with_valid_token(self):
-        admin_token = {"token": settings.PLATFORM_ADMIN_TOKEN}
-        self.set_api_credentials(admin_token)
-        response = self.client.get(self.url, format="json")
+    def export(self, address, **params):
+        url = reverse("transaction-export", kwargs={"address": address})
+        response = self.client.get(url, data=params)
+        content = b"".join(response.streaming_content) if response.streaming else b""
+        return response, content.decode()
+
+    def test_export_csv(self):
+        self.transfer_to_iternal_address()
+        self.transfer_to_external_address()
+        response, content = self.export(self.wallet_1_user_A, format="csv")
         self.assertEqual(
             response.status_code,
             status.HTTP_200_OK,
@@ -355,55 +634,272 @@ class TestStatisticsListView(TestTransactionCreateListView):
                 response.status_code
             ),
         )
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual(
+            [row["transaction_type"] for row in rows],
+            [
+                Transaction.PLATFORM,
+                Transaction.SENT_INTERNAL,
+                Transaction.SENT_EXTERNAL,
+                Transaction.PLATFORM_PROFIT,
+            ],
+        )
+        self.assertEqual(rows[0]["amount"], "1.00000000")
+        self.assertEqual(rows[1]["wallet_to"], str(self.wallet_2_user_A))
 
-    def test_statistics_platform_with_invalid_token(self):
-        response = self.client.get(self.url, format="json")
+        # Same representation as the transactions list
+        listed = self.client.get(
+            reverse("transaction-detail", kwargs={"address": self.wallet_1_user_A})
+        ).json()["results"]
+        self.assertEqual(rows[-1]["created_at"], listed[0]["created_at"])
+
+    def test_export_csv_formulas_are_quoted(self):
+        self.transfer_to_iternal_address()
+        for extra in ["=1+1", "+1", "-1", "@SUM(A1)", "\tcmd", "\rcmd", "a=b"]:
+            Transaction.objects.filter(
+                transaction_type=Transaction.SENT_INTERNAL
+            ).update(extra=extra)
+            _, content = self.export(self.wallet_1_user_A, format="csv")
+            rows = list(csv.DictReader(StringIO(content, newline="")))
+            quoted = extra if extra == "a=b" else "'" + extra
+            self.assertEqual(rows[-1]["extra"], quoted)
+
+    def test_export_ndjson(self):
+        self.transfer_to_iternal_address()
+        with mock.patch.object(TransactionExportView, "chunk_size", 1):
+            response, content = self.export(self.wallet_2_user_A, format="ndjson")
+        self.assertEqual(
+            response["Content-Type"], "application/x-ndjson; charset=utf-8"
+        )
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(
+            [row["transaction_type"] for row in rows],
+            [Transaction.PLATFORM, Transaction.SENT_INTERNAL],
+        )
+        self.assertEqual(rows[1]["wallet_from"], str(self.wallet_1_user_A))
+        self.assertEqual(list(rows[0]), list(TransactionSerializer.Meta.fields))
+
+    def test_export_errors(self):
+        response, _ = self.export(self.wallet_1_user_B, format="ndjson")
         self.assertEqual(
             response.status_code,
-            status.HTTP_403_FORBIDDEN,
-            "Expected Response Code 403, received {0} instead.".format(
+            status.HTTP_404_NOT_FOUND,
+            "Expected Response Code 404, received {0} instead.".format(
                 response.status_code
             ),
         )
+        self.assertEqual(json.loads(response.content)["status_code"], 404)
+        response, _ = self.export(self.wallet_1_user_A, format="xml")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
-class TestUserCreateView(APITestCase):
-    url = reverse("user-create")
+class TestStoredBalance(TestTransactionCreateListView):
+    """
+    Test the stored wallet balance is kept in sync with the ledger
+    """
 
-    valid_payload = {
-        "username": "davidn04",
-        "email": "david@snow.com",
-        "password": "the_password",
-    }
-    invalid_payload = {
-        "username": "davidn04",
-        "email": "david@snow.com",
-    }
+    url_transaction = reverse("transaction-list")
 
-    def test_valid_user_payload(self):
-        """
-        Tests create a new user with a valid user's definition.
-        """
-        response = self.client.post(self.url, data=self.valid_payload, format="json")
+    def test_stored_balance_matches_ledger_after_transfers(self):
+        self.client.post(
+            reverse("transaction-list"),
+            data={
+                "wallet_from": self.wallet_1_user_A,
+                "wallet_to": self.wallet_1_user_B,
+                "transaction_type": Transaction.SENT_EXTERNAL,
+                "amount": Decimal("0.3"),
+            },
+            format="json",
+        )
+        for wallet in Wallet.objects.all():
+            self.assertEqual(
+                wallet.balance_btc + wallet.accrued_balance_btc(),
+                wallet.ledger_balance_btc(),
+                "Stored balance differs from ledger for wallet {0}".format(wallet),
+            )
+
+    def test_rebuild_balances_command(self):
+        Wallet.objects.filter(address=self.wallet_1_user_A).update(balance_btc=5)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_balances", "--verify", stdout=StringIO())
+        call_command("rebuild_balances", stdout=StringIO())
+        call_command("rebuild_balances", "--verify", stdout=StringIO())
+        wallet = Wallet.objects.get(address=self.wallet_1_user_A)
+        self.assertEqual(wallet.balance_btc, Decimal("1"))
+
+    def test_platform_profits_accrued_on_shards(self):
+        platform_wallet = get_platform_wallet()
+        stored = platform_wallet.balance_btc
+        self.transfer_to_external_address()
+        platform_wallet.refresh_from_db(fields=["balance_btc"])
+        self.assertEqual(platform_wallet.balance_btc, stored)
+        self.assertNotEqual(PlatformBalance.total(), 0)
+
+        # Rebuilding folds the shards into the stored balance
+        ledger = platform_wallet.ledger_balance_btc()
+        call_command("rebuild_balances", stdout=StringIO())
+        platform_wallet.refresh_from_db(fields=["balance_btc"])
+        self.assertEqual(platform_wallet.balance_btc, ledger)
+        self.assertEqual(PlatformBalance.total(), 0)
+        call_command("rebuild_balances", "--verify", stdout=StringIO())
+
+
+class TestTransactionArchive(TestTransactionCreateListView):
+    """
+    Test transactions of closed months are archived and still listed
+    """
+
+    url_transaction = reverse("transaction-list")
+
+    def archive_old_transactions(self):
+        self.transfer_to_iternal_address()
+        old = Transaction.objects.update(
+            created_at=timezone.now() - timedelta(days=100)
+        )
+        call_command("archive_transactions", "--chunk-size=2", stdout=StringIO())
+        self.transfer_to_external_address()
+        return old
+
+    def list_all(self, url):
+        rows = []
+        url += "?page_size=1"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_200_OK,
+                "Expected Response Code 200, received {0} instead.".format(
+                    response.status_code
+                ),
+            )
+            rows.extend(response.data["results"])
+            url = response.data["next"]
+        return [row["transaction_type"] for row in rows]
+
+    @override_settings(TRANSACTION_ARCHIVE_AFTER_MONTHS=1)
+    def test_archive_transactions_command(self):
+        old = self.archive_old_transactions()
+        self.assertEqual(ArchivedTransaction.objects.count(), old)
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertFalse(
+            Transaction.objects.filter(
+                pk__in=ArchivedTransaction.objects.values("pk")
+            ).exists()
+        )
+
+        expected = [
+            Transaction.PLATFORM_PROFIT,
+            Transaction.SENT_EXTERNAL,
+            Transaction.SENT_INTERNAL,
+            Transaction.PLATFORM,
+        ]
+        detail = reverse("transaction-detail", kwargs={"address": self.wallet_1_user_A})
+        self.assertEqual(self.list_all(detail), expected)
+        self.assertEqual(
+            self.list_all(self.url_transaction), expected + [Transaction.PLATFORM]
+        )
+
+        # Balances and exports include the archive
+        call_command("rebuild_balances", "--verify", stdout=StringIO())
+        wallet = Wallet.objects.get(address=self.wallet_1_user_A)
+        self.assertEqual(wallet.balance_btc_at(timezone.now()), wallet.balance_btc)
+        url = reverse("transaction-export", kwargs={"address": self.wallet_1_user_A})
+        response = self.client.get(url, data={"format": "ndjson"})
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(len(content.splitlines()), 4)
+
+    def test_archive_transactions_requires_setting(self):
+        # The archive wouldn't be read, archived transactions would be lost
+        Transaction.objects.update(created_at=timezone.now() - timedelta(days=100))
+        with self.assertRaises(CommandError):
+            call_command("archive_transactions", "--months=1", stdout=StringIO())
+        self.assertFalse(ArchivedTransaction.objects.exists())
+        self.assertFalse(ArchivedTransaction.in_use())
+        self.assertEqual(ArchivedTransaction.ledgers(), [Transaction])
+
+    def test_archive_cutoff(self):
+        now = timezone.make_aware(timezone.datetime(2020, 1, 15, 10))
+        self.assertEqual(
+            ArchivedTransaction.cutoff(2, now=now),
+            timezone.make_aware(timezone.datetime(2019, 11, 1), timezone.utc),
+        )
+        self.assertEqual(month_start(now, 12).year, 2021)
+
+    @skipUnless(connection.vendor == "postgresql", "Requires PostgreSQL")
+    def test_partition_transactions_command(self):
+        self.assertTrue(is_partitioned())
+        call_command("partition_transactions", "--ahead=5", stdout=StringIO())
+        starts = [start for _, start, _ in partitions()]
+        self.assertIn(month_start(timezone.now(), 5), starts)
+
+
+class TestWalletBalanceView(TestTransactionCreateListView):
+    """
+    Test point in time balance queries
+    """
+
+    def balance_at(self, address, at):
+        response = self.client.get(
+            reverse("wallet-balance", kwargs={"address": address}),
+            data={"at": at.isoformat()},
+            format="json",
+        )
         self.assertEqual(
             response.status_code,
-            status.HTTP_201_CREATED,
-            "Expected Response Code 201, received {0} instead.".format(
+            status.HTTP_200_OK,
+            "Expected Response Code 200, received {0} instead.".format(
                 response.status_code
             ),
         )
+        return response.data["btc"]
 
-    def test_valid_token_response(self):
-        """
-        Test a valid token is returned after user creation.
-        """
-        pass
+    def assert_balances(self, before, after):
+        self.assertEqual(self.balance_at(self.wallet_1_user_A, before), "1.00000000")
+        self.assertEqual(self.balance_at(self.wallet_1_user_A, after), "0.45000000")
+        self.assertEqual(self.balance_at(self.wallet_2_user_A, after), "1.55000000")
 
-    def test_invalid_user_payload(self):
-        """
-        Tests create a new user with a invalid user's definition must fail.
-        """
-        response = self.client.post(self.url, data=self.invalid_payload, format="json")
+    def transfer_and_get_times(self):
+        before = timezone.now()
+        self.client.post(
+            reverse("transaction-list"),
+            data={
+                "wallet_from": self.wallet_1_user_A,
+                "wallet_to": self.wallet_2_user_A,
+                "transaction_type": Transaction.SENT_INTERNAL,
+                "amount": Decimal("0.55"),
+            },
+            format="json",
+        )
+        return before, timezone.now()
+
+    def test_balance_at_without_checkpoints(self):
+        before, after = self.transfer_and_get_times()
+        self.assert_balances(before, after)
+
+    def test_balance_at_with_checkpoints(self):
+        before, after = self.transfer_and_get_times()
+        call_command(
+            "checkpoint_balances", "--settle=0", "--interval=1", stdout=StringIO()
+        )
+        self.assertTrue(
+            BalanceCheckpoint.objects.filter(wallet=self.wallet_1_user_A).exists()
+        )
+        self.assert_balances(before, after)
+
+    def test_incremental_checkpoints(self):
+        call_command("checkpoint_balances", "--settle=0", stdout=StringIO())
+        before, after = self.transfer_and_get_times()
+        call_command("checkpoint_balances", "--settle=0", stdout=StringIO())
+        self.assert_balances(before, after)
+
+    def test_invalid_timestamp(self):
+        response = self.client.get(
+            reverse("wallet-balance", kwargs={"address": self.wallet_1_user_A}),
+            data={"at": "yesterday"},
+            format="json",
+        )
         self.assertEqual(
             response.status_code,
             status.HTTP_400_BAD_REQUEST,
@@ -412,16 +908,1377 @@ class TestUserCreateView(APITestCase):
             ),
         )
 
-    def test_invalid_duplicate_username(self):
-        """
-        Tests usernames must be unique.
-        """
-        self.client.post(self.url, data=self.valid_payload, format="json")
-        response = self.client.post(self.url, data=self.valid_payload, format="json")
+
+@override_settings(WALLET_TRANSFER_MODE=Wallet.OPTIMISTIC)
+class TestOptimisticTransactionCreateView(TestTransactionCreateView):
+    """
+    Runs the transaction tests with the optimistic transfer mode
+    """
+
+    def transfer(self, amount, mode=Wallet.OPTIMISTIC):
+        return Wallet.transfer(
+            wallet_from=Wallet.objects.get(address=self.wallet_1_user_A),
+            wallet_to=Wallet.objects.get(address=self.wallet_1_user_B),
+            transaction_type=Transaction.SENT_EXTERNAL,
+            amount=amount,
+            extra="",
+            mode=mode,
+        )
+
+    def test_insufficient_funds_changes_nothing(self):
+        transactions = Transaction.objects.count()
+        with self.assertRaisesMessage(Exception, "Insufficient funds"):
+            self.transfer(Decimal("0.99"))
         self.assertEqual(
-            response.status_code,
-            status.HTTP_400_BAD_REQUEST,
-            "Expected Response Code 400, received {0} instead.".format(
-                response.status_code
+            Wallet.objects.get(address=self.wallet_1_user_B).balance_btc, Decimal("1")
+        )
+        self.assertEqual(Transaction.objects.count(), transactions)
+
+    def test_modes_update_the_same_balances(self):
+        self.transfer(Decimal("0.1"))
+        self.transfer(Decimal("0.1"), mode=Wallet.PESSIMISTIC)
+        wallet = Wallet.objects.get(address=self.wallet_1_user_A)
+        self.assertEqual(wallet.balance_btc, Decimal("0.797"))
+        self.assertEqual(wallet.balance_btc, wallet.ledger_balance_btc())
+
+    def test_aborted_transfer_is_retried(self):
+        update = Wallet.update_balances_optimistic.__func__
+        calls = []
+
+        def flaky_update(cls, *args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError("deadlock detected")
+            return update(cls, *args)
+
+        with mock.patch.object(
+            Wallet, "update_balances_optimistic", classmethod(flaky_update)
+        ):
+            self.transfer(Decimal("0.1"))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            Wallet.objects.get(address=self.wallet_1_user_B).balance_btc, Decimal("1.1")
+        )
+
+
+class TestBench(APITransactionTestCase):
+    """
+    Test the benchmark commands. Transactional, as the bench command serves
+    the app from another thread.
+    """
+
+    def setUp(self):
+        self.addCleanup(clear_platform_wallet_cache)
+        self.addCleanup(cache.clear)
+
+    def test_bench_transfers(self):
+        out = StringIO()
+        test_database = mock.MagicMock(side_effect=contextlib.nullcontext)
+        # The command runs in a throwaway database, not the configured one
+        with mock.patch(
+            "api.management.commands.bench_transfers.test_database", test_database
+        ):
+            call_command("bench_transfers", "--threads=1", "--transfers=4", stdout=out)
+        test_database.assert_called_once_with(False)
+        output = out.getvalue()
+        self.assertIn(Wallet.PESSIMISTIC, output)
+        self.assertIn(Wallet.OPTIMISTIC, output)
+
+    def test_bench_summaries(self):
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 99), 4)
+        self.assertEqual(summarize([], 0, 1)["p99"], None)
+        self.assertEqual(summarize([0.001, 0.002], 0, 1)["p95"], 2)
+
+    def test_bench_mix(self):
+        self.assertEqual(
+            parse_mix("wallet-detail=3, transfer-internal=1"),
+            {"wallet-detail": 3, "transfer-internal": 1},
+        )
+        invalid = ["wallet-detail=x", "unknown=1", "wallet-detail=0"]
+        for mix in invalid + ["transfer-internal=-1"]:
+            with self.assertRaises(CommandError):
+                parse_mix(mix)
+
+    def test_bench_command(self):
+        out = StringIO()
+        # Run against the test database instead of creating another one
+        with mock.patch(
+            "api.management.commands.bench.test_database", contextlib.nullcontext
+        ):
+            call_command(
+                "bench",
+                "--users=2",
+                "--clients=1",
+                "--requests=4",
+                "--mix=wallet-detail=1,transfer-internal=1",
+                stdout=out,
+            )
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["config"]["requests"], 4)
+        self.assertEqual(
+            set(report["operations"]), {"wallet-detail", "transfer-internal"}
+        )
+        self.assertEqual(report["total"]["calls"], 4)
+        self.assertEqual(report["total"]["errors"], 0)
+
+
+class TestMicrobench(APITestCase):
+    """
+    Test the microbench command and the comparison of its reports
+    """
+
+    def test_microbench_compare(self):
+        number, timings = measure(lambda: None, 3)
+        self.assertGreater(number, 1)
+        self.assertEqual(len(timings), 3)
+
+        def report(*timings):
+            return {
+                "results": [
+                    {"benchmark": name, "ledger_size": 1000, "p50_us": p50}
+                    for name, p50 in timings
+                ]
+            }
+
+        baseline = report(("transfer", 100), ("calculate-profit", 2))
+        current = report(("transfer", 111), ("calculate-profit", 2), ("new", 1))
+        self.assertEqual(
+            compare(baseline, current, threshold=10),
+            [
+                ("transfer", 1000, 100, 111, 11.0, True),
+                ("calculate-profit", 1000, 2, 2, 0.0, False),
+            ],
+        )
+
+    def test_microbench_command(self):
+        out = StringIO()
+        with mock.patch(
+            "api.management.commands.microbench.test_database", contextlib.nullcontext
+        ):
+            call_command(
+                "microbench",
+                "--ledger-size=10",
+                "--benchmark=transfer",
+                "--benchmark=calculate-profit",
+                "--repeat=1",
+                stdout=out,
+            )
+        report = json.loads(out.getvalue())
+        self.assertEqual(
+            [result["benchmark"] for result in report["results"]],
+            ["transfer", "calculate-profit"],
+        )
+        self.assertEqual(report["config"]["ledger_sizes"], [10])
+
+
+class TestIdempotentTransactionCreate(TestTransactionCreateListView):
+    url_transaction = reverse("transaction-list")
+
+    def transfer(self, key, amount=Decimal("0.1")):
+        transaction = {
+            "wallet_from": self.wallet_1_user_A,
+            "wallet_to": self.wallet_2_user_A,
+            "transaction_type": Transaction.SENT_INTERNAL,
+            "amount": amount,
+        }
+        return self.client.post(
+            self.url_transaction,
+            data=transaction,
+            format="json",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def transfers(self):
+        return Transaction.objects.filter(transaction_type=Transaction.SENT_INTERNAL)
+
+    def test_retry_returns_stored_response(self):
+        first = self.transfer("key-1")
+        self.assertEqual(
+            first.status_code,
+            status.HTTP_201_CREATED,
+            "Expected Response Code 201, received {0} instead.".format(
+                first.status_code
             ),
         )
+        with self.assertNumQueries(1):
+            retry = self.transfer("key-1")
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.data["details"], first.data["details"])
+        self.assertEqual(self.transfers().count(), 1)
+        self.transfer("key-2")
+        self.assertEqual(self.transfers().count(), 2)
+
+    def test_errors_are_stored(self):
+        first = self.transfer("key-1", amount=Decimal("5"))
+        self.assertEqual(first.status_code, status.HTTP_400_BAD_REQUEST)
+        retry = self.transfer("key-1", amount=Decimal("5"))
+        self.assertEqual(retry.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+
+    def test_key_reused_with_another_request(self):
+        self.transfer("key-1")
+        response = self.transfer("key-1", amount=Decimal("0.2"))
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(self.transfers().count(), 1)
+        # Keys are scoped by user
+        self.set_api_credentials(self.userB)
+        response = self.client.post(
+            self.url_transaction,
+            data={
+                "wallet_from": self.wallet_1_user_B,
+                "wallet_to": self.wallet_1_user_A,
+                "transaction_type": Transaction.SENT_EXTERNAL,
+                "amount": Decimal("0.1"),
+            },
+            format="json",
+            HTTP_IDEMPOTENCY_KEY="key-1",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_concurrent_request_with_same_key(self):
+        user = Wallet.objects.get(address=self.wallet_1_user_A).user
+        self.transfer("key-1")
+        in_progress = IdempotencyKey.objects.get(user=user, key="key-1")
+        in_progress.status_code = None
+        in_progress.save()
+        response = self.transfer("key-1")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        # A request that never completed can be retried after a while
+        in_progress.created_at -= timedelta(seconds=settings.IDEMPOTENCY_CLAIM_TIMEOUT)
+        in_progress.save()
+        response = self.transfer("key-1")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.transfers().count(), 2)
+
+    def test_expired_keys(self):
+        self.transfer("key-1")
+        self.transfer("key-2")
+        expired = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL + 1)
+        IdempotencyKey.objects.filter(key="key-1").update(created_at=expired)
+        # An expired key is not replayed, and can be used for another request
+        response = self.transfer("key-1", amount=Decimal("0.2"))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.transfers().count(), 3)
+
+        IdempotencyKey.objects.filter(key="key-2").update(created_at=expired)
+        call_command("purge_idempotency_keys", stdout=StringIO())
+        self.assertEqual(
+            list(IdempotencyKey.objects.values_list("key", flat=True)), ["key-1"]
+        )
+
+    def test_invalid_key(self):
+        response = self.transfer("k" * 256)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(self.transfers().exists())
+
+
+class TestTransactionBatchView(TestTransactionCreateListView):
+    url_batch = reverse("transaction-batch")
+
+    def internal(self, amount):
+        return {
+            "wallet_from": self.wallet_1_user_A,
+            "wallet_to": self.wallet_2_user_A,
+            "transaction_type": Transaction.SENT_INTERNAL,
+            "amount": str(amount),
+        }
+
+    def external(self, amount):
+        return {
+            "wallet_from": self.wallet_1_user_A,
+            "wallet_to": self.wallet_1_user_B,
+            "transaction_type": Transaction.SENT_EXTERNAL,
+            "amount": str(amount),
+        }
+
+    def post_batch(self, transfers, mode=None):
+        batch = {"transfers": transfers}
+        if mode is not None:
+            batch["mode"] = mode
+        return self.client.post(self.url_batch, data=batch, format="json")
+
+    def balance(self, address):
+        return Wallet.objects.get(address=address).balance_btc
+
+    def test_batch_does_not_lock_platform_wallet(self):
+        platform_wallet = get_platform_wallet()
+        for transfer in (self.internal, self.external):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post_batch([transfer(Decimal("0.1"))])
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertNotIn(platform_wallet.address.hex, self.lock_query(queries))
+
+    def lock_query(self, queries):
+        """
+        Returns the query locking the wallets of the batch (sorted by
+        address, FOR UPDATE is left out on SQLite).
+        """
+        (sql,) = [
+            query["sql"]
+            for query in queries
+            if '"api_wallet"."address" IN' in query["sql"]
+            and "ORDER BY" in query["sql"]
+        ]
+        return sql
+
+    def test_batch_transfer(self):
+        response = self.post_batch(
+            [self.internal(Decimal("0.1")), self.external(Decimal("0.2"))]
+        )
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            "Expected Response Code 201, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        results = response.data["results"]
+        self.assertEqual([result["status"] for result in results], ["created"] * 2)
+        self.assertEqual(
+            results[1]["transaction"]["wallet_to"], str(self.wallet_1_user_B)
+        )
+        # 0.2 BTC external transfer costs 0.003 BTC
+        self.assertEqual(self.balance(self.wallet_1_user_A), Decimal("0.697"))
+        self.assertEqual(self.balance(self.wallet_2_user_A), Decimal("1.1"))
+        self.assertEqual(self.balance(self.wallet_1_user_B), Decimal("1.2"))
+        self.assertEqual(
+            self.balance(self.wallet_1_user_A),
+            Wallet.objects.get(address=self.wallet_1_user_A).ledger_balance_btc(),
+        )
+        # Platform funds, 3 wallet grants, 2 transfers and 1 platform profit
+        self.assertEqual(
+            Statistics.objects.aggregate(total=Sum("transactions"))["total"], 7
+        )
+
+    def test_atomic_batch_transfers_nothing_on_failure(self):
+        # Funds are checked against the balance left by previous transfers
+        response = self.post_batch(
+            [self.internal(Decimal("0.6")), self.internal(Decimal("0.6"))]
+        )
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_400_BAD_REQUEST,
+            "Expected Response Code 400, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        results = response.data["results"]
+        self.assertEqual(
+            [result["status"] for result in results], ["not_applied", "failed"]
+        )
+        self.assertIn("Insufficient funds", results[1]["errors"]["non_field_errors"][0])
+        self.assertEqual(self.balance(self.wallet_1_user_A), Decimal("1"))
+        self.assertEqual(self.balance(self.wallet_2_user_A), Decimal("1"))
+
+    def test_best_effort_batch_reports_failures(self):
+        invalid = self.internal(Decimal("0.1"))
+        invalid["wallet_to"] = self.wallet_1_user_B
+        response = self.post_batch(
+            [
+                self.internal(Decimal("0.6")),
+                invalid,
+                self.internal(Decimal("0.6")),
+                self.external(Decimal("0.2")),
+            ],
+            mode="best_effort",
+        )
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_207_MULTI_STATUS,
+            "Expected Response Code 207, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        results = response.data["results"]
+        self.assertEqual(
+            [result["status"] for result in results],
+            ["created", "failed", "failed", "created"],
+        )
+        self.assertEqual(
+            results[1]["errors"]["non_field_errors"],
+            ["Invalid internal wallet/address to transfer."],
+        )
+        self.assertEqual(self.balance(self.wallet_1_user_A), Decimal("0.197"))
+
+    def test_batch_validation(self):
+        response = self.post_batch([], mode="all")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_400_BAD_REQUEST,
+            "Expected Response Code 400, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        self.assertEqual(set(response.data["error_message"]), {"transfers", "mode"})
+
+    @override_settings(STATISTICS_SHARDS=1)
+    def test_batch_queries_dont_grow_with_transfers(self):
+        with mock.patch.object(transaction, "on_commit", lambda func: func()):
+            get_platform_wallet()
+        self.addCleanup(clear_platform_wallet_cache)
+        # Creates the statistics row of the current hour
+        self.post_batch([self.internal(Decimal("0.01"))])
+        with CaptureQueriesContext(connection) as small:
+            self.post_batch([self.internal(Decimal("0.01"))] * 2)
+        with CaptureQueriesContext(connection) as large:
+            self.post_batch([self.internal(Decimal("0.01"))] * 20)
+        self.assertEqual(len(small), len(large))
+
+
+class TestStatisticsListView(TestTransactionCreateListView):
+    url = reverse("statistics")
+    url_transaction = reverse("transaction-list")
+
+    def test_statistics_platform_with_valid_token(self):
+        admin_token = {"token": settings.PLATFORM_ADMIN_TOKEN}
+        self.set_api_credentials(admin_token)
+        response = self.client.get(self.url, format="json")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            "Expected Response Code 200, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+    def test_statistics_totals_are_exact(self):
+        self.transfer_to_external_address()
+        self.transfer_to_external_address()
+        self.set_api_credentials({"token": settings.PLATFORM_ADMIN_TOKEN})
+        response = self.client.get(self.url, format="json")
+        profit = Transaction.objects.filter(
+            transaction_type=Transaction.PLATFORM_PROFIT
+        ).aggregate(total=Sum("amount"))["total"]
+        self.assertEqual(response.data["transactions"], Transaction.objects.count())
+        self.assertEqual(Decimal(response.data["profit"]), profit)
+
+    def test_statistics_record_on_shards(self):
+        Statistics.objects.all().delete()
+        for shard in [0, 1, 1]:
+            with mock.patch("random.randrange", return_value=shard):
+                Statistics.record(transactions=2, profit=Decimal("0.5"))
+        self.assertEqual(Statistics.objects.count(), 2)
+        totals = Statistics.objects.aggregate(
+            transactions=Sum("transactions"), profit=Sum("profit")
+        )
+        self.assertEqual(totals["transactions"], 6)
+        self.assertEqual(totals["profit"], Decimal("1.5"))
+
+    def test_transfer_records_statistics_once(self):
+        with mock.patch.object(Statistics, "record") as record:
+            self.transfer_to_external_address()
+        # Both ledger rows are recorded on a single shard
+        profit = Transaction.objects.get(
+            transaction_type=Transaction.PLATFORM_PROFIT
+        ).amount
+        record.assert_called_once_with(transactions=2, profit=profit)
+
+    def record_statistics_at(self, hour, transactions, profit):
+        Statistics.objects.create(
+            date=hour.date(),
+            hour=hour.hour,
+            transactions=transactions,
+            profit=Decimal(profit),
+        )
+
+    def get_statistics_range(self, start, end, granularity):
+        self.set_api_credentials({"token": settings.PLATFORM_ADMIN_TOKEN})
+        response = self.client.get(
+            self.url,
+            data={
+                "from": start.isoformat(),
+                "to": end.isoformat(),
+                "granularity": granularity,
+            },
+        )
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            "Expected Response Code 200, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        return response.data
+
+    def assert_statistics_ranges(self, base):
+        data = self.get_statistics_range(base, base + timedelta(hours=48), "day")
+        series = [bucket["transactions"] for bucket in data["series"]]
+        self.assertEqual(series, [5, 1])
+        self.assertEqual(data["transactions"], 6)
+        self.assertEqual(data["profit"], "0.60000000")
+
+        start = base + timedelta(minutes=30)
+        data = self.get_statistics_range(start, start + timedelta(hours=3), "hour")
+        series = [bucket["transactions"] for bucket in data["series"]]
+        self.assertEqual(series, [0, 2, 3, 0])
+        self.assertEqual(data["series"][1]["profit"], "0.10000000")
+
+        data = self.get_statistics_range(base, base + timedelta(hours=80), "month")
+        self.assertEqual(data["transactions"], 10)
+
+    def test_statistics_range(self):
+        """
+        Range queries return the same results before and after the
+        statistics are rolled up
+        """
+        Statistics.objects.all().delete()
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        base = today - timedelta(days=3)
+        self.record_statistics_at(base + timedelta(hours=1), 2, "0.1")
+        self.record_statistics_at(base + timedelta(hours=2), 3, "0.2")
+        self.record_statistics_at(base + timedelta(hours=30), 1, "0.3")
+        self.record_statistics_at(base + timedelta(hours=50), 4, "0.4")
+        self.assert_statistics_ranges(base)
+
+        call_command("rollup_statistics", stdout=StringIO())
+        rollups = StatisticsRollup.objects.order_by("hour")
+        first, last = rollups.first(), rollups.last()
+        self.assertEqual(first.hour, base + timedelta(hours=1))
+        self.assertEqual(last.transactions, 10)
+        self.assertEqual(
+            rollups.count(), (last.hour - first.hour) // timedelta(hours=1) + 1
+        )
+        self.assert_statistics_ranges(base)
+
+        call_command("rollup_statistics", "--settle=0", stdout=StringIO())
+        self.assert_statistics_ranges(base)
+
+    def test_statistics_totals_from_rollup(self):
+        Statistics.objects.all().delete()
+        today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.record_statistics_at(today - timedelta(days=2), 2, "0.1")
+        call_command("rollup_statistics", stdout=StringIO())
+        # Hourly rows before the last prefix sum are not read again
+        Statistics.objects.update(transactions=0, profit=0)
+        self.record_statistics_at(timezone.now(), 3, "0.2")
+        self.set_api_credentials({"token": settings.PLATFORM_ADMIN_TOKEN})
+        response = self.client.get(self.url)
+        self.assertEqual(response.data["transactions"], 5)
+        self.assertEqual(response.data["profit"], "0.30000000")
+
+    def test_statistics_invalid_range(self):
+        self.set_api_credentials({"token": settings.PLATFORM_ADMIN_TOKEN})
+        start, end = "2020-01-01T00:00Z", "2020-01-02T00:00Z"
+        for query in [
+            {"from": end, "to": start},
+            {"from": start},
+            {"from": "2000-01-01T00:00Z", "to": end},
+            {"from": start, "to": end, "granularity": "week"},
+        ]:
+            response = self.client.get(self.url, data=query)
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_400_BAD_REQUEST,
+                "Expected Response Code 400, received {0} instead.".format(
+                    response.status_code
+                ),
+            )
+
+    def test_statistics_platform_with_invalid_token(self):
+        response = self.client.get(self.url, format="json")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_403_FORBIDDEN,
+            "Expected Response Code 403, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+
+class TestUserCreateView(APITestCase):
+    url = reverse("user-create")
+
+    valid_payload = {
+        "username": "davidn04",
+        "email": "david@snow.com",
+        "password": "the_password",
+    }
+    invalid_payload = {
+        "username": "davidn04",
+        "email": "david@snow.com",
+    }
+
+    def test_valid_user_payload(self):
+        """
+        Tests create a new user with a valid user's definition.
+        """
+        response = self.client.post(self.url, data=self.valid_payload, format="json")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_201_CREATED,
+            "Expected Response Code 201, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+    def test_valid_token_response(self):
+        """
+        Test a valid token is returned after user creation.
+        """
+        pass
+
+    def test_invalid_user_payload(self):
+        """
+        Tests create a new user with a invalid user's definition must fail.
+        """
+        response = self.client.post(self.url, data=self.invalid_payload, format="json")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_400_BAD_REQUEST,
+            "Expected Response Code 400, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+    def test_invalid_duplicate_username(self):
+        """
+        Tests usernames must be unique.
+        """
+        self.client.post(self.url, data=self.valid_payload, format="json")
+        response = self.client.post(self.url, data=self.valid_payload, format="json")
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_400_BAD_REQUEST,
+            "Expected Response Code 400, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+
+class TestProvisionAccounts(APITestCase):
+    """
+    Test bulk provisioning of users, tokens and wallets
+    """
+
+    def provision(self, content, suffix, *args):
+        with tempfile.NamedTemporaryFile("w", suffix=suffix) as stream:
+            stream.write(content)
+            stream.flush()
+            out, err = StringIO(), StringIO()
+            call_command(
+                "provision_accounts",
+                stream.name,
+                "--workers=1",
+                *args,
+                stdout=out,
+                stderr=err,
+            )
+        return list(csv.DictReader(StringIO(out.getvalue()))), err.getvalue()
+
+    def test_provision_csv(self):
+        accounts, err = self.provision(
+            "username,password,alias\n"
+            "alice,secret-a,Savings\n"
+            "bob,secret-b,\n"
+            "alice,secret-c,\n"
+            ",secret-d,\n",
+            ".csv",
+            "--chunk-size=2",
+        )
+        self.assertEqual([account["username"] for account in accounts], ["alice", "bob"])
+        self.assertIn("Provisioned 2 account(s), skipped 2.", err)
+
+        alice = accounts[0]
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + alice["token"])
+        response = self.client.get(reverse("wallet-create"))
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            "Expected Response Code 200, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        self.assertEqual(str(response.data[0]["address"]), alice["address"])
+        self.assertEqual(response.data[0]["alias"], "Savings")
+        self.assertEqual(response.data[0]["balance"]["btc"], "1.00000000")
+        self.assertTrue(User.objects.get(username="bob").check_password("secret-b"))
+
+        wallet = Wallet.objects.get(address=accounts[1]["address"])
+        self.assertEqual(wallet.alias, accounts[1]["address"])
+        self.assertEqual(wallet.balance_btc, wallet.ledger_balance_btc())
+        # Platform funds and the 2 grants
+        self.assertEqual(
+            Statistics.objects.aggregate(total=Sum("transactions"))["total"], 3
+        )
+
+    def test_provision_ndjson(self):
+        User.objects.create_user(username="carol")
+        accounts, err = self.provision(
+            '{"username": "carol", "password": "secret"}\n'
+            '{"username": "dave", "password": "secret"}\n',
+            ".ndjson",
+        )
+        self.assertEqual([account["username"] for account in accounts], ["dave"])
+        self.assertIn("Skipped carol: A user with that username already exists.", err)
+
+    def test_grants_minted_beyond_platform_funds(self):
+        with override_settings(PLATFORM_INITIAL_FUNDS="1"):
+            accounts, _ = self.provision(
+                "username,password\nerin,secret\nfrank,secret\n", ".csv"
+            )
+        self.assertEqual(len(accounts), 2)
+        platform_wallet = Wallet.objects.get(address=settings.PLATFORM_WALLET_ADDRESS)
+        balance = platform_wallet.balance_btc + platform_wallet.accrued_balance_btc()
+        self.assertEqual(balance, Decimal("-1"))
+        self.assertEqual(balance, platform_wallet.ledger_balance_btc())
+
+
+class TestRates(APITestCase):
+    """
+    Test BTC rates are cached, not the converted amounts
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_rate_is_cached_per_currency(self):
+        with mock.patch.object(Rates, "api_call", return_value=API_RATES) as api_call:
+            self.assertEqual(Rates.bitcoins_to_usd(Decimal("1")), Decimal("11661.17"))
+            self.assertEqual(Rates.bitcoins_to_usd(Decimal("0.5")), Decimal("5830.58"))
+        self.assertEqual(api_call.call_count, 1)
+        rate = Rates.get_rate("usd")
+        self.assertEqual(rate.value, Decimal("11661.17"))
+        self.assertEqual(rate.source, Rates.API_URL)
+        self.assertEqual(Rates.get_rate("eur").value, Decimal("9876.54"))
+        self.assertIsNone(Rates.get_rate("xyz"))
+        self.assertTrue(rate.is_fresh())
+
+    def test_stale_rate_fallback(self):
+        with mock.patch.object(Rates, "api_call", return_value=API_RATES):
+            Rates.get_rate("usd")
+        failing_api = mock.patch.object(Rates, "api_call", side_effect=Exception)
+        with failing_api as api_call:
+            rate = Rates.get_rate("usd", max_age=0, wait=True)
+            self.assertEqual(api_call.call_count, 1)
+            self.assertFalse(rate.is_fresh(max_age=-1))
+            self.assertEqual(
+                Rates.convert(Rates.get_rates(0, wait=True), "usd", Decimal("2")),
+                Decimal("23322.34"),
+            )
+            self.assertEqual(
+                Rates.convert(Rates.get_rates(0, wait=True), "usd", 2, max_stale=-1),
+                Rates.API_NOT_AVAILABLE,
+            )
+
+    def test_stale_rate_refreshed_in_background(self):
+        with mock.patch.object(Rates, "api_call", return_value=API_RATES):
+            Rates.get_rates()
+        refresh = mock.patch.object(Rates, "refresh_rates_in_background")
+        api = mock.patch.object(Rates, "api_call", side_effect=Exception)
+        with refresh as refresh_in_background, api as api_call:
+            self.assertEqual(
+                Rates.bitcoins_to_currency("usd", Decimal("2"), max_age=0),
+                Decimal("23322.34"),
+            )
+        refresh_in_background.assert_called_once_with()
+        self.assertEqual(api_call.call_count, 0)
+
+    def test_failure_is_cached_when_no_rates(self):
+        with mock.patch.object(Rates, "api_call", side_effect=Exception) as api_call:
+            for _ in range(3):
+                self.assertEqual(
+                    Rates.bitcoins_to_usd(Decimal("1")), Rates.API_NOT_AVAILABLE
+                )
+        self.assertEqual(api_call.call_count, 1)
+        cache.delete(Rates.FAILURE_KEY)
+        with mock.patch.object(Rates, "api_call", return_value=API_RATES):
+            self.assertEqual(Rates.bitcoins_to_usd(Decimal("1")), Decimal("11661.17"))
+
+    def test_rates_are_fetched_once_when_no_rates(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_api_call():
+            started.set()
+            release.wait(5)
+            return API_RATES
+
+        # The threads can't share the test database, the rates use a local cache
+        local_cache = LocMemCache("rates", {})
+        api = mock.patch.object(Rates, "api_call", side_effect=slow_api_call)
+        with api as api_call, mock.patch("api.utils.rates.cache", local_cache):
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                first = executor.submit(Rates.get_rates)
+                started.wait(5)
+                others = [executor.submit(Rates.get_rates) for _ in range(2)]
+                release.set()
+                tables = [future.result() for future in [first] + others]
+        self.assertEqual(api_call.call_count, 1)
+        usd_rates = {table.rates["usd"] for table in tables}
+        self.assertEqual(usd_rates, {Decimal("11661.17")})
+
+    def test_expired_rates_are_kept(self):
+        with mock.patch.object(Rates, "api_call", return_value=API_RATES):
+            Rates.get_rates()
+        refresh = mock.patch.object(Rates, "refresh_rates_in_background")
+        with refresh as refresh_in_background, override_settings(RATES_MAX_STALE=0):
+            self.assertEqual(
+                Rates.bitcoins_to_currency("usd", Decimal("1"), max_age=-1),
+                Rates.API_NOT_AVAILABLE,
+            )
+        refresh_in_background.assert_called_once_with()
+
+
+class TestCachedTokenAuthentication(APITestBaseView):
+    """
+    Test authenticated tokens are cached and evicted
+    """
+
+    url = reverse("wallet-create")
+
+    def test_token_is_cached(self):
+        self.client.get(self.url)
+        hits = metrics.TOKEN_CACHE.snapshot().get('["hit"]', 0)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(metrics.TOKEN_CACHE.snapshot()['["hit"]'], hits + 1)
+
+    def test_deleted_token_is_evicted(self):
+        self.client.get(self.url)
+        Token.objects.filter(key=self.token["token"]).delete()
+        response = self.client.get(self.url)
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_401_UNAUTHORIZED,
+            "Expected Response Code 401, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+    def test_deactivated_user_is_evicted(self):
+        self.client.get(self.url)
+        user = Token.objects.get(key=self.token["token"]).user
+        user.is_active = False
+        user.save()
+        response = self.client.get(self.url)
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_401_UNAUTHORIZED,
+            "Expected Response Code 401, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+    def test_bulk_deactivated_user_expires(self):
+        self.client.get(self.url)
+        # Bulk updates send no signal, the cached token expires
+        User.objects.filter(auth_token__key=self.token["token"]).update(
+            is_active=False
+        )
+        later = time.monotonic() + settings.TOKEN_CACHE_TIMEOUT + 1
+        with mock.patch("api.utils.cache.time.monotonic", return_value=later):
+            response = self.client.get(self.url)
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_401_UNAUTHORIZED,
+            "Expected Response Code 401, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+
+    @override_settings(PLATFORM_ADMIN_TOKEN="admin-token")
+    def test_admin_token_constant_time_comparison(self):
+        url = reverse("statistics")
+        self.client.credentials(HTTP_AUTHORIZATION="Token admin-token")
+        with mock.patch("hmac.compare_digest", wraps=hmac.compare_digest) as compare:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        compare.assert_called_once_with(b"admin-token", b"admin-token")
+        self.client.credentials(HTTP_AUTHORIZATION="Token admin-tokem")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TestMetrics(APITestBaseView):
+    def transfers(self, outcome):
+        key = json.dumps([Transaction.SENT_INTERNAL, outcome])
+        return metrics.TRANSFERS.snapshot().get(key, 0)
+
+    @override_settings(PLATFORM_ADMIN_TOKEN="admin-token")
+    def test_metrics(self):
+        wallets = [
+            self.client.post(reverse("wallet-create"), {}, format="json").data
+            for _ in range(2)
+        ]
+        wallet_from, wallet_to = Wallet.objects.filter(
+            address__in=[wallet["address"] for wallet in wallets]
+        )
+        successes = self.transfers("success")
+        insufficient = self.transfers("insufficient_funds")
+        Wallet.transfer(
+            wallet_from, wallet_to, Transaction.SENT_INTERNAL, Decimal("0.1"), ""
+        )
+        with self.assertRaises(InsufficientFundsError):
+            Wallet.transfer(
+                wallet_from, wallet_to, Transaction.SENT_INTERNAL, Decimal("10"), ""
+            )
+        self.assertEqual(self.transfers("success"), successes + 1)
+        self.assertEqual(self.transfers("insufficient_funds"), insufficient + 1)
+
+        # Batch transfers are counted per item
+        rolled_back = self.transfers("rolled_back")
+        internal = {
+            "wallet_from": wallet_from,
+            "wallet_to": wallet_to,
+            "transaction_type": Transaction.SENT_INTERNAL,
+        }
+        Wallet.transfer_batch(
+            [
+                {**internal, "amount": Decimal("0.1")},
+                {**internal, "amount": Decimal("10")},
+            ],
+            atomic=True,
+        )
+        Wallet.transfer_batch([{**internal, "amount": Decimal("0.1")}])
+        self.assertEqual(self.transfers("success"), successes + 2)
+        self.assertEqual(self.transfers("insufficient_funds"), insufficient + 2)
+        self.assertEqual(self.transfers("rolled_back"), rolled_back + 1)
+
+        url = reverse("metrics")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.credentials(HTTP_AUTHORIZATION="Token admin-token")
+        response = self.client.get(url)
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_200_OK,
+            "Expected Response Code 200, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        lines = response.content.decode().splitlines()
+        self.assertIn(
+            'btcwallet_transfers_total{transaction_type="sent_internal",'
+            f'outcome="success"}} {successes + 2}',
+            lines,
+        )
+        self.assertIn(
+            'btcwallet_request_duration_seconds_bucket{view="wallet-create",'
+            'method="POST",le="+Inf"}',
+            "\n".join(lines),
+        )
+        self.assertIn("# TYPE btcwallet_statistics_write_seconds histogram", lines)
+        self.assertIn("# TYPE btcwallet_rates_cache_hit_ratio gauge", lines)
+        self.assertIn("# TYPE btcwallet_token_cache_hit_ratio gauge", lines)
+
+    def test_metrics_summed_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            other_worker = {
+                metrics.TRANSFERS.name: {'["platform", "success"]': 5},
+                metrics.STATISTICS_WRITE.name: {"[]": [1] + [0] * 10 + [0.0004]},
+            }
+            with open(os.path.join(directory, "1.json"), "w") as f:
+                json.dump(other_worker, f)
+            with override_settings(METRICS_DIR=directory):
+                local = metrics.snapshot()
+                values = metrics.collect()
+                self.assertTrue(
+                    os.path.exists(os.path.join(directory, f"{os.getpid()}.json"))
+                )
+        key = '["platform", "success"]'
+        self.assertEqual(
+            values[metrics.TRANSFERS.name][key],
+            local[metrics.TRANSFERS.name].get(key, 0) + 5,
+        )
+        local_writes = local[metrics.STATISTICS_WRITE.name].get("[]", [0] * 12)
+        self.assertEqual(
+            values[metrics.STATISTICS_WRITE.name]["[]"][0], local_writes[0] + 1
+        )
+
+
+class TestTieredCache(APITestCase):
+    """
+    Test the in-process tier in front of the shared database cache
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_local_tier_hit_skips_shared_cache(self):
+        cache.set("key", "value")
+        hits = cache.stats()["local"]["hits"]
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get("key"), "value")
+        self.assertEqual(cache.stats()["local"]["hits"], hits + 1)
+
+    def test_shared_tier_fills_local_tier(self):
+        caches["shared"].set("key", "value")
+        misses = cache.stats()["shared"]["misses"]
+        self.assertEqual(cache.get("key"), "value")
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get("key"), "value")
+        self.assertIsNone(cache.get("missing"))
+        self.assertEqual(cache.stats()["shared"]["misses"], misses + 1)
+
+    def test_has_key_is_one_cache_call(self):
+        cache.set("key", "value")
+        with instrumentation.collect() as collected:
+            self.assertTrue(cache.has_key("key"))
+            self.assertFalse(cache.has_key("missing"))
+        self.assertEqual(collected.counts["cache"], 2)
+
+    def test_delete_from_both_tiers(self):
+        cache.set("key", "value")
+        cache.delete("key")
+        self.assertIsNone(cache.get("key"))
+        self.assertIsNone(caches["shared"].get("key"))
+
+    def test_local_tier_is_bounded(self):
+        for i in range(cache.local.max_entries + 10):
+            cache.local.set(i, i)
+        self.assertEqual(len(cache.local), cache.local.max_entries)
+        self.assertIsNone(cache.local.get(0))
+
+
+class TestPlatformWallet(APITestCase):
+    """
+    Test the platform wallet is funded once and memoized after commit
+    """
+
+    def setUp(self):
+        self.addCleanup(clear_platform_wallet_cache)
+        # Run on_commit callbacks right away, as if the test transaction committed
+        on_commit = mock.patch.object(transaction, "on_commit", lambda func: func())
+        on_commit.start()
+        self.addCleanup(on_commit.stop)
+
+    def test_funded_once(self):
+        get_platform_wallet()
+        clear_platform_wallet_cache()
+        platform_wallet = get_platform_wallet()
+        grants = Transaction.objects.filter(
+            wallet_to=platform_wallet, details="Initial funds"
+        )
+        self.assertEqual(grants.count(), 1)
+        platform_wallet.refresh_from_db(fields=["balance_btc"])
+        self.assertEqual(
+            platform_wallet.balance_btc, Decimal(settings.PLATFORM_INITIAL_FUNDS)
+        )
+
+    def test_grants_minted_without_funds(self):
+        platform_wallet = get_platform_wallet()
+        Wallet.objects.filter(pk=platform_wallet.pk).update(balance_btc=0)
+        token = self.client.post(
+            reverse("user-create"), {"username": "userA", "password": "passA"}
+        ).data
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token["token"])
+        for mode in (Wallet.PESSIMISTIC, Wallet.OPTIMISTIC):
+            with override_settings(WALLET_TRANSFER_MODE=mode):
+                response = self.client.post(reverse("wallet-create"), {}, format="json")
+            self.assertEqual(
+                response.status_code,
+                status.HTTP_201_CREATED,
+                "Expected Response Code 201, received {0} instead.".format(
+                    response.status_code
+                ),
+            )
+        # Grants are accrued on the platform balance shards
+        platform_wallet.refresh_from_db(fields=["balance_btc"])
+        self.assertEqual(
+            platform_wallet.balance_btc + platform_wallet.accrued_balance_btc(),
+            Decimal("-2"),
+        )
+
+        # Only the platform wallet mints
+        wallet = Wallet.objects.get(address=response.data["address"])
+        with self.assertRaises(InsufficientFundsError):
+            Wallet.transfer(
+                wallet, platform_wallet, Transaction.PLATFORM, Decimal("5"), ""
+            )
+
+    def test_memoized(self):
+        platform_wallet = get_platform_wallet()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_platform_wallet().pk, platform_wallet.pk)
+
+    def test_invalidated_on_delete(self):
+        platform_wallet = get_platform_wallet()
+        Transaction.objects.filter(wallet_to=platform_wallet).delete()
+        platform_wallet.delete()
+        platform_wallet = get_platform_wallet()
+        self.assertTrue(Wallet.objects.filter(pk=platform_wallet.pk).exists())
+
+
+@skipUnless("replica" in settings.DATABASES, "Requires DATABASE_LOCAL_REPLICA")
+@override_settings(DATABASE_REPLICAS=["replica"])
+class TestReplicaRouting(APITransactionTestCase):
+    """
+    Test reads of read-only views go to the replica (a second connection to
+    the test database) unless the user recently wrote
+    """
+
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.addCleanup(clear_platform_wallet_cache)
+        self.addCleanup(cache.clear)
+        token = self.client.post(
+            reverse("user-create"), {"username": "userA", "password": "passA"}
+        ).data
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token["token"])
+        self.user = User.objects.get(username="userA")
+        self.wallets = [
+            self.client.post(reverse("wallet-create"), {}, format="json").data[
+                "address"
+            ]
+            for _ in range(2)
+        ]
+        self.url = reverse("transaction-detail", kwargs={"address": self.wallets[0]})
+
+    def replica_queries(self, method, url, **kwargs):
+        with CaptureQueriesContext(connections["replica"]) as queries:
+            response = method(url, **kwargs)
+        self.assertLess(
+            response.status_code,
+            status.HTTP_400_BAD_REQUEST,
+            "Expected a successful response, received {0} instead.".format(
+                response.status_code
+            ),
+        )
+        return len(queries)
+
+    def forget_writes(self):
+        del self.client.cookies[STICKY_COOKIE]
+        cache.delete(STICKY_KEY.format(self.user.pk))
+
+    def test_reads_go_to_replica(self):
+        self.forget_writes()
+        self.assertGreater(self.replica_queries(self.client.get, self.url), 0)
+        response = self.client.get(reverse("transaction-list"))
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def test_sticky_after_write(self):
+        # Creating the wallets made the user sticky
+        cookie = self.client.cookies[STICKY_COOKIE]
+        self.assertEqual(cookie["max-age"], settings.REPLICA_STICKY_SECONDS)
+        self.assertEqual(self.replica_queries(self.client.get, self.url), 0)
+        # Other clients of the user (e.g. without cookies) are sticky too
+        del self.client.cookies[STICKY_COOKIE]
+        self.assertEqual(self.replica_queries(self.client.get, self.url), 0)
+        cache.delete(STICKY_KEY.format(self.user.pk))
+        self.assertGreater(self.replica_queries(self.client.get, self.url), 0)
+
+    def test_tampered_sticky_cookie_ignored(self):
+        self.forget_writes()
+        self.client.cookies[STICKY_COOKIE] = str(self.user.pk)
+        self.assertGreater(self.replica_queries(self.client.get, self.url), 0)
+
+    def test_writes_go_to_primary(self):
+        self.forget_writes()
+        transfer = {
+            "wallet_from": self.wallets[0],
+            "wallet_to": self.wallets[1],
+            "transaction_type": Transaction.SENT_INTERNAL,
+            "amount": Decimal(settings.PLATFORM_TRANSACTION_LIMITS),
+        }
+        queries = self.replica_queries(
+            self.client.post, reverse("transaction-list"), data=transfer, format="json"
+        )
+        self.assertEqual(queries, 0)
+        self.assertIn(STICKY_COOKIE, self.client.cookies)
+        self.assertIsNotNone(cache.get(STICKY_KEY.format(self.user.pk)))
+
+    def test_router_outside_of_requests(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Wallet))
+        self.assertEqual(router.db_for_write(Wallet), "default")
+        self.assertFalse(router.allow_migrate("replica", "api"))
+        self.assertTrue(router.allow_migrate("default", "api"))
+
+
+@override_settings(STATISTICS_SHARDS=1, PLATFORM_BALANCE_SHARDS=1)
+class TestQueryBudgets(TestTransactionCreateListView):
+    """
+    Pins the maximum number of SQL queries executed by each endpoint, for
+    both the success and the validation failure paths. Lower a budget when
+    an endpoint gets cheaper; never raise one without a good reason.
+    Statistics use a single shard, so its row exists after setUp.
+    """
+
+    url_transaction = reverse("transaction-list")
+
+    def setUp(self):
+        super().setUp()
+        # Stub the rates API and warm the cache, so the budgets don't
+        # depend on the network.
+        patcher = mock.patch.object(Rates, "api_call", return_value=API_RATES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        Rates.bitcoins_to_usd(Decimal("1"))
+        # Memoize the platform wallet as if the test transaction was committed
+        with mock.patch.object(transaction, "on_commit", lambda func: func()):
+            get_platform_wallet()
+        self.addCleanup(clear_platform_wallet_cache)
+
+    def assertMaxQueries(self, budget, func, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            response = func(*args, **kwargs)
+        executed = "\n".join(query["sql"] for query in context.captured_queries)
+        self.assertLessEqual(
+            len(context),
+            budget,
+            "Expected at most {0} queries, executed {1} instead:\n{2}".format(
+                budget, len(context), executed
+            ),
+        )
+        return response
+
+    def test_user_create(self):
+        url = reverse("user-create")
+        payload = {"username": "userC", "password": "passC"}
+        response = self.assertMaxQueries(3, self.client.post, url, payload)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        payload = {"username": "userD"}
+        response = self.assertMaxQueries(1, self.client.post, url, payload)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_wallet_create(self):
+        url = reverse("wallet-create")
+        response = self.assertMaxQueries(14, self.client.post, url, {}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        payload = {"alias": self.wallet_1_user_A}
+        response = self.assertMaxQueries(4, self.client.post, url, payload)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_wallet_list(self):
+        url = reverse("wallet-create")
+        response = self.assertMaxQueries(1, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+
+    def test_wallet_detail(self):
+        url = reverse("wallet-detail", kwargs={"address": self.wallet_1_user_A})
+        response = self.assertMaxQueries(1, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        url = reverse("wallet-detail", kwargs={"address": self.wallet_1_user_B})
+        response = self.assertMaxQueries(1, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_wallet_balance(self):
+        url = reverse("wallet-balance", kwargs={"address": self.wallet_1_user_A})
+        query = {"at": "2020-01-01T00:00Z"}
+        response = self.assertMaxQueries(4, self.client.get, url, query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.assertMaxQueries(1, self.client.get, url, {"at": "invalid"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_transaction_list(self):
+        url = reverse("transaction-list")
+        # The wallets of the user, then one query per wallet and direction
+        response = self.assertMaxQueries(5, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.assertMaxQueries(0, self.client.get, url, {"cursor": "x"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_transaction_create(self):
+        response = self.assertMaxQueries(8, self.transfer_to_iternal_address)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.assertMaxQueries(11, self.transfer_to_external_address)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        transaction = {
+            "wallet_from": self.wallet_1_user_A,
+            "wallet_to": self.wallet_1_user_B,
+            "transaction_type": Transaction.SENT_EXTERNAL,
+            "amount": Decimal("50"),
+        }
+        response = self.assertMaxQueries(
+            1, self.client.post, self.url_transaction, transaction, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_transaction_detail(self):
+        url = reverse("transaction-detail", kwargs={"address": self.wallet_1_user_A})
+        response = self.assertMaxQueries(3, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        url = reverse("transaction-detail", kwargs={"address": self.wallet_1_user_B})
+        response = self.assertMaxQueries(1, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_statistics(self):
+        url = reverse("statistics")
+        response = self.assertMaxQueries(0, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.set_api_credentials({"token": settings.PLATFORM_ADMIN_TOKEN})
+        # The last prefix sum, then the hourly rows after it
+        response = self.assertMaxQueries(2, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_transaction_batch(self):
+        url = reverse("transaction-batch")
+        transfers = [
+            {
+                "wallet_from": self.wallet_1_user_A,
+                "wallet_to": wallet_to,
+                "transaction_type": transaction_type,
+                "amount": "0.1",
+            }
+            for wallet_to, transaction_type in (
+                (self.wallet_2_user_A, Transaction.SENT_INTERNAL),
+                (self.wallet_1_user_B, Transaction.SENT_EXTERNAL),
+            )
+        ]
+        batch = {"transfers": transfers}
+        response = self.assertMaxQueries(8, self.client.post, url, batch, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        batch = {"transfers": [{**transfers[0], "amount": "x"}]}
+        response = self.assertMaxQueries(0, self.client.post, url, batch, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_transaction_export(self):
+        def export(address):
+            url = reverse("transaction-export", kwargs={"address": address})
+            response = self.client.get(url, {"format": "csv"})
+            if response.streaming:
+                b"".join(response.streaming_content)
+            return response
+
+        response = self.assertMaxQueries(3, export, self.wallet_1_user_A)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.assertMaxQueries(1, export, self.wallet_1_user_B)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_metrics(self):
+        url = reverse("metrics")
+        response = self.assertMaxQueries(0, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.set_api_credentials({"token": settings.PLATFORM_ADMIN_TOKEN})
+        response = self.assertMaxQueries(0, self.client.get, url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_every_endpoint_has_a_budget(self):
+        names = [pattern.name for pattern in api_urls.urlpatterns] + ["metrics"]
+        for name in names:
+            self.assertTrue(
+                hasattr(self, "test_" + name.replace("-", "_")),
+                "No query budget for {0}".format(name),
+            )
+
+    @skipUnless(connection.vendor == "postgresql", "Requires PostgreSQL")
+    def test_transaction_lists_use_index_scans(self):
+        """
+        Every query on the transactions table done by the list endpoints
+        must be answered using an index
+        """
+        with connection.cursor() as cursor:
+            # Tables are tiny in tests, don't let the planner pick a seq scan
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        urls = [
+            reverse("transaction-list"),
+            reverse("transaction-detail", kwargs={"address": self.wallet_1_user_A}),
+        ]
+        for url in urls:
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(url)
+            for query in context.captured_queries:
+                if 'FROM "api_transaction"' not in query["sql"]:
+                    continue
+                with connection.cursor() as cursor:
+                    cursor.execute("EXPLAIN " + query["sql"])
+                    plan = "\n".join(row[0] for row in cursor.fetchall())
+                self.assertNotIn("Seq Scan on api_transaction", plan, plan)
+                self.assertIn("Index", plan, plan)
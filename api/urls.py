@@ -3,8 +3,11 @@ from .views import (
     UserCreateView,
     WalletCreateView,
     WalletDetailView,
+    WalletBalanceView,
     TransactionCreateListView,
+    TransactionBatchView,
     TransactionDetailView,
+    TransactionExportView,
     StatisticsView,
 )
 
@@ -12,11 +15,26 @@ urlpatterns = [
     path("users/", UserCreateView.as_view(), name="user-create"),
     path("wallets/", WalletCreateView.as_view(), name="wallet-create"),
     path("wallets/<str:address>", WalletDetailView.as_view(), name="wallet-detail"),
+    path(
+        "wallets/<str:address>/balance",
+        WalletBalanceView.as_view(),
+        name="wallet-balance",
+    ),
     path(
         "wallets/<str:address>/transactions/",
         TransactionDetailView.as_view(),
         name="transaction-detail",
     ),
+    path(
+        "wallets/<str:address>/transactions/export",
+        TransactionExportView.as_view(),
+        name="transaction-export",
+    ),
     path("transactions/", TransactionCreateListView.as_view(), name="transaction-list"),
+    path(
+        "transactions/batch",
+        TransactionBatchView.as_view(),
+        name="transaction-batch",
+    ),
     path("statistics/", StatisticsView.as_view(), name="statistics"),
 ]
@@ -1,10 +1,53 @@
+import hmac
+
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.utils.translation import gettext_lazy as _
 
-from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.authentication import (
+    BaseAuthentication,
+    TokenAuthentication,
+    get_authorization_header,
+)
 from rest_framework import exceptions
 
+from .cache import LRUCache
+from .metrics import TOKEN_CACHE
+
+# Process wide token -> (user, token) cache, see CachedTokenAuthentication
+_token_cache = LRUCache(
+    max_entries=settings.TOKEN_CACHE_MAX_ENTRIES, timeout=settings.TOKEN_CACHE_TIMEOUT
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    DRF token authentication that keeps the authenticated tokens (and their
+    users) in a bounded in-process cache for TOKEN_CACHE_TIMEOUT seconds,
+    so most requests don't query the token and user tables.
+    Tokens are evicted when they are deleted or their user is deactivated
+    (see api.signals). Other processes keep using a cached token until it
+    expires, so the timeout is short (5 seconds by default). Cached users
+    deactivated in process are checked again against the database.
+    """
+
+    cache = _token_cache
+
+    def authenticate_credentials(self, key):
+        cached = self.cache.get(key)
+        if cached is not None and cached[0].is_active:
+            TOKEN_CACHE.inc(result="hit")
+            return cached
+        TOKEN_CACHE.inc(result="miss")
+        user, token = super().authenticate_credentials(key)
+        self.cache.set(key, (user, token))
+        return (user, token)
+
+    @classmethod
+    def invalidate(cls, *keys):
+        for key in keys:
+            cls.cache.delete(key)
+
 
 class TokenAdminAuthentication(BaseAuthentication):
     """
@@ -34,7 +77,9 @@ class TokenAdminAuthentication(BaseAuthentication):
                 "Invalid token header. Token string should not contain invalid characters."
             )
             raise exceptions.AuthenticationFailed(msg)
-        if token == settings.PLATFORM_ADMIN_TOKEN:
+        admin_token = settings.PLATFORM_ADMIN_TOKEN or ""
+        # Constant time comparison, so the token can't be guessed from timings
+        if admin_token and hmac.compare_digest(token.encode(), admin_token.encode()):
             return (AnonymousUser, None)
         else:
             raise exceptions.AuthenticationFailed(_("Invalid token."))
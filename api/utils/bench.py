@@ -0,0 +1,112 @@
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection, connections
+
+from api.models import clear_platform_wallet_cache
+
+
+def percentile(values, percent):
+    """
+    Returns the given percentile of values (nearest rank method), or None
+    if there are no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def run_concurrently(func, threads, calls):
+    """
+    Calls func(index) calls times, from the given number of threads.
+    Returns the latency of each successful call (seconds), the number of
+    failed calls and the elapsed time. With a single thread calls are
+    made from the current thread.
+    """
+    latencies = []
+    errors = []
+    indexes = iter(range(calls))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            start = time.perf_counter()
+            try:
+                func(index)
+            except Exception as exc:
+                errors.append(exc)
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    def thread_worker():
+        try:
+            worker()
+        finally:
+            # Each thread has its own database connections
+            connections.close_all()
+
+    start = time.perf_counter()
+    if threads == 1:
+        worker()
+    else:
+        workers = [threading.Thread(target=thread_worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    return latencies, len(errors), time.perf_counter() - start
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Returns throughput (successful calls per second) and latency
+    percentiles (milliseconds) of a run_concurrently result.
+    """
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 2)
+
+    return {
+        "calls": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50": ms(percentile(latencies, 50)),
+        "p95": ms(percentile(latencies, 95)),
+        "p99": ms(percentile(latencies, 99)),
+        "max": ms(max(latencies, default=None)),
+    }
+
+
+@contextmanager
+def test_database(keepdb=False):
+    """
+    Creates the test database of the default connection like the test
+    runner does, and destroys it on exit unless keepdb is True. SQLite
+    uses a file, in-memory databases are not shared between threads.
+    """
+    old_name = connection.settings_dict["NAME"]
+    test_settings = connection.settings_dict["TEST"]
+    if connection.vendor == "sqlite" and not test_settings.get("NAME"):
+        test_settings["NAME"] = os.path.join(
+            tempfile.gettempdir(), "btcwallet_bench.sqlite3"
+        )
+    connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb
+    )
+    clear_platform_wallet_cache()
+    try:
+        yield
+    finally:
+        clear_platform_wallet_cache()
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
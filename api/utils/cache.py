@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from api.utils.instrumentation import instrumented
+
+_MISSING = object()
+
+# Django creates cache backends per thread, local tiers are shared by
+# all the threads of the process.
+_local_tiers = {}
+_local_tiers_lock = threading.Lock()
+
+
+class LRUCache:
+    """
+    Bounded in-process cache. Least recently used entries are evicted when
+    max_entries is reached, and every entry expires after timeout seconds.
+    Keeps hit/miss counters. Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries=1000, timeout=5):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        # Counters of the next tier, updated by TieredCache
+        self.next_hits = 0
+        self.next_misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def count_next(self, hit):
+        """
+        Counts a hit or a miss of the next tier.
+        """
+        with self._lock:
+            if hit:
+                self.next_hits += 1
+            else:
+                self.next_misses += 1
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+
+class TieredCache(BaseCache):
+    """
+    Two tier cache backend. A small in-process LRU with a short timeout
+    sits in front of a shared cache (e.g. the database cache), so hot keys
+    don't need a round trip to the shared cache on every read.
+    LOCATION is the alias of the shared cache. Options:
+        - MAX_ENTRIES: max entries of the local tier (default 1000)
+        - LOCAL_TIMEOUT: seconds an entry lives in the local tier (default 5)
+    Other processes only see changes to a key once it expires locally.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._shared_alias = location
+        with _local_tiers_lock:
+            if location not in _local_tiers:
+                _local_tiers[location] = LRUCache(
+                    max_entries=self._max_entries,
+                    timeout=options.get("LOCAL_TIMEOUT", 5),
+                )
+        self.local = _local_tiers[location]
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def get_local_timeout(self, timeout):
+        if timeout is DEFAULT_TIMEOUT or timeout is None:
+            return self.local.timeout
+        return min(timeout, self.local.timeout)
+
+    @instrumented("cache")
+    def get(self, key, default=None, version=None):
+        local_key = (key, version)
+        value = self.local.get(local_key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = self.shared.get(key, _MISSING, version=version)
+        self.local.count_next(value is not _MISSING)
+        if value is _MISSING:
+            return default
+        self.local.set(local_key, value)
+        return value
+
+    @instrumented("cache")
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout=timeout, version=version)
+        local_timeout = self.get_local_timeout(timeout)
+        if local_timeout <= 0:
+            self.local.delete((key, version))
+        else:
+            self.local.set((key, version), value, local_timeout)
+
+    @instrumented("cache")
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout=timeout, version=version)
+        local_timeout = self.get_local_timeout(timeout)
+        if added and local_timeout > 0:
+            self.local.set((key, version), value, local_timeout)
+        return added
+
+    @instrumented("cache")
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout=timeout, version=version)
+
+    @instrumented("cache")
+    def delete(self, key, version=None):
+        self.local.delete((key, version))
+        return self.shared.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    @instrumented("cache")
+    def incr(self, key, delta=1, version=None):
+        self.local.delete((key, version))
+        return self.shared.incr(key, delta, version=version)
+
+    @instrumented("cache")
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def stats(self):
+        """
+        Returns hit/miss counters of both tiers.
+        """
+        return {
+            "local": self.local.stats(),
+            "shared": {"hits": self.local.next_hits, "misses": self.local.next_misses},
+        }
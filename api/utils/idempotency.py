@@ -0,0 +1,132 @@
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from api.models import IdempotencyKey
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKeyInProgress(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = _("A request with this Idempotency-Key is being processed.")
+    default_code = "idempotency_key_in_progress"
+
+
+class IdempotencyKeyMismatch(exceptions.APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = _("Idempotency-Key was already used with a different request.")
+    default_code = "idempotency_key_mismatch"
+
+
+def request_hash(request):
+    """
+    Returns a fingerprint of the request method, path and body.
+    """
+    body = json.dumps(request.data, cls=JSONEncoder, sort_keys=True)
+    fingerprint = f"{request.method} {request.path}\n{body}"
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+def claim(user, key, fingerprint):
+    """
+    Claims the key for the current request. Returns the claimed key, or
+    the stored key if it belongs to a completed request.
+    The claim is committed right away (outside of any transaction), so
+    concurrent requests with the same key see it and don't run.
+    """
+    now = timezone.now()
+    stored = IdempotencyKey.objects.filter(user=user, key=key).first()
+    if stored is None:
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    user=user, key=key, request_hash=fingerprint, created_at=now
+                )
+        except IntegrityError:
+            # Claimed by a concurrent request
+            raise IdempotencyKeyInProgress()
+
+    ttl = timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    expired = stored.status_code is not None and stored.created_at < now - ttl
+    if not expired:
+        if stored.request_hash != fingerprint:
+            raise IdempotencyKeyMismatch()
+        if stored.status_code is not None:
+            return stored
+        # A request that never completed was rolled back, and can be retried
+        stale = now - timedelta(seconds=settings.IDEMPOTENCY_CLAIM_TIMEOUT)
+        if stored.created_at >= stale:
+            raise IdempotencyKeyInProgress()
+
+    # Only one of the concurrent requests takes over the key. The request
+    # processing it keeps the row locked, so it's never taken over while
+    # the request is still running.
+    reclaimed = IdempotencyKey.objects.filter(
+        pk=stored.pk, status_code=stored.status_code, created_at=stored.created_at
+    ).update(request_hash=fingerprint, status_code=None, response="", created_at=now)
+    if not reclaimed:
+        raise IdempotencyKeyInProgress()
+    stored.request_hash, stored.created_at = fingerprint, now
+    stored.status_code, stored.response = None, ""
+    return stored
+
+
+def idempotent(method):
+    """
+    Makes a view method idempotent for requests with an Idempotency-Key
+    header. The first request with a key is performed and its response
+    stored (unless it is a server error). Later requests of the same user
+    with the same key and body get the stored response back, until the key
+    expires (IDEMPOTENCY_KEY_TTL). The view and the stored response are
+    committed together.
+    """
+
+    @functools.wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.META.get(HEADER)
+        if not key:
+            return method(view, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            raise exceptions.ValidationError(
+                f"Ensure Idempotency-Key has no more than {MAX_KEY_LENGTH} characters."
+            )
+
+        stored = claim(request.user, key, request_hash(request))
+        if stored.status_code is not None:
+            response = Response(json.loads(stored.response), status=stored.status_code)
+            response["Idempotent-Replayed"] = "true"
+            return response
+
+        completed = False
+        try:
+            with transaction.atomic():
+                # Held until the response is stored, see claim
+                IdempotencyKey.objects.select_for_update().get(pk=stored.pk)
+                try:
+                    response = method(view, request, *args, **kwargs)
+                except exceptions.APIException as exc:
+                    response = view.handle_exception(exc)
+                if response.status_code < 500:
+                    stored.status_code = response.status_code
+                    stored.response = json.dumps(response.data, cls=JSONEncoder)
+                    stored.save(update_fields=["status_code", "response"])
+                    completed = True
+        finally:
+            if not completed:
+                # Let the client retry a request that failed
+                stored.delete()
+        return response
+
+    return wrapper
@@ -0,0 +1,94 @@
+import functools
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+
+# Metrics of the request being processed by the current thread
+_state = threading.local()
+
+
+class RequestMetrics:
+    """
+    Number and duration (seconds) of the SQL queries, cache calls and
+    outbound HTTP calls of a request, and the time spent rendering its
+    response. Calls made while another one is being timed are part of it,
+    e.g. the SQL queries of the database cache count as cache time.
+    """
+
+    CATEGORIES = ("db", "cache", "http")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.CATEGORIES, 0)
+        self.durations = dict.fromkeys(self.CATEGORIES, 0.0)
+        self.render = None
+        self.active = False
+
+    def record(self, category, duration):
+        self.counts[category] += 1
+        self.durations[category] += duration
+
+
+def current_metrics():
+    """
+    Returns the metrics of the request being collected, or None.
+    """
+    return getattr(_state, "metrics", None)
+
+
+@contextmanager
+def timed(category):
+    """
+    Counts and times the block in the metrics of the current request.
+    Does nothing outside of collect, or inside another timed block.
+    """
+    metrics = current_metrics()
+    if metrics is None or metrics.active:
+        yield
+        return
+    metrics.active = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.active = False
+        metrics.record(category, time.perf_counter() - start)
+
+
+def instrumented(category):
+    """
+    Decorator version of timed.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    with timed("db"):
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def collect():
+    """
+    Collects the metrics of the block, which are yielded. SQL queries are
+    timed on all the database connections of the current thread.
+    """
+    metrics = RequestMetrics()
+    _state.metrics = metrics
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(_execute_wrapper))
+            yield metrics
+    finally:
+        _state.metrics = None
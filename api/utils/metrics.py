@@ -0,0 +1,299 @@
+import atexit
+import glob
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets (seconds) of the histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """
+    Base class of the metrics of the process. Values are kept per label
+    values, and exported in the Prometheus text format.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels_key(self, labels):
+        return json.dumps([str(labels[name]) for name in self.labelnames])
+
+    def snapshot(self):
+        with self._lock:
+            return {key: self.copy(value) for key, value in self._values.items()}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def copy(self, value):
+        return value
+
+    def merge(self, value, other):
+        raise NotImplementedError
+
+    def format_labels(self, key, **extra):
+        pairs = list(zip(self.labelnames, json.loads(key))) + list(extra.items())
+        if not pairs:
+            return ""
+        labels = ",".join(
+            '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        return "{" + labels + "}"
+
+    def samples(self, key, value):
+        raise NotImplementedError
+
+    def exposition(self, values):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for key in sorted(values):
+            lines.extend(self.samples(key, values[key]))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        changed()
+
+    def merge(self, value, other):
+        return value + other
+
+    def samples(self, key, value):
+        yield f"{self.name}{self.format_labels(key)} {value}"
+
+
+class Histogram(Metric):
+    """
+    Histogram of observed values. Values are stored as the count of each
+    bucket (not cumulative), followed by their sum.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, **labels):
+        key = self.labels_key(labels)
+        index = next(
+            (i for i, bound in enumerate(self.buckets) if amount <= bound),
+            len(self.buckets),
+        )
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            value[index] += 1
+            value[-1] += amount
+        changed()
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def copy(self, value):
+        return list(value)
+
+    def merge(self, value, other):
+        return [a + b for a, b in zip(value, other)]
+
+    def samples(self, key, value):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(float(bound))
+            yield f"{self.name}_bucket{self.format_labels(key, le=le)} {cumulative}"
+        yield f"{self.name}_sum{self.format_labels(key)} {value[-1]}"
+        yield f"{self.name}_count{self.format_labels(key)} {cumulative}"
+
+
+REGISTRY = []
+
+REQUEST_DURATION = Histogram(
+    "btcwallet_request_duration_seconds",
+    "Latency of the requests, by view (URL name) and method.",
+    ["view", "method"],
+)
+TRANSFERS = Counter(
+    "btcwallet_transfers_total",
+    "Wallet transfers by transaction type and outcome "
+    "(success, insufficient_funds, lock_timeout, rolled_back, error).",
+    ["transaction_type", "outcome"],
+)
+RATES_CACHE = Counter(
+    "btcwallet_rates_cache_total",
+    "Lookups of the cached BTC rates by result (hit, stale, miss).",
+    ["result"],
+)
+TOKEN_CACHE = Counter(
+    "btcwallet_token_cache_total",
+    "Lookups of the cached authentication tokens by result (hit, miss).",
+    ["result"],
+)
+STATISTICS_WRITE = Histogram(
+    "btcwallet_statistics_write_seconds",
+    "Time spent writing the transactions statistics.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+
+
+# Each worker process writes its metrics to its own file in METRICS_DIR,
+# at most every METRICS_FLUSH_INTERVAL seconds. Scrapes sum the files.
+_flush_lock = threading.Lock()
+_flush_event = threading.Event()
+_flusher_pid = None
+
+
+def changed():
+    if not settings.METRICS_DIR:
+        return
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+    _flush_event.set()
+
+
+def _start_flusher():
+    global _flusher_pid
+    with _flush_lock:
+        if _flusher_pid == os.getpid():
+            return
+        if _flusher_pid is not None:
+            # Forked: the values inherited from the parent are in its file
+            for metric in REGISTRY:
+                metric.clear()
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_flush_loop, name="metrics", daemon=True).start()
+        atexit.register(flush)
+
+
+def _flush_loop():
+    while True:
+        _flush_event.wait()
+        _flush_event.clear()
+        try:
+            flush()
+        except Exception:
+            logger.exception("Unable to write metrics")
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+
+
+def snapshot():
+    """
+    Returns the values of the metrics of this process, keyed by name.
+    """
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+
+def flush():
+    """
+    Writes the metrics of this process to its file in METRICS_DIR.
+    """
+    if not settings.METRICS_DIR:
+        return
+    path = os.path.join(settings.METRICS_DIR, f"{os.getpid()}.json")
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(temp_path, path)
+
+
+def collect():
+    """
+    Returns the values of the metrics summed across the worker processes
+    (only the ones of this process if METRICS_DIR is not set).
+    """
+    if not settings.METRICS_DIR:
+        return snapshot()
+    flush()
+    merged = {metric.name: {} for metric in REGISTRY}
+    metrics = {metric.name: metric for metric in REGISTRY}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, samples in values.items():
+            if name not in metrics:
+                continue
+            for key, value in samples.items():
+                current = merged[name].get(key)
+                merged[name][key] = (
+                    value if current is None else metrics[name].merge(current, value)
+                )
+    return merged
+
+
+def exposition():
+    """
+    Returns the metrics of all the processes in the Prometheus text format.
+    """
+    values = collect()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.exposition(values[metric.name]))
+
+    # Derived from the cache counters, for convenience
+    lines.extend(
+        hit_ratio(
+            "btcwallet_rates_cache_hit_ratio",
+            "Ratio of the rates lookups served from the cache.",
+            values[RATES_CACHE.name],
+            ("hit", "stale"),
+        )
+    )
+    lines.extend(
+        hit_ratio(
+            "btcwallet_token_cache_hit_ratio",
+            "Ratio of the token authentications served from the cache.",
+            values[TOKEN_CACHE.name],
+            ("hit",),
+        )
+    )
+    return "\n".join(lines) + "\n"
+
+
+def hit_ratio(name, documentation, values, hits):
+    """
+    Returns the exposition of the ratio of the lookups of a cache counter
+    (labelled by result) whose result is one of hits.
+    """
+    lookups = {json.loads(key)[0]: count for key, count in values.items()}
+    total = sum(lookups.values())
+    ratio = sum(lookups.get(hit, 0) for hit in hits) / total if total else 0
+    return [
+        f"# HELP {name} {documentation}",
+        f"# TYPE {name} gauge",
+        f"{name} {ratio}",
+    ]
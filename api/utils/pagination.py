@@ -0,0 +1,104 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor (keyset) pagination for transactions, newest first.
+    The position is the (created_at, id) pair of the last returned row,
+    so every page is an index range scan that costs the same as the first
+    one. The cursor is exposed as an opaque token in the "next" link.
+
+    Several querysets may be paginated together (e.g. debits and credits
+    of a wallet); each one is read up to one page and results are merged.
+    Archived querysets, whose rows are all older than the other ones, are
+    only read when the other querysets don't fill the page.
+    """
+
+    page_size = 50
+    max_page_size = 500
+    page_size_query_param = "page_size"
+    cursor_query_param = "cursor"
+    invalid_cursor_message = _("Invalid cursor")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_querysets([queryset], request)
+
+    def paginate_querysets(self, querysets, request, archived_querysets=()):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        rows = {}
+        self.read_page(querysets, position, rows)
+        if len(rows) <= self.page_size:
+            self.read_page(archived_querysets, position, rows)
+
+        page = sorted(rows.values(), key=lambda row: (row.created_at, row.pk))
+        page.reverse()
+        self.has_next = len(page) > self.page_size
+        self.page = page[: self.page_size]
+        return self.page
+
+    def read_page(self, querysets, position, rows):
+        """
+        Reads up to one page (and one row) of each queryset after position
+        into rows, keyed by primary key.
+        """
+        for queryset in querysets:
+            if position is not None:
+                created_at, pk = position
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+                )
+            for row in queryset.order_by("-created_at", "-pk")[: self.page_size + 1]:
+                rows[row.pk] = row
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(last.created_at, last.pk)
+        )
+
+    def encode_cursor(self, created_at, pk):
+        position = f"{created_at.isoformat()}|{pk}".encode()
+        return base64.urlsafe_b64encode(position).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            position = base64.urlsafe_b64decode(encoded.encode()).decode()
+            created_at, pk = position.split("|")
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
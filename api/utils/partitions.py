@@ -0,0 +1,97 @@
+import re
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+# Monthly range partitions of the transactions table on PostgreSQL (see
+# migration 0025). Each month has its own partition, named after it
+# (api_transaction_pYYYYMM). Rows outside of them go to the default
+# partition, and are moved to their month partition when it is created.
+TABLE = "api_transaction"
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_NAME = re.compile(rf"^{TABLE}_p(\d{{4}})(\d{{2}})$")
+
+
+def month_start(value, months=0):
+    """
+    Returns the start (UTC) of the month of value, moved by months.
+    """
+    value = value.astimezone(timezone.utc)
+    month = value.year * 12 + value.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start:%Y%m}"
+
+
+def is_partitioned():
+    """
+    Whether the transactions table is partitioned (PostgreSQL only).
+    """
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def partitions():
+    """
+    Returns the (name, start, end) of the month partitions, oldest first.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = %s::regclass",
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    months = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            start = datetime(
+                int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc
+            )
+            months.append((name, start, month_start(start, 1)))
+    return sorted(months, key=lambda partition: partition[1])
+
+
+def create_partition(start):
+    """
+    Creates the partition of the month starting at start. Rows of the
+    month in the default partition are moved to it first, as a partition
+    can't be attached while the default partition has rows of its range.
+    """
+    name = partition_name(start)
+    end = month_start(start, 1)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+            "WHERE created_at >= %s AND created_at < %s RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved",
+            [start, end],
+        )
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+            "FOR VALUES FROM (%s) TO (%s)",
+            # Bounds must be plain literals
+            [start.isoformat(), end.isoformat()],
+        )
+    return name
+
+
+def drop_partition(name):
+    """
+    Detaches and drops a partition. Its rows must have been archived.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+        cursor.execute(f"DROP TABLE {name}")
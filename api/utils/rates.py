@@ -1,9 +1,64 @@
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, ROUND_DOWN
 
+from django.conf import settings
 from django.core.cache import cache
+from django.db import connections
+from django.utils import timezone
 
 import requests
 
+from api.utils.instrumentation import instrumented
+from api.utils.metrics import RATES_CACHE
+
+logger = logging.getLogger(__name__)
+
+
+class Freshness:
+    """
+    Freshness helpers for values that keep the time they were fetched.
+    """
+
+    __slots__ = ()
+
+    @property
+    def age(self):
+        """
+        Seconds elapsed since the value was fetched.
+        """
+        return (timezone.now() - self.fetched_at).total_seconds()
+
+    def is_fresh(self, max_age=None):
+        if max_age is None:
+            max_age = settings.RATES_MAX_AGE
+        return self.age <= max_age
+
+
+class Rate(Freshness, namedtuple("Rate", ["value", "fetched_at", "source"])):
+    """
+    BTC exchange rate for a currency, with the time it was fetched and
+    the API it was fetched from.
+    """
+
+    __slots__ = ()
+
+
+class RateTable(Freshness, namedtuple("RateTable", ["rates", "fetched_at", "source"])):
+    """
+    BTC exchange rates for all the currencies, fetched at once.
+    """
+
+    __slots__ = ()
+
+    def rate(self, currency):
+        value = self.rates.get(currency.lower())
+        if value is None:
+            return None
+        return Rate(value=value, fetched_at=self.fetched_at, source=self.source)
+
 
 class Rates:
     """
@@ -14,37 +69,143 @@ class Rates:
     Bitpay API Documentation con be found here: https://bitpay.com/api/#rest-api
     """
 
-    API_URL = "https://bitpay.com/rates/BTC/"
+    API_URL = "https://bitpay.com/rates/BTC"
     API_NOT_AVAILABLE = "Not available at the moment"
+    CACHE_KEY = "rates:btc"
+    FAILURE_KEY = "rates:btc:failure"
+    DEFAULT_CURRENCIES = ["usd"]
+
+    # Stale rates are refreshed in background, one refresh at a time
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rates")
+    _refresh = None
+    _refresh_lock = threading.Lock()
+    # Only one request per process fetches the rates when none are cached
+    _fetch_lock = threading.Lock()
 
     @classmethod
-    def api_call(cls, currency):
+    @instrumented("http")
+    def api_call(cls):
         """
         Performs the requests to the external API to query bitcoins rates.
+        Returns the rates of all the currencies, keyed by lowercase code.
         """
         headers = {"x-accept-version": "2.0.0", "Accept": "application/json"}
-        r = requests.get(cls.API_URL + currency, headers=headers)
+        r = requests.get(
+            cls.API_URL, headers=headers, timeout=settings.RATES_API_TIMEOUT
+        )
         r.raise_for_status()
-        return r.json()["data"]["rate"]
+        return {item["code"].lower(): item["rate"] for item in r.json()["data"]}
 
     @classmethod
-    def bitcoins_to_currency(cls, currency, amount):
+    def get_rates(cls, max_age=None, wait=False):
+        """
+        Returns the BTC rate table. The cached table is used while it is not
+        older than max_age seconds (RATES_MAX_AGE by default). A stale table
+        is returned right away and refreshed in background, unless wait is
+        True, so requests don't block on the rates API. Callers can check
+        the freshness of the returned table. Only when no rates are cached
+        at all the API is called synchronously, by one request at a time,
+        and not again for RATES_RETRY_AFTER seconds after it failed.
+        Returns None if no rates are known.
+        """
+        rates = cache.get(cls.CACHE_KEY)
+        if rates is not None and rates.is_fresh(max_age):
+            RATES_CACHE.inc(result="hit")
+            return rates
+        if rates is not None and not wait:
+            RATES_CACHE.inc(result="stale")
+            cls.refresh_rates_in_background()
+            return rates
+        RATES_CACHE.inc(result="miss")
+        if cache.get(cls.FAILURE_KEY):
+            return rates
+        with cls._fetch_lock:
+            # The rates may have been fetched while waiting for the lock
+            fetched = cache.get(cls.CACHE_KEY)
+            if fetched is not None and fetched.is_fresh(max_age):
+                return fetched
+            if cache.get(cls.FAILURE_KEY):
+                return rates
+            return cls.refresh_rates() or rates
+
+    @classmethod
+    def refresh_rates(cls):
+        """
+        Fetches the rates from the API and caches them. Returns None if
+        the API is not available.
+        """
+        try:
+            api_rates = cls.api_call()
+        except Exception:
+            # Don't retry, and let the requests that find no rates cached
+            # skip the API for a while instead of waiting for it
+            cache.set(cls.FAILURE_KEY, True, timeout=settings.RATES_RETRY_AFTER)
+            return None
+        rates = RateTable(
+            rates={code: Decimal(str(rate)) for code, rate in api_rates.items()},
+            fetched_at=timezone.now(),
+            source=cls.API_URL,
+        )
+        # Keep the rates after they get stale, so they can be used as fallback
+        # and refreshed in background. convert() ignores them once they are
+        # older than RATES_MAX_STALE.
+        cache.set(cls.CACHE_KEY, rates, timeout=None)
+        cache.delete(cls.FAILURE_KEY)
+        return rates
+
+    @classmethod
+    def refresh_rates_in_background(cls):
+        """
+        Schedules a refresh of the rates, unless one is already in flight.
+        Returns the future of the refresh.
+        """
+        with cls._refresh_lock:
+            if cls._refresh is None or cls._refresh.done():
+                cls._refresh = cls._executor.submit(cls._background_refresh)
+            return cls._refresh
+
+    @classmethod
+    def _background_refresh(cls):
+        try:
+            return cls.refresh_rates()
+        except Exception:
+            logger.exception("Unable to refresh BTC rates")
+        finally:
+            # The worker thread has its own database connections
+            connections.close_all()
+
+    @classmethod
+    def get_rate(cls, currency, max_age=None, wait=False):
+        """
+        Returns the BTC rate for the given currency, or None if unknown.
+        """
+        rates = cls.get_rates(max_age, wait)
+        if rates is None:
+            return None
+        return rates.rate(currency)
+
+    @classmethod
+    def convert(cls, rates, currency, amount, max_stale=None):
+        """
+        Converts a given amount of bitcoins to currency using the given rate
+        table. A stale rate is used if it is not older than max_stale seconds
+        (RATES_MAX_STALE by default).
+        """
+        if max_stale is None:
+            max_stale = settings.RATES_MAX_STALE
+        rate = rates.rate(currency) if rates is not None else None
+        if rate is None or not rate.is_fresh(max_stale):
+            return cls.API_NOT_AVAILABLE
+        decimals = Decimal("0.01")
+        total = amount * rate.value
+        return total.quantize(decimals, rounding=ROUND_DOWN).normalize()
+
+    @classmethod
+    def bitcoins_to_currency(cls, currency, amount, max_age=None, max_stale=None):
         """
         Converts a given amount of bitcoins to the equivalent number of currency.
-        Caching is used to improve the performance of the application.
-        """
-        if not (rate := cache.get(currency)):
-            try:
-                api_rate = cls.api_call(currency)
-                decimals = Decimal("0.01")
-                total = amount * Decimal(str(api_rate))
-                rate = total.quantize(decimals, rounding=ROUND_DOWN).normalize()
-            except Exception:
-                # Don't retry. Just send empty flag
-                rate = cls.API_NOT_AVAILABLE
-            if rate and rate != cls.API_NOT_AVAILABLE:
-                cache.set(currency, rate)
-        return rate
+        """
+        return cls.convert(cls.get_rates(max_age), currency, amount, max_stale)
 
     @classmethod
     def bitcoins_to_usd(cls, amount):
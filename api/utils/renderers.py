@@ -0,0 +1,89 @@
+import csv
+import io
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class StreamingRenderer(BaseRenderer):
+    """
+    Base class of the renderers of streamed exports. stream() renders the
+    header right away, then the rows in chunks of chunk_size rows, so the
+    whole export is never held in memory. render() is used for the error
+    responses, which are rendered as a single row.
+    """
+
+    charset = "utf-8"
+    chunk_size = 500
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if not isinstance(data, dict):
+            data = {"detail": data}
+        fields = list(data)
+        return (
+            self.render_header(fields) + self.render_row(fields, data.values())
+        ).encode(self.charset)
+
+    def stream(self, fields, rows):
+        yield self.render_header(fields)
+        chunk = []
+        for row in rows:
+            chunk.append(self.render_row(fields, row))
+            if len(chunk) == self.chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+    def render_header(self, fields):
+        raise NotImplementedError
+
+    def render_row(self, fields, values):
+        raise NotImplementedError
+
+
+class CSVRenderer(StreamingRenderer):
+    media_type = "text/csv"
+    format = "csv"
+    # Text starting with these is run as a formula by spreadsheets
+    formula_prefixes = ("=", "+", "-", "@", "\t", "\r")
+
+    def __init__(self):
+        self._encoder = JSONEncoder()
+
+    def render_header(self, fields):
+        return self.render_line(fields)
+
+    def render_row(self, fields, values):
+        return self.render_line(
+            "" if value is None else self.to_text(value) for value in values
+        )
+
+    def render_line(self, values):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        return buffer.getvalue()
+
+    def to_text(self, value):
+        if isinstance(value, str):
+            # Quote it so it is shown as text (CSV injection)
+            return "'" + value if value.startswith(self.formula_prefixes) else value
+        if isinstance(value, (int, float)):
+            return value
+        # Same representation as the JSON responses (dates, decimals, UUIDs)
+        encoded = self._encoder.default(value)
+        return encoded if isinstance(encoded, str) else json.dumps(encoded)
+
+
+class NDJSONRenderer(StreamingRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render_header(self, fields):
+        return ""
+
+    def render_row(self, fields, values):
+        return json.dumps(dict(zip(fields, values)), cls=JSONEncoder) + "\n"
@@ -0,0 +1,144 @@
+import functools
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Routing of the request being processed by the current thread
+_state = threading.local()
+
+# Models of the database cache, which is always read from the primary
+CACHE_APP_LABEL = "django_cache"
+# Shared cache key marking a user who recently wrote
+STICKY_KEY = "replica_sticky:{}"
+# Signed cookie (also used as salt) holding the pk of a user who recently
+# wrote, which saves the cache lookup for the client that wrote
+STICKY_COOKIE = "replica_sticky"
+
+
+class RequestRouting:
+    """
+    Replica the reads of a request go to (None for the primary), and
+    whether the request wrote to the database.
+    """
+
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+
+def current_routing():
+    """
+    Returns the routing of the request being processed, or None.
+    """
+    return getattr(_state, "routing", None)
+
+
+@contextmanager
+def request_routing():
+    """
+    Scopes the routing to a request. Reads go to the primary until
+    use_replica() is called.
+    """
+    routing = _state.routing = RequestRouting()
+    try:
+        yield routing
+    finally:
+        _state.routing = None
+
+
+def is_sticky(request):
+    """
+    Whether the user of the request recently wrote, from any client. The
+    cookie set by make_sticky answers without a lookup, otherwise the
+    marker of the user is looked up in the shared cache.
+    """
+    pk = request.get_signed_cookie(
+        STICKY_COOKIE,
+        default=None,
+        salt=STICKY_COOKIE,
+        max_age=settings.REPLICA_STICKY_SECONDS,
+    )
+    if pk is not None and pk == str(request.user.pk):
+        return True
+    return cache.get(STICKY_KEY.format(request.user.pk)) is not None
+
+
+def make_sticky(response, user):
+    """
+    Sends the reads of the user to the primary for REPLICA_STICKY_SECONDS,
+    so they read their own writes while replicas catch up. Stickiness is
+    kept per user in the shared cache, so it applies to all their clients
+    (token clients usually don't send cookies back), and in a signed cookie.
+    """
+    cache.set(STICKY_KEY.format(user.pk), True, settings.REPLICA_STICKY_SECONDS)
+    response.set_signed_cookie(
+        STICKY_COOKIE,
+        str(user.pk),
+        salt=STICKY_COOKIE,
+        max_age=settings.REPLICA_STICKY_SECONDS,
+        httponly=True,
+    )
+
+
+def use_replica(request):
+    """
+    Sends the next reads of the current request to one of the
+    DATABASE_REPLICAS, unless the request or its user recently wrote.
+    """
+    routing = current_routing()
+    if routing is None or routing.wrote or not settings.DATABASE_REPLICAS:
+        return
+    if getattr(request.user, "pk", None) is not None and is_sticky(request):
+        return
+    routing.replica = random.choice(settings.DATABASE_REPLICAS)
+
+
+def replica_reads(view_method):
+    """
+    Decorator of read-only view methods, whose reads may be served by a
+    replica. Runs after authentication, so stickiness applies to the user.
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        use_replica(request)
+        return view_method(view, request, *args, **kwargs)
+
+    return wrapper
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of the requests allowed to use a replica (see
+    replica_reads) to it, and everything else, writes and locking reads
+    included, to the primary ("default") database. Writes are recorded,
+    so the request stops reading from the replica and its user is made
+    sticky to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        routing = current_routing()
+        if routing is None or model._meta.app_label == CACHE_APP_LABEL:
+            return None
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing()
+        if routing is not None and model._meta.app_label != CACHE_APP_LABEL:
+            routing.replica = None
+            routing.wrote = True
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are migrated through the primary
+        return db == "default"
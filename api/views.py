@@ -1,6 +1,8 @@
-from django.http import Http404
+import heapq
+
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.db import transaction
-from django.db.models import Q, Sum
+from django.utils import timezone
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -8,14 +10,29 @@ from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.permissions import IsAuthenticated
 from .utils.authentication import TokenAdminAuthentication
+from .utils.idempotency import idempotent
+from .utils.metrics import exposition
+from .utils.pagination import KeysetPagination
+from .utils.renderers import CSVRenderer, NDJSONRenderer
+from .utils.routers import replica_reads
 
 from .serializers import (
     UserCreateSerializer,
     WalletSerializer,
     TransactionSerializer,
+    TransactionBatchSerializer,
+    CurrencyQuerySerializer,
+    BalanceAtSerializer,
     StatisticsSerializer,
+    StatisticsBucketSerializer,
+    StatisticsQuerySerializer,
+)
+from .models import (
+    Wallet,
+    Transaction,
+    ArchivedTransaction,
+    StatisticsRollup,
 )
-from .models import Wallet, Transaction, Statistics
 
 
 class UserCreateView(APIView):
@@ -39,16 +56,32 @@ class WalletCreateView(APIView):
     Create BTC wallet for the authenticated user. 1 BTC is
     automatically granted to the new wallet upon creation.
     User may register only up to 10 wallets.
-    Returns wallet address and current balance in BTC and USD.
+    Returns wallet address and current balance in BTC and USD (or
+    the currencies requested with ?currency=usd,eur,...).
+    GET lists all the wallets of the user, with their balances.
     """
 
     permission_classes = [IsAuthenticated]
     serializer_class = WalletSerializer
 
+    @replica_reads
+    def get(self, request, *args, **kwargs):
+        user = request.user
+        query = CurrencyQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        # Balances are stored on the wallets, one query lists them all
+        wallets = Wallet.objects.filter(user=user).order_by("created", "pk")
+        context = {"currencies": query.get_currencies()}
+        serializer = self.serializer_class(wallets, many=True, context=context)
+        return Response(serializer.data)
+
     @transaction.atomic
     def post(self, request, *args, **kwargs):
         user = request.user
-        serializer = self.serializer_class(data=request.data, context={"user": user})
+        query = CurrencyQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        context = {"user": user, "currencies": query.get_currencies()}
+        serializer = self.serializer_class(data=request.data, context=context)
         serializer.is_valid(raise_exception=True)
         serializer.save()
         return Response(serializer.data, status=status.HTTP_201_CREATED,)
@@ -56,7 +89,8 @@ class WalletCreateView(APIView):
 
 class WalletDetailView(APIView):
     """
-    Returns wallet address and current balance in BTC and USD.
+    Returns wallet address and current balance in BTC and USD (or
+    the currencies requested with ?currency=usd,eur,...).
     """
 
     permission_classes = [IsAuthenticated]
@@ -68,10 +102,47 @@ class WalletDetailView(APIView):
         except Exception:
             raise Http404
 
+    @replica_reads
+    def get(self, request, address):
+        user = request.user
+        wallet = self.get_object(address, user)
+        query = CurrencyQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        context = {"currencies": query.get_currencies()}
+        serializer = self.serializer_class(wallet, context=context)
+        return Response(serializer.data)
+
+
+class WalletBalanceView(APIView):
+    """
+    Returns wallet balance in BTC at a given point in time (?at=<timestamp>).
+    Current balance is returned if no timestamp is provided.
+    """
+
+    permission_classes = [IsAuthenticated]
+    serializer_class = BalanceAtSerializer
+
+    def get_object(self, address, user):
+        try:
+            return Wallet.objects.get(address=address, user=user)
+        except Exception:
+            raise Http404
+
+    @replica_reads
     def get(self, request, address):
         user = request.user
         wallet = self.get_object(address, user)
-        serializer = self.serializer_class(wallet)
+        query = self.serializer_class(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        at = query.validated_data.get("at")
+        if at is None:
+            at = timezone.now()
+            balance = wallet.balance_btc + wallet.accrued_balance_btc()
+        else:
+            balance = wallet.balance_btc_at(at)
+        serializer = self.serializer_class(
+            {"address": str(wallet.address), "at": at, "btc": str(balance)}
+        )
         return Response(serializer.data)
 
 
@@ -81,19 +152,40 @@ class TransactionCreateListView(APIView):
     Transaction is free if transferred to own wallet.
     Transaction costs 1.5% of the transferred amount (profit of the platform) if
     transferred to a wallet of another user.
+    Retries with the same Idempotency-Key header get the stored response.
     """
 
     permission_classes = [IsAuthenticated]
     serializer_class = TransactionSerializer
+    pagination_class = KeysetPagination
 
+    @replica_reads
     def get(self, request, *args, **kwargs):
         user = request.user
-        transactions = Transaction.objects.filter(
-            Q(wallet_from__user=user) | Q(wallet_to__user=user)
+        addresses = Wallet.objects.filter(user=user).values_list("address", flat=True)
+        paginator = self.pagination_class()
+        archived = []
+        if ArchivedTransaction.in_use():
+            archived = self.wallet_querysets(ArchivedTransaction, addresses)
+        transactions = paginator.paginate_querysets(
+            self.wallet_querysets(Transaction, addresses), request, archived
         )
         serializer = self.serializer_class(transactions, many=True)
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
+    @staticmethod
+    def wallet_querysets(model, addresses):
+        """
+        Yields the transactions from and to each wallet as separate
+        querysets, so each page is read with an index range scan per wallet
+        (users have at most 10 wallets) instead of sorting all the rows of
+        the user's wallets. Addresses are only read once the cursor is valid.
+        """
+        for address in addresses:
+            yield model.objects.filter(wallet_from=address)
+            yield model.objects.filter(wallet_to=address)
+
+    @idempotent
     def post(self, request, *args, **kwargs):
         user = request.user
         transfer = request.data
@@ -103,6 +195,33 @@ class TransactionCreateListView(APIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
+class TransactionBatchView(APIView):
+    """
+    Transfers BTCs for a list of transfers at once. All the wallets are
+    locked together, and ledger rows are inserted in bulk.
+    Returns 201 if all transfers were performed. Otherwise, returns 400 in
+    "atomic" mode (nothing transferred) and 207 in "best_effort" mode, with
+    the result of each transfer.
+    """
+
+    permission_classes = [IsAuthenticated]
+    serializer_class = TransactionBatchSerializer
+
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        user = request.user
+        serializer = self.serializer_class(data=request.data, context={"user": user})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        if serializer.is_created():
+            response_status = status.HTTP_201_CREATED
+        elif serializer.validated_data["mode"] == serializer.ATOMIC:
+            response_status = status.HTTP_400_BAD_REQUEST
+        else:
+            response_status = status.HTTP_207_MULTI_STATUS
+        return Response(serializer.data, status=response_status)
+
+
 class TransactionDetailView(APIView):
     """
     Returns all transactions related to specific wallet
@@ -110,6 +229,7 @@ class TransactionDetailView(APIView):
 
     permission_classes = [IsAuthenticated]
     serializer_class = TransactionSerializer
+    pagination_class = KeysetPagination
 
     def get_object(self, address, user):
         try:
@@ -117,29 +237,141 @@ class TransactionDetailView(APIView):
         except Exception:
             raise Http404
 
+    @replica_reads
     def get(self, request, address):
         user = request.user
         wallet = self.get_object(address, user)
-        transactions = Transaction.objects.filter(
-            Q(wallet_from=wallet) | Q(wallet_to=wallet)
+        paginator = self.pagination_class()
+        archived = []
+        if ArchivedTransaction.in_use():
+            archived = [
+                ArchivedTransaction.objects.filter(wallet_from=wallet),
+                ArchivedTransaction.objects.filter(wallet_to=wallet),
+            ]
+        transactions = paginator.paginate_querysets(
+            [
+                Transaction.objects.filter(wallet_from=wallet),
+                Transaction.objects.filter(wallet_to=wallet),
+            ],
+            request,
+            archived,
         )
         serializer = self.serializer_class(transactions, many=True)
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class TransactionExportView(APIView):
+    """
+    Streams all the transactions of a wallet, oldest first, as CSV or
+    NDJSON (?format=csv|ndjson). Debits and credits, archived or not, are
+    read with server-side cursors in chunks and merged, so memory stays
+    constant whatever the size of the history.
+    """
+
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [CSVRenderer, NDJSONRenderer]
+    fields = TransactionSerializer.Meta.fields
+    chunk_size = 2000
+
+    def get_object(self, address, user):
+        try:
+            return Wallet.objects.get(address=address, user=user)
+        except Exception:
+            raise Http404
+
+    @replica_reads
+    def get(self, request, address):
+        wallet = self.get_object(address, request.user)
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            renderer.stream(self.fields, self.get_rows(wallet)),
+            content_type=f"{renderer.media_type}; charset={renderer.charset}",
+        )
+        filename = f"transactions-{wallet.address}.{renderer.format}"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+    def get_rows(self, wallet):
+        # Rows are read once the response is streamed, after the routing of
+        # the request ended: use the database the wallet was read from.
+        querysets = [
+            model.objects.using(wallet._state.db).filter(**{field: wallet})
+            for model in ArchivedTransaction.ledgers()
+            for field in ("wallet_from", "wallet_to")
+        ]
+        iterators = [
+            queryset.order_by("created_at", "pk")
+            .values_list("created_at", "pk", *self.fields)
+            .iterator(chunk_size=self.chunk_size)
+            for queryset in querysets
+        ]
+        last_pk = None
+        for row in heapq.merge(*iterators, key=lambda row: row[:2]):
+            if row[1] == last_pk:
+                continue
+            last_pk = row[1]
+            values = dict(zip(self.fields, row[2:]))
+            for field in ("wallet_from", "wallet_to"):
+                if values[field] is not None:
+                    values[field] = str(values[field])
+            # Same representation as the JSON responses
+            values["amount"] = str(values["amount"])
+            yield values.values()
 
 
 class StatisticsView(APIView):
     """
-    Returns the total number of transactions and platform profit.
-    Profit amount unit is BTC
+    Returns the total number of transactions and platform profit, from the
+    last statistics prefix sum and the hours after it. Profit amount unit
+    is BTC.
+    With ?from=&to=&granularity=hour|day|month returns the totals of the
+    range and a time series, computed from the statistics prefix sums.
     """
 
     authentication_classes = [TokenAdminAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = StatisticsSerializer
 
+    @replica_reads
+    def get(self, request, *args, **kwargs):
+        query = StatisticsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        if not query.validated_data:
+            transactions, profit = StatisticsRollup.totals()
+            stats = {"transactions": transactions, "profit": profit}
+            serializer = self.serializer_class(stats)
+            return Response(serializer.data)
+
+        boundaries = query.validated_data["boundaries"]
+        totals = StatisticsRollup.totals_before(boundaries)
+        series = []
+        for start, end in zip(boundaries, boundaries[1:]):
+            series.append(
+                {
+                    "start": start,
+                    "transactions": totals[end][0] - totals[start][0],
+                    "profit": totals[end][1] - totals[start][1],
+                }
+            )
+        first, last = totals[boundaries[0]], totals[boundaries[-1]]
+        stats = {"transactions": last[0] - first[0], "profit": last[1] - first[1]}
+        data = self.serializer_class(stats).data
+        data["granularity"] = query.validated_data["granularity"]
+        data["series"] = StatisticsBucketSerializer(series, many=True).data
+        return Response(data)
+
+
+class MetricsView(APIView):
+    """
+    Returns the metrics of the API workers in the Prometheus text format:
+    request latency histograms per view, transfers by type and outcome,
+    rates and token cache lookups and statistics write time.
+    """
+
+    authentication_classes = [TokenAdminAuthentication]
+    permission_classes = [IsAuthenticated]
+
     def get(self, request, *args, **kwargs):
-        stats = Statistics.objects.aggregate(
-            transactions=Sum("transactions"), profit=Sum("profit")
+        return HttpResponse(
+            exposition(), content_type="text/plain; version=0.0.4; charset=utf-8"
         )
-        serializer = self.serializer_class(stats)
-        return Response(serializer.data)
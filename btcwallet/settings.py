@@ -46,6 +46,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.middleware.MetricsMiddleware",
+    # Only enabled when REQUEST_TIMING is set
+    "api.middleware.RequestTimingMiddleware",
+    # Only enabled when DATABASE_REPLICAS is set
+    "api.middleware.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -92,6 +97,34 @@ DATABASES = {
     }
 }
 
+# Read replicas, as comma separated hosts sharing the other settings of the
+# default database, with the "replica_1", "replica_2"... aliases.
+for index, host in enumerate(
+    filter(None, os.getenv("DATABASE_REPLICA_HOSTS", "").split(",")), 1
+):
+    DATABASES[f"replica_{index}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "TEST": {"MIRROR": "default"},
+    }
+# The "replica" alias is a second connection to the default database, which
+# stands for a replica in local development and tests. Only defined when
+# DATABASE_LOCAL_REPLICA is set (see .env), so production opens no extra
+# connection.
+if os.getenv("DATABASE_LOCAL_REPLICA"):
+    DATABASES["replica"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+
+# Aliases the reads of read-only views are sent to (the replica_<n> ones by
+# default). Users read from the primary for REPLICA_STICKY_SECONDS after
+# they wrote, so they don't see stale balances.
+DATABASE_REPLICAS = os.getenv(
+    "DATABASE_REPLICAS",
+    ",".join(alias for alias in DATABASES if alias.startswith("replica_")),
+)
+DATABASE_REPLICAS = [alias for alias in DATABASE_REPLICAS.split(",") if alias]
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", 10))
+DATABASE_ROUTERS = ["api.utils.routers.ReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -126,16 +159,23 @@ USE_TZ = True
 STATIC_URL = "/static/"
 
 CACHES = {
+    # Small in-process cache in front of the shared database cache
     "default": {
+        "BACKEND": "api.utils.cache.TieredCache",
+        "LOCATION": "shared",
+        "TIMEOUT": 60,
+        "OPTIONS": {"MAX_ENTRIES": 1000, "LOCAL_TIMEOUT": 5},
+    },
+    "shared": {
         "BACKEND": "django.core.cache.backends.db.DatabaseCache",
         "LOCATION": "api_rates_cache",
         "TIMEOUT": 60,
-    }
+    },
 }
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "api.utils.authentication.CachedTokenAuthentication",
         "rest_framework.authentication.SessionAuthentication",
     ],
     "EXCEPTION_HANDLER": "api.utils.exception_handler.custom_exception_handler",
@@ -147,3 +187,68 @@ PLATFORM_WALLET_USER_NAME = os.getenv("PLATFORM_WALLET_USER_NAME", None)
 PLATFORM_WALLET_USER_PASSWORD = os.getenv("PLATFORM_WALLET_USER_PASSWORD", None)
 PLATFORM_TRANSACTION_LIMITS = os.getenv("PLATFORM_TRANSACTION_LIMITS", None)
 PLATFORM_PROFIT = "0.015"  # 15%
+# Bitcoins the platform wallet is funded with when it is created
+PLATFORM_INITIAL_FUNDS = os.getenv("PLATFORM_INITIAL_FUNDS", "1000")
+
+# Seconds a cached BTC rate is considered fresh, and how long a stale rate
+# may still be used when the rates API is not available.
+RATES_MAX_AGE = int(os.getenv("RATES_MAX_AGE", 60))
+RATES_MAX_STALE = int(os.getenv("RATES_MAX_STALE", 900))
+# Seconds to wait for the rates API
+RATES_API_TIMEOUT = float(os.getenv("RATES_API_TIMEOUT", 2))
+# Seconds the rates API is not called again, when no rates are cached, after
+# it failed
+RATES_RETRY_AFTER = int(os.getenv("RATES_RETRY_AFTER", 30))
+
+# Number of rows the statistics of each hour are split in, to avoid contention
+STATISTICS_SHARDS = int(os.getenv("STATISTICS_SHARDS", 16))
+# Number of rows the profits and grants of the platform wallet are accrued on
+PLATFORM_BALANCE_SHARDS = int(os.getenv("PLATFORM_BALANCE_SHARDS", 16))
+
+# Number of transactions per wallet between two balance checkpoints
+BALANCE_CHECKPOINT_INTERVAL = int(os.getenv("BALANCE_CHECKPOINT_INTERVAL", 1000))
+
+# How Wallet.transfer updates balances: "pessimistic" locks the source wallet
+# row, "optimistic" uses a conditional UPDATE. Transfers aborted by the
+# database (e.g. deadlocks) are retried up to WALLET_TRANSFER_RETRIES times.
+WALLET_TRANSFER_MODE = os.getenv("WALLET_TRANSFER_MODE", "pessimistic")
+WALLET_TRANSFER_RETRIES = int(os.getenv("WALLET_TRANSFER_RETRIES", 3))
+
+# Seconds the response of a request with an Idempotency-Key is kept, and
+# seconds after which a request that never completed may be retried.
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", 24 * 60 * 60))
+IDEMPOTENCY_CLAIM_TIMEOUT = int(os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT", 60))
+
+# Authenticated tokens are cached in process for TOKEN_CACHE_TIMEOUT seconds.
+# Deleted tokens and deactivated users are evicted right away in the process
+# that changed them, other processes (and bulk updates, which send no
+# signals) see the change once the token expires, so keep it short.
+TOKEN_CACHE_TIMEOUT = int(os.getenv("TOKEN_CACHE_TIMEOUT", 5))
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", 10000))
+
+# Adds a Server-Timing header to each response, with the number and time of
+# the SQL queries, cache calls and outbound HTTP calls of the request, and
+# logs them as a JSON line to the "api.timing" logger.
+REQUEST_TIMING = os.getenv("REQUEST_TIMING", "").lower() in ("1", "true", "yes")
+
+# Transactions older than this many months (counted in whole months) are
+# moved to the archive by the archive_transactions command. History and
+# point-in-time balances only read the archive when it is set.
+TRANSACTION_ARCHIVE_AFTER_MONTHS = os.getenv("TRANSACTION_ARCHIVE_AFTER_MONTHS")
+if TRANSACTION_ARCHIVE_AFTER_MONTHS is not None:
+    TRANSACTION_ARCHIVE_AFTER_MONTHS = int(TRANSACTION_ARCHIVE_AFTER_MONTHS)
+
+# Directory where each worker process writes its metrics (at most every
+# METRICS_FLUSH_INTERVAL seconds), so /metrics reports the sum of all the
+# workers. Without it /metrics only reports the process serving it.
+METRICS_DIR = os.getenv("METRICS_DIR", None)
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "api.timing": {"handlers": ["console"], "level": "INFO", "propagate": False}
+    },
+}
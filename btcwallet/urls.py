@@ -16,8 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import re_path, include
 
+from api.views import MetricsView
+
 urlpatterns = [
     re_path("admin/", admin.site.urls),
     re_path(r"^api/v1/", include("api.urls")),
     re_path("api/v1/login/", include("rest_framework.urls")),
+    re_path(r"^metrics$", MetricsView.as_view(), name="metrics"),
 ]